@@ -0,0 +1,224 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent cache shared by all the runs of the presubmit hooks."""
+
+from __future__ import print_function
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Bump this whenever the layout of the tables changes.  Caches written with
+# another version are thrown away.
+SCHEMA_VERSION = 1
+
+# How much data (keys and values) a cache keeps before it evicts the least
+# recently used entries.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# How long to wait for another process holding a lock on the database.
+_TIMEOUT = 30
+
+# How many entries to ask SQLite for at once in GetMany.
+_BATCH_SIZE = 500
+
+
+def GetDefaultPath():
+  """Returns where the cache shared by all the projects lives."""
+  cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, 'repohooks', 'cache.sqlite')
+
+
+class Cache(object):
+  """A key/value store kept in a single SQLite database.
+
+  Values are anything that can be serialized as JSON; they are serialized as
+  they are put, and any that can't be are dropped.  The database is in WAL
+  mode, so several processes (e.g. repo upload in different projects) can use
+  it at the same time.  To keep those processes from contending for the write
+  lock, Put calls (and the access times of Get hits) are kept in memory, and
+  written out in a single transaction by Flush.  Once the data stored exceeds
+  the byte budget, Flush evicts the least recently used entries.
+
+  A Cache may be used from several threads.
+
+  Attributes:
+    hits: The number of lookups that found a value.
+    misses: The number of lookups that didn't.
+  """
+
+  def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+    """Opens the cache, creating it if needed.
+
+    Args:
+      path: The file the cache is kept in.
+      max_bytes: The most data to keep in the cache.
+
+    Raises:
+      sqlite3.Error: The database couldn't be opened.
+    """
+    self.path = path
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._pending = {}
+    self._touched = set()
+    self._lock = threading.Lock()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Someone else may have just created it.
+        if not os.path.isdir(directory):
+          raise
+    self._conn = sqlite3.connect(path, timeout=_TIMEOUT,
+                                 check_same_thread=False,
+                                 isolation_level=None)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+    self._InitSchema()
+
+  def _InitSchema(self):
+    """Creates the tables, replacing any with another schema version."""
+    conn = self._conn
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == SCHEMA_VERSION:
+      return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+      # Check again now that we hold the write lock.
+      version = conn.execute('PRAGMA user_version').fetchone()[0]
+      if version != SCHEMA_VERSION:
+        conn.execute('DROP TABLE IF EXISTS entries')
+        conn.execute('CREATE TABLE entries ('
+                     'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                     'size INTEGER NOT NULL, atime REAL NOT NULL)')
+        conn.execute('CREATE INDEX entries_atime ON entries (atime)')
+        conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+      conn.execute('COMMIT')
+    except:
+      conn.execute('ROLLBACK')
+      raise
+
+  def GetMany(self, keys):
+    """Looks up several keys at once.
+
+    Args:
+      keys: An iterable of keys (strings).
+
+    Returns:
+      A dictionary mapping the keys that were found to their values.
+    """
+    keys = list(keys)
+    results = {}
+    with self._lock:
+      missing = []
+      for key in keys:
+        if key in self._pending:
+          results[key] = json.loads(self._pending[key])
+        else:
+          missing.append(key)
+
+      for i in xrange(0, len(missing), _BATCH_SIZE):
+        batch = missing[i:i + _BATCH_SIZE]
+        rows = self._conn.execute(
+            'SELECT key, value FROM entries WHERE key IN (%s)' %
+            ','.join('?' * len(batch)), batch)
+        for key, value in rows:
+          results[key] = json.loads(value)
+          self._touched.add(key)
+
+      self.hits += len(results)
+      self.misses += len(keys) - len(results)
+    return results
+
+  def Get(self, key, default=None):
+    """Returns the value cached under |key|, or |default| if there is none."""
+    return self.GetMany([key]).get(key, default)
+
+  def PutMany(self, items):
+    """Caches several values at once.
+
+    Values which can't be serialized as JSON aren't cached, without affecting
+    the others.
+
+    Args:
+      items: A dictionary (or an iterable of pairs) mapping keys to values.
+    """
+    if isinstance(items, dict):
+      items = items.iteritems()
+    serialized = []
+    for key, value in items:
+      try:
+        serialized.append((key, json.dumps(value)))
+      except (TypeError, ValueError):
+        pass
+    with self._lock:
+      self._pending.update(serialized)
+
+  def Put(self, key, value):
+    """Caches |value| under |key|."""
+    self.PutMany([(key, value)])
+
+  def Flush(self):
+    """Writes out the pending changes, and evicts entries over the budget."""
+    with self._lock:
+      if not self._pending and not self._touched:
+        return
+      now = time.time()
+      rows = [(key, value, len(key) + len(value), now)
+              for key, value in self._pending.iteritems()]
+
+      conn = self._conn
+      conn.execute('BEGIN IMMEDIATE')
+      try:
+        conn.executemany('UPDATE entries SET atime = ? WHERE key = ?',
+                         [(now, x) for x in self._touched])
+        conn.executemany('INSERT OR REPLACE INTO entries '
+                         '(key, value, size, atime) VALUES (?, ?, ?, ?)', rows)
+        self._Evict()
+        conn.execute('COMMIT')
+      except:
+        conn.execute('ROLLBACK')
+        raise
+      self._pending = {}
+      self._touched = set()
+
+  def _Evict(self):
+    """Deletes the least recently used entries until we're within budget."""
+    total = self._conn.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    excess = total - self.max_bytes
+    if excess <= 0:
+      return
+
+    doomed = []
+    for key, size in self._conn.execute(
+        'SELECT key, size FROM entries ORDER BY atime'):
+      doomed.append((key,))
+      excess -= size
+      if excess <= 0:
+        break
+    self._conn.executemany('DELETE FROM entries WHERE key = ?', doomed)
+
+  def Stats(self):
+    """Returns a dictionary of counters describing how the cache was used."""
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'pending': len(self._pending)}
+
+  def Close(self):
+    """Writes out the pending changes and closes the database."""
+    try:
+      self.Flush()
+    finally:
+      self._conn.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/python2
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for cache.py."""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import sys
+import threading
+
+import cache
+
+# Make sure we can find the chromite paths.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..'))
+
+from chromite.lib import cros_test_lib
+
+
+class CacheTest(cros_test_lib.TempDirTestCase):
+  """Tests for cache.Cache."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'sub', 'cache.sqlite')
+    self.cache = cache.Cache(self.path)
+
+  def tearDown(self):
+    self.cache.Close()
+
+  def testRoundTrip(self):
+    """Verify values survive being written out and read back."""
+    self.cache.Put('none', None)
+    self.cache.PutMany({'list': [1, 'a'], 'str': 'x'})
+    # Values are visible before being flushed.
+    self.assertEqual(self.cache.Get('list'), [1, 'a'])
+    self.cache.Close()
+
+    self.cache = cache.Cache(self.path)
+    self.assertEqual(self.cache.GetMany(['none', 'list', 'str', 'missing']),
+                     {'none': None, 'list': [1, 'a'], 'str': 'x'})
+    self.assertEqual(self.cache.Get('missing', 'default'), 'default')
+
+  def testUnserializable(self):
+    """Verify values which can't be stored are dropped on their own."""
+    self.cache.PutMany([('good', 1), ('bad', object()), ('bytes', '\xff'),
+                        ('also_good', 2)])
+    self.assertEqual(self.cache.GetMany(['good', 'bad', 'bytes', 'also_good']),
+                     {'good': 1, 'also_good': 2})
+    self.cache.Close()
+
+    self.cache = cache.Cache(self.path)
+    self.assertEqual(self.cache.GetMany(['good', 'bad', 'bytes', 'also_good']),
+                     {'good': 1, 'also_good': 2})
+
+  def testManyKeys(self):
+    """Verify lookups of more keys than fit in one query."""
+    self.cache.PutMany(('k%d' % i, i) for i in xrange(1200))
+    self.cache.Flush()
+    results = self.cache.GetMany('k%d' % i for i in xrange(0, 2400, 2))
+    self.assertEqual(len(results), 600)
+    self.assertEqual(results['k1198'], 1198)
+
+  def testCounters(self):
+    """Verify hits and misses are counted."""
+    self.cache.Put('a', 1)
+    self.cache.GetMany(['a', 'b', 'c'])
+    self.cache.Get('a')
+    self.assertEqual(self.cache.Stats(),
+                     {'hits': 2, 'misses': 2, 'pending': 1})
+
+  def testEviction(self):
+    """Verify the least recently used entries go once over budget."""
+    self.cache.max_bytes = 100
+    for key in ('a', 'b', 'c'):
+      self.cache.Put(key, 'x' * 30)
+      self.cache.Flush()
+    # Make 'a' the most recently used entry.
+    self.cache.Get('a')
+    self.cache.Put('d', 'x' * 30)
+    self.cache.Flush()
+    self.assertEqual(sorted(self.cache.GetMany('abcd')), ['a', 'c', 'd'])
+
+  def testSchemaVersion(self):
+    """Verify caches from another schema version are discarded."""
+    self.cache.Put('a', 1)
+    self.cache.Close()
+    conn = sqlite3.connect(self.path)
+    conn.execute('PRAGMA user_version = %d' % (cache.SCHEMA_VERSION + 1))
+    conn.close()
+
+    self.cache = cache.Cache(self.path)
+    self.assertEqual(self.cache.Get('a'), None)
+    self.cache.Put('a', 2)
+    self.cache.Flush()
+    self.assertEqual(self.cache.Get('a'), 2)
+
+  def testSharedFile(self):
+    """Verify several users of the same file see each other's writes."""
+    other = cache.Cache(self.path)
+    try:
+      other.Put('a', 1)
+      self.cache.Put('b', 2)
+      other.Flush()
+      self.cache.Flush()
+      self.assertEqual(other.GetMany(['a', 'b']), {'a': 1, 'b': 2})
+    finally:
+      other.Close()
+
+  def testThreads(self):
+    """Verify the cache can be used from several threads."""
+    def _Work(n):
+      for i in xrange(50):
+        self.cache.Put('%d-%d' % (n, i), i)
+        self.cache.Get('%d-%d' % (n, i // 2))
+    threads = [threading.Thread(target=_Work, args=(n,)) for n in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.cache.Flush()
+    self.assertEqual(len(self.cache.GetMany(
+        '%d-%d' % (n, i) for n in xrange(4) for i in xrange(50))), 200)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main(module=__name__)
@@ -46,6 +46,7 @@ my $ignore_perl_version = 0;
 my $minimum_perl_version = 5.10.0;
 my $min_conf_desc_length = 4;
 my $spelling_file = "$D/spelling.txt";
+my $server = 0;
 
 sub help {
 	my ($exitcode) = @_;
@@ -87,6 +88,11 @@ Options:
                              file.  It's your fault if there's no backup or git
   --ignore-perl-version      override checking of perl version.  expect
                              runtime errors.
+  --server                   check patches read from standard input one after
+                             the other, each one sent as its length in bytes
+                             on a line of its own followed by the patch, and
+                             answer each with a "<exit code> <length>" line
+                             followed by the report
   -h, --help, --version      display this help and exit
 
 When FILE is - read standard input.
@@ -143,6 +149,7 @@ GetOptions(
 	'fix!'		=> \$fix,
 	'fix-inplace!'	=> \$fix_inplace,
 	'ignore-perl-version!' => \$ignore_perl_version,
+	'server!'	=> \$server,
 	'debug=s'	=> \%debug,
 	'test-only=s'	=> \$tst_only,
 	'h|help'	=> \$help,
@@ -163,7 +170,7 @@ if ($^V && $^V lt $minimum_perl_version) {
 	}
 }
 
-if ($#ARGV < 0) {
+if ($#ARGV < 0 && !$server) {
 	print "$P: no input files\n";
 	exit(1);
 }
@@ -657,6 +664,58 @@ my @fixed_deleted = ();
 my $fixlinenr = -1;
 
 my $vname;
+
+# Check the patches sent on standard input until it is closed (see --server),
+# so that callers checking many patches only pay for starting up once.
+sub serve {
+	binmode(STDIN);
+	binmode(STDOUT);
+	$| = 1;
+
+	while (defined(my $header = <STDIN>)) {
+		my ($size) = ($header =~ /^(\d+)\n$/)
+		    or die "$P: bad request header '$header'\n";
+		my $patch = '';
+		while (length($patch) < $size) {
+			read(STDIN, $patch, $size - length($patch), length($patch))
+			    or die "$P: truncated request\n";
+		}
+		@rawlines = split(/\n/, $patch, -1);
+		pop(@rawlines) if (@rawlines && $rawlines[-1] eq '');
+		$vname = 'Your patch';
+		$rpt_cleaners = 0;
+
+		my $output = '';
+		my $exitcode = 0;
+		open(my $report, '>', \$output)
+		    or die "$P: can't capture the report - $!\n";
+		my $stdout = select($report);
+		{
+			local $SIG{__WARN__} = sub { print $report @_; };
+			my $clean = eval { process('-') };
+			if ($@) {
+				print $report $@;
+				$exitcode = 2;
+			} elsif (!$clean) {
+				$exitcode = 1;
+			}
+		}
+		select($stdout);
+		close($report);
+		print $exitcode . ' ' . length($output) . "\n" . $output;
+
+		@rawlines = ();
+		@lines = ();
+		@fixed = ();
+		@fixed_inserted = ();
+		@fixed_deleted = ();
+		$fixlinenr = -1;
+	}
+	exit(0);
+}
+
+serve() if ($server);
+
 for my $filename (@ARGV) {
 	my $FILE;
 	if ($file) {
@@ -5143,18 +5202,21 @@ sub process {
 	# If we have no input at all, then there is nothing to report on
 	# so just keep quiet.
 	if ($#rawlines == -1) {
+		return 1 if ($server);
 		exit(0);
 	}
 
 	# In mailback mode only produce a report in the negative, for
 	# things that appear to be patches.
 	if ($mailback && ($clean == 1 || !$is_patch)) {
+		return 1 if ($server);
 		exit(0);
 	}
 
 	# This is not a patch, and we are are in 'no-patch' mode so
 	# just keep quiet.
 	if (!$chk_patch && !$is_patch) {
+		return 1 if ($server);
 		exit(0);
 	}
 
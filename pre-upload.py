@@ -15,12 +15,25 @@ import collections
 import ConfigParser
 import fnmatch
 import functools
+import hashlib
 import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
 import re
+import sqlite3
+import sre_constants
+import sre_parse
+import subprocess
 import sys
 import stat
+import StringIO
+import tempfile
+import threading
+import traceback
 
+import cache
 from errors import (VerifyException, HookFailure, PrintErrorForProject,
                     PrintErrorsForCommit)
 
@@ -39,6 +52,10 @@ from chromite.licensing import licenses_lib
 
 PRE_SUBMIT = 'pre-submit'
 
+# Set this environment variable (e.g. REPOHOOKS_NO_CACHE=1 repo upload) to run
+# every hook again instead of reusing results from earlier runs.
+NO_CACHE_ENV = 'REPOHOOKS_NO_CACHE'
+
 COMMON_INCLUDED_PATHS = [
     # C++ and friends
     r".*\.c$", r".*\.cc$", r".*\.cpp$", r".*\.h$", r".*\.m$", r".*\.mm$",
@@ -83,6 +100,10 @@ COMMON_EXCLUDED_PATHS = [
 _CONFIG_FILE = 'PRESUBMIT.cfg'
 
 
+# The most bytes of file names to pass to a single command.
+_MAX_ARGS_LEN = 64 * 1024
+
+
 # File containing wildcards, one per line, matching files that should be
 # excluded from presubmit checks. Lines beginning with '#' are ignored.
 _IGNORE_FILE = '.presubmitignore'
@@ -102,6 +123,87 @@ class BadInvocation(Exception):
 Project = collections.namedtuple('Project', ['name', 'dir', 'remote'])
 
 
+CommitInfo = collections.namedtuple('CommitInfo',
+                                    ['sha', 'parents', 'author', 'desc'])
+
+
+class CommitContext(str):
+  """A commit id that remembers what has been asked of git about it.
+
+  _run_project_hooks hands one of these to every hook in place of the bare
+  commit id.  The git helpers below (_get_affected_files, _get_commit_desc,
+  _get_file_diff and _get_file_content) store their results on it, so no
+  matter how many hooks ask, each git query is run at most once per commit.
+
+  Since it is still a str, hooks (and hook scripts) can keep treating it as
+  the commit id.  The helpers also keep working on plain strings; they just
+  don't cache anything then.
+  """
+
+  def __new__(cls, commit, root, objects=None, info=None, verdicts=None,
+              line_rules=None):
+    """Creates a new context.
+
+    Args:
+      commit: The commit id (or PRE_SUBMIT).
+      root: The top directory of the project the commit belongs to.
+      objects: If non-None, a GitObjectReader for the project that file
+          contents will be read through.
+      info: If non-None, the CommitInfo already fetched for the commit.
+      verdicts: If non-None, a HookResultCache remembering what checks made
+          of file contents (see _get_blob_verdict).
+      line_rules: If non-None, the LineRules of the line hooks run on the
+          commit, which _scan_added_lines checks the added lines against.
+    """
+    self = str.__new__(cls, commit)
+    self.root = root
+    self.objects = objects
+    self.info = info
+    self.verdicts = verdicts
+    self.line_rules = line_rules
+    self._cache = {}
+    self._lock = threading.Lock()
+    self._key_locks = {}
+    return self
+
+  def get(self, key, func):
+    """Returns the value cached under |key|, calling func() to fill it in.
+
+    Hooks may run in parallel, so this is safe to call from several threads;
+    func() will still only be called once for each key.
+    """
+    with self._lock:
+      if key in self._cache:
+        return self._cache[key]
+      key_lock = self._key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+      if key not in self._cache:
+        self._cache[key] = func()
+    return self._cache[key]
+
+
+def _get_project_root(commit):
+  """Returns the top directory of the project |commit| belongs to.
+
+  Plain commit ids don't say which project they belong to, so the current
+  directory is assumed for them.
+  """
+  return getattr(commit, 'root', None) or os.getcwd()
+
+
+def _cached(commit, key, func):
+  """Returns func(), remembering the result on |commit| when possible.
+
+  Args:
+    commit: A commit id; results are only cached for a CommitContext.
+    key: A hashable key identifying the query func() performs.
+    func: A callable taking no arguments that performs the query.
+  """
+  if isinstance(commit, CommitContext):
+    return commit.get(key, func)
+  return func()
+
+
 # pylint: disable=redefined-builtin
 def _run_command(cmd, cwd=None, input=None,
                  redirect_stderr=False, combine_stdout_stderr=False):
@@ -157,6 +259,111 @@ def _match_regex_list(subject, expressions):
   return False
 
 
+# Matches regexes that only check for a literal suffix, like r'.*\.cc$'.
+_LITERAL_SUFFIX_RE = re.compile(r'^(?:\.\*)?((?:\\\.|[-\w/])+)\$$')
+
+# Matches regexes that can't be safely combined with others into one regex:
+# those using backreferences, setting global flags or naming groups (which
+# another regex may name the same).
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[iLmsux]')
+
+
+class RegexList(object):
+  """A list of regexes compiled to quickly check for a match with any of them.
+
+  This behaves like _match_regex_list(), but rather than running each regex in
+  turn, the ones that only check for a literal suffix (like most of
+  COMMON_INCLUDED_PATHS) are turned into a single str.endswith() check, and all
+  the others are combined into one alternation that is compiled once.  As with
+  _match_regex_list(), the regexes are searched for, not matched, so all of
+  them are expected to be usable with re.search().
+  """
+
+  def __init__(self, expressions):
+    """Compiles the regexes.
+
+    Args:
+      expressions: A list of regular expressions.
+    """
+    suffixes = []
+    combinable = []
+    self._regexes = []
+    for expr in expressions:
+      m = _LITERAL_SUFFIX_RE.match(expr)
+      if m:
+        suffixes.append(m.group(1).replace('\\.', '.'))
+      elif _UNCOMBINABLE_RE.search(expr):
+        self._regexes.append(re.compile(expr))
+      else:
+        # A leading .* makes no difference to a search, except to slow it
+        # down a lot.
+        if expr.startswith('.*') and expr[2:3] not in ('*', '+', '?'):
+          expr = expr[2:]
+        combinable.append(expr)
+    self._suffixes = tuple(suffixes)
+    if combinable:
+      self._regexes.append(
+          re.compile('|'.join('(?:%s)' % x for x in combinable)))
+
+  def search(self, subject):
+    """Returns whether |subject| matches any of the regexes."""
+    if self._suffixes and subject.endswith(self._suffixes):
+      return True
+    for regex in self._regexes:
+      if regex.search(subject):
+        return True
+    return False
+
+
+class PathMatcher(object):
+  """Decides which paths pass an include list and an exclude list of regexes.
+
+  Decisions are remembered, as the same paths get checked against the same
+  lists by many hooks.  Use _get_path_matcher() to share a matcher with all
+  the other users of the same lists.
+  """
+
+  def __init__(self, include_list, exclude_list=()):
+    """Compiles the lists.
+
+    Args:
+      include_list: list of regex that when matched with a file path will
+          cause it to pass unless the file is also matched with a regex in the
+          exclude_list.
+      exclude_list: list of regex that when matched with a file will prevent it
+          from passing, even if it is also matched with a regex in the
+          include_list.
+    """
+    self._include = RegexList(include_list)
+    self._exclude = RegexList(exclude_list)
+    self._results = {}
+
+  def match(self, path):
+    """Returns whether |path| passes the include and exclude lists."""
+    result = self._results.get(path)
+    if result is None:
+      result = self._results[path] = (self._include.search(path) and
+                                      not self._exclude.search(path))
+    return result
+
+  def filter(self, paths):
+    """Returns the list of |paths| that pass the include and exclude lists."""
+    return [x for x in paths if self.match(x)]
+
+
+# The PathMatcher for each (include list, exclude list) used so far.
+_PATH_MATCHERS = {}
+
+
+def _get_path_matcher(include_list, exclude_list=()):
+  """Returns the PathMatcher for the given lists, creating it if needed."""
+  key = (tuple(include_list), tuple(exclude_list))
+  matcher = _PATH_MATCHERS.get(key)
+  if matcher is None:
+    matcher = _PATH_MATCHERS[key] = PathMatcher(include_list, exclude_list)
+  return matcher
+
+
 def _filter_files(files, include_list, exclude_list=()):
   """Filter out files based on the conditions passed in.
 
@@ -173,43 +380,142 @@ def _filter_files(files, include_list, exclude_list=()):
     A list of filepaths that contain files matched in the include_list and not
     in the exclude_list.
   """
-  filtered = []
-  for f in files:
-    if (_match_regex_list(f, include_list) and
-        not _match_regex_list(f, exclude_list)):
-      filtered.append(f)
-  return filtered
+  return _get_path_matcher(include_list, exclude_list).filter(files)
 
 
 # Git Helpers
 
 
-def _get_upstream_branch():
+def _get_upstream_branch(root):
   """Returns the upstream tracking branch of the current branch.
 
+  Args:
+    root: The top directory of the project.
+
   Raises:
     Error if there is no tracking branch
   """
-  current_branch = _run_command(['git', 'symbolic-ref', 'HEAD']).strip()
+  current_branch = _run_command(['git', 'symbolic-ref', 'HEAD'],
+                                cwd=root).strip()
   current_branch = current_branch.replace('refs/heads/', '')
   if not current_branch:
     raise VerifyException('Need to be on a tracking branch')
 
   cfg_option = 'branch.' + current_branch + '.%s'
-  full_upstream = _run_command(['git', 'config', cfg_option % 'merge']).strip()
-  remote = _run_command(['git', 'config', cfg_option % 'remote']).strip()
+  full_upstream = _run_command(['git', 'config', cfg_option % 'merge'],
+                               cwd=root).strip()
+  remote = _run_command(['git', 'config', cfg_option % 'remote'],
+                        cwd=root).strip()
   if not remote or not full_upstream:
     raise VerifyException('Need to be on a tracking branch')
 
   return full_upstream.replace('heads', 'remotes/' + remote)
 
 
+# The types of the objects in a git repository.
+_GIT_OBJECT_TYPES = frozenset(['blob', 'commit', 'tag', 'tree'])
+
+
+class GitObjectReader(object):
+  """Reads git objects through long-lived `git cat-file` processes.
+
+  Running `git show` for every file a hook looks at means a fork+exec per file
+  per hook.  Instead, we start one `git cat-file --batch` (for contents) and
+  one `git cat-file --batch-check` (for types and sizes) per project and send
+  them requests for as long as the run lasts.
+
+  Objects can be named in any way git understands, e.g. "<commit>:<path>" or a
+  SHA.  The processes are started on first use, and must be stopped with
+  close() once done.
+  """
+
+  def __init__(self, root):
+    """Initializes the reader.
+
+    Args:
+      root: The top directory of the project whose objects will be read.
+    """
+    self.root = root
+    self._procs = {}
+    self._lock = threading.Lock()
+
+  def _request(self, mode, obj):
+    """Sends |obj| to the `git cat-file |mode|` process.
+
+    Returns:
+      A (sha, type, size) tuple read back from git, or None if |obj| doesn't
+      exist.  For --batch, the caller must read the content that follows.
+    """
+    proc = self._procs.get(mode)
+    if proc is None:
+      proc = self._procs[mode] = subprocess.Popen(
+          ['git', 'cat-file', mode], cwd=self.root,
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(obj + '\n')
+    proc.stdin.flush()
+    header = proc.stdout.readline().rstrip('\n').split(' ')
+    # Anything else is something like "<obj> missing" or "<obj> ambiguous",
+    # where <obj> may itself contain spaces.
+    if (len(header) != 3 or header[1] not in _GIT_OBJECT_TYPES or
+        not header[2].isdigit()):
+      return None
+    return header[0], header[1], int(header[2])
+
+  def info(self, obj):
+    """Returns a (sha, type, size) tuple for |obj|, or None if it is missing."""
+    if '\n' in obj:
+      return None
+    with self._lock:
+      return self._request('--batch-check', obj)
+
+  def read(self, obj):
+    """Returns a (type, content) tuple for |obj|, or None if it is missing."""
+    if '\n' in obj:
+      return None
+    with self._lock:
+      header = self._request('--batch', obj)
+      if header is None:
+        return None
+      _sha, obj_type, size = header
+      stdout = self._procs['--batch'].stdout
+      content = stdout.read(size)
+      # Every object is followed by a newline.
+      stdout.read(1)
+      return obj_type, content
+
+  def close(self):
+    """Stops all the git processes."""
+    with self._lock:
+      for proc in self._procs.values():
+        proc.stdin.close()
+        proc.wait()
+      self._procs = {}
+
+
+def _get_patch_cmd(commit):
+  """Returns the git command which writes the patch for this commit."""
+  if commit == PRE_SUBMIT:
+    return ['git', 'diff', '--cached', 'HEAD']
+  return ['git', 'format-patch', '--stdout', '-1', commit]
+
+
 def _get_patch(commit):
   """Returns the patch for this commit."""
-  if commit == PRE_SUBMIT:
-    return _run_command(['git', 'diff', '--cached', 'HEAD'])
-  else:
-    return _run_command(['git', 'format-patch', '--stdout', '-1', commit])
+  return _run_command(_get_patch_cmd(commit), cwd=_get_project_root(commit))
+
+
+def _open_patch(commit):
+  """Starts git writing the patch for this commit to a pipe.
+
+  This is meant for passing big patches on to other tools without having to
+  hold them in memory.
+
+  Returns:
+    The git process; the patch is to be read from its stdout.
+  """
+  return subprocess.Popen(_get_patch_cmd(commit),
+                          cwd=_get_project_root(commit),
+                          stdout=subprocess.PIPE)
 
 
 def _try_utf8_decode(data):
@@ -234,37 +540,394 @@ def _get_file_content(path, commit):
   a full file, you should check that first.  One way to detect is that the
   content will not have any newlines.
   """
+  return _cached(commit, ('file_content', path),
+                 lambda: _read_file_content(path, commit))
+
+
+def _read_file_content(path, commit):
+  """Reads the content of |path| at |commit| from git without any caching."""
+  root = _get_project_root(commit)
+  if commit == PRE_SUBMIT:
+    return _run_command(['git', 'diff', 'HEAD', path], cwd=root)
+
+  obj = '%s:%s' % (commit, path)
+  objects = getattr(commit, 'objects', None)
+  if objects is not None:
+    result = objects.read(obj)
+    if result is None:
+      # Same as what `git show` would have given us.
+      return ''
+    obj_type, content = result
+    if obj_type == 'blob':
+      return content
+  return _run_command(['git', 'show', obj], cwd=root)
+
+
+def _get_tree_file(path, commit):
+  """Returns the content of a file in the tree of |commit|.
+
+  Unlike _get_file_content, this tells missing files apart from empty ones,
+  and only gives the content of regular files.  Everything is read from the
+  git objects, so no working tree is needed; only PRE_SUBMIT (where the commit
+  isn't made yet) reads the file from disk.
+
+  Args:
+    path: The path of the file, relative to the project root (or absolute, as
+        returned by _get_affected_files).
+    commit: The commit to read the file from.
+
+  Returns:
+    The content of the file, or None if |commit| has no such file.
+  """
+  root = _get_project_root(commit)
+  if os.path.isabs(path):
+    path = os.path.relpath(path, root)
+  if commit == PRE_SUBMIT:
+    path = os.path.join(root, path)
+    if not os.path.isfile(path):
+      return None
+    return osutils.ReadFile(path)
+
+  def _read():
+    obj = '%s:%s' % (commit, path)
+    objects = getattr(commit, 'objects', None)
+    if objects is not None:
+      info = objects.info(obj)
+      if info is None or info[1] != 'blob':
+        return None
+      return _get_file_content(path, commit)
+    if _run_command(['git', 'cat-file', '-t', obj], cwd=root,
+                    redirect_stderr=True).strip() != 'blob':
+      return None
+    return _run_command(['git', 'cat-file', 'blob', obj], cwd=root)
+
+  return _cached(commit, ('tree_file', path), _read)
+
+
+# Matches the header of each hunk in a diff, capturing the line it starts at in
+# the new file.  The line count is omitted by git when it is 1.
+_HUNK_HEADER_RE = re.compile(
+    r'^@@ -[0-9]+(?:,[0-9]+)? \+([0-9]+)(?:,[0-9]+)? @@')
+
+
+def _get_blob_verdict(commit, check, path, func, options=()):
+  """Returns what a check makes of the content of a file at |commit|.
+
+  Checks that judge a file by its content alone get the same answer whenever
+  they see the same blob, so the answer is remembered by blob SHA and reused
+  for later commits (and later runs) with the same content.
+
+  Args:
+    commit: The commit to read the file from.
+    check: A name for the check, unique among all the callers.
+    path: The path of the file, relative to the project root.
+    func: A function taking the file content and returning the verdict.  The
+        verdict must survive a trip through JSON.
+    options: Anything else (JSON serializable) the verdict depends on.
+
+  Returns:
+    The value func() returned for the content of the file.
+  """
+  cache = getattr(commit, 'verdicts', None)
+  key = None
+  if cache is not None and commit != PRE_SUBMIT and commit.objects is not None:
+    info = commit.objects.info('%s:%s' % (commit, path))
+    if info is not None:
+      key = cache.verdict_key(check, info[0], options)
+      found, verdict = cache.get_verdict(key)
+      if found:
+        return verdict
+
+  verdict = func(_get_file_content(path, commit))
+  if key is not None:
+    cache.put_verdict(key, verdict)
+  return verdict
+
+
+# The ebuild variables read by Ebuild.  Only the first EAPI counts, as it is
+# meant to come first in the file.
+_EBUILD_EAPI_RE = re.compile(r'^\s*EAPI=[\'"]?([^\'"]+)')
+_EBUILD_KEYWORDS_RE = re.compile(r'^\s*KEYWORDS="(.*)"')
+_EBUILD_LICENSE_RE = re.compile(
+    r'^LICENSE=(?:"([^"$`\\]*)"|\'([^\']*)\'|([^\s\'"$`\\;&|()<>#]*))'
+    r'\s*(?:#.*)?$')
+_EBUILD_INHERIT_RE = re.compile(r'^\s*inherit\b')
+
+
+def _parse_ebuild(contents):
+  """Returns the variables of an ebuild the ebuild hooks look at.
+
+  Returns:
+    A dictionary with:
+      symlink: Whether this is most likely just a symlink to another ebuild.
+      eapi: The EAPI (defaulting to '0'), or None for a symlink.
+      keywords: A list with the keywords of each KEYWORDS line.
+      license: The value of LICENSE, or None if it can't be known without
+          sourcing the ebuild (e.g. it is set by an eclass, or computed).
+  """
+  lines = contents.splitlines()
+  symlink = len(lines) == 1
+
+  eapi = None
+  if not symlink:
+    eapi = '0'
+    for line in lines:
+      m = _EBUILD_EAPI_RE.match(line)
+      if m:
+        eapi = m.group(1)
+        break
+
+  keywords = []
+  for line in lines:
+    m = _EBUILD_KEYWORDS_RE.match(line)
+    if m:
+      keywords.append(m.group(1).split())
+
+  # Only trust a single plain assignment, made after all the eclasses it might
+  # override were inherited.
+  license_value = None
+  for line in lines:
+    if 'LICENSE' in line:
+      m = _EBUILD_LICENSE_RE.match(line)
+      if m is None or license_value is not None:
+        license_value = None
+        break
+      license_value = next(x for x in m.groups() if x is not None)
+    elif license_value is not None and _EBUILD_INHERIT_RE.match(line):
+      license_value = None
+      break
+
+  return {'symlink': symlink, 'eapi': eapi, 'keywords': keywords,
+          'license': license_value}
+
+
+class Ebuild(object):
+  """An ebuild touched by a commit, as the ebuild hooks see it.
+
+  The package atom comes from the path of the ebuild.  The variables come from
+  its content at the commit, which is only parsed on first use, and then only
+  once per blob (see _get_blob_verdict), however many hooks look at it.
+
+  Attributes:
+    path: The path of the ebuild, relative to the project root.
+    overlay: The directory holding the category directory ('' for the root).
+    category: The category of the package, or None.
+    package: The name of the package, or None.
+    version: The version (and revision) of the package, or None if the file
+        isn't named after its directory.
+  """
+
+  def __init__(self, path, commit):
+    """Initializes the ebuild.
+
+    Args:
+      path: The path of the ebuild, relative to the project root.
+      commit: The commit to read the ebuild from.
+    """
+    self.path = path
+    self._commit = commit
+    self._parsed = None
+    parts = path.split('/')
+    self.overlay = '/'.join(parts[:-3])
+    self.category = parts[-3] if len(parts) >= 3 else None
+    self.package = parts[-2] if len(parts) >= 2 else None
+    self.version = None
+    if self.package and parts[-1].startswith(self.package + '-'):
+      self.version = parts[-1][len(self.package) + 1:-len('.ebuild')]
+
+  def __repr__(self):
+    return 'Ebuild(%r)' % self.path
+
+  @property
+  def atom(self):
+    """The category/package-version atom, or None if it isn't known."""
+    if self.category is None or self.version is None:
+      return None
+    return '%s/%s-%s' % (self.category, self.package, self.version)
+
+  @property
+  def _variables(self):
+    """The variables of the ebuild, as returned by _parse_ebuild()."""
+    if self._parsed is None:
+      self._parsed = _cached(
+          self._commit, ('ebuild', self.path),
+          lambda: _get_blob_verdict(self._commit, 'ebuild', self.path,
+                                    _parse_ebuild))
+    return self._parsed
+
+  @property
+  def is_symlink(self):
+    """Whether the ebuild is most likely a symlink to another ebuild."""
+    return self._variables['symlink']
+
+  @property
+  def eapi(self):
+    """The EAPI of the ebuild, or None for a symlink."""
+    return self._variables['eapi']
+
+  @property
+  def keywords(self):
+    """A list with the keywords of each KEYWORDS line."""
+    return self._variables['keywords']
+
+  def get_license_types(self):
+    """Returns the license types listed in LICENSE.
+
+    Raises:
+      ValueError: LICENSE is missing or malformed.
+    """
+    value = self._variables['license']
+    if value is None:
+      # Let bash work out what LICENSE ends up as.
+      if self._commit == PRE_SUBMIT:
+        return licenses_lib.GetLicenseTypesFromEbuild(
+            os.path.join(_get_project_root(self._commit), self.path))
+      # Source the ebuild as of the commit rather than the working tree.
+      with osutils.TempDir(prefix='repohooks.') as tempdir:
+        path = os.path.join(tempdir, os.path.basename(self.path))
+        osutils.WriteFile(path, _get_file_content(self.path, self._commit))
+        return licenses_lib.GetLicenseTypesFromEbuild(path)
+    # Same checks as licenses_lib does.
+    if not value.strip():
+      raise ValueError('No LICENSE found in the ebuild.')
+    if re.search(r'[,;]', value):
+      raise ValueError(
+          'LICENSE field in the ebuild should be whitespace-limited.')
+    return value.split()
+
+
+def _list_tree_files(commit):
+  """Returns the paths of all the files in the tree of |commit|.
+
+  The paths are relative to the project root.  For PRE_SUBMIT, this is the
+  tree about to be committed (i.e. the index).
+  """
   if commit == PRE_SUBMIT:
-    return _run_command(['git', 'diff', 'HEAD', path])
+    cmd = ['git', 'ls-files', '-z']
   else:
-    return _run_command(['git', 'show', '%s:%s' % (commit, path)])
+    cmd = ['git', 'ls-tree', '-r', '-z', '--name-only', commit]
+  return _cached(commit, ('tree_files',), lambda: [
+      x for x in _run_command(cmd, cwd=_get_project_root(commit)).split('\0')
+      if x])
+
+
+def _get_ebuild_dirs(commit):
+  """Returns where the ebuilds are in the tree of |commit|.
+
+  Returns:
+    A dictionary mapping each directory holding ebuilds (relative to the
+    project root, '' being the root itself) to the names of its ebuilds.
+  """
+  def _index():
+    index = {}
+    for path in _list_tree_files(commit):
+      if path.endswith('.ebuild'):
+        directory, name = os.path.split(path)
+        index.setdefault(directory, []).append(name)
+    return index
+
+  return _cached(commit, ('ebuild_dirs',), _index)
+
+
+def _get_ebuilds(commit):
+  """Returns an Ebuild for each ebuild |commit| touched."""
+  return _cached(commit, ('ebuilds',), lambda: [
+      Ebuild(path, commit)
+      for path in _filter_files(_get_affected_files(commit, relative=True),
+                                [r'\.ebuild$'])])
 
 
 def _get_file_diff(path, commit):
   """Returns a list of (linenum, lines) tuples that the commit touched."""
-  command = ['git', 'diff', '-p', '--pretty=format:', '--no-ext-diff']
+  if os.path.isabs(path):
+    path = os.path.relpath(path, _get_project_root(commit))
+  return list(_get_commit_diff(commit).get(path, []))
+
+
+def _get_commit_diff(commit):
+  """Returns the lines |commit| added to each file it touched.
+
+  The whole commit is diffed with a single git call, so hooks looking at the
+  lines of many files don't end up running git for each of them.
+
+  Returns:
+    A dictionary mapping each file path (relative to the project root) to a
+    list of (linenum, line) tuples for the lines added to it.
+  """
+  return _cached(commit, ('commit_diff',), lambda: _parse_commit_diff(commit))
+
+
+def _parse_diff_path(path):
+  """Returns the file a "+++ " line of a diff names, or None if there is none.
+
+  Args:
+    path: The rest of the "+++ " line, e.g. 'b/foo/bar.c'.
+  """
+  # git terminates the names of files with spaces in them with a tab.
+  if path.endswith('\t'):
+    path = path[:-1]
+  if path.startswith('"'):
+    # git quotes paths with unusual characters C-style.
+    path = path[1:-1].decode('string_escape')
+  if path == '/dev/null':
+    return None
+  # Strip the 'b/' prefix.
+  return path[2:]
+
+
+def _parse_commit_diff(commit):
+  """Runs git to diff |commit| and parses the output in one pass.
+
+  See _get_commit_diff() for details.
+  """
+  command = ['git', 'diff', '-U0', '-M', '--no-color', '--no-ext-diff',
+             '--src-prefix=a/', '--dst-prefix=b/']
   if commit == PRE_SUBMIT:
-    command += ['HEAD', path]
+    command += ['HEAD']
   else:
-    command += [commit, path]
-  output = _run_command(command)
+    command += ['%s^!' % commit]
+  output = _run_command(command, cwd=_get_project_root(commit))
 
-  new_lines = []
+  diffs = {}
+  new_lines = None
+  in_header = False
   line_num = 0
   for line in output.splitlines():
-    m = re.match(r'^@@ [0-9\,\+\-]+ \+([0-9]+)\,[0-9]+ @@', line)
-    if m:
-      line_num = int(m.groups(1)[0])
-      continue
-    if line.startswith('+') and not line.startswith('++'):
-      new_lines.append((line_num, _try_utf8_decode(line[1:])))
-    if not line.startswith('-'):
+    if line.startswith('diff --git '):
+      # The header lines up to the first hunk describe the file.
+      new_lines = None
+      in_header = True
+    elif line.startswith('@@'):
+      in_header = False
+      m = _HUNK_HEADER_RE.match(line)
+      line_num = int(m.group(1)) if m else 0
+    elif in_header:
+      if line.startswith('+++ '):
+        path = _parse_diff_path(line[4:])
+        if path is not None:
+          new_lines = diffs.setdefault(path, [])
+    elif line.startswith('+'):
+      if new_lines is not None:
+        new_lines.append((line_num, _try_utf8_decode(line[1:])))
       line_num += 1
-  return new_lines
+  return diffs
+
+
+def _parse_ignore_file(content):
+  """Returns the wildcards listed in the contents of an _IGNORE_FILE."""
+  wildcards = []
+  for line in content.splitlines():
+    line = line.strip()
+    if line.startswith('#'):
+      continue
+    if line.endswith('/'):
+      line += '*'
+    wildcards.append(line)
+  return wildcards
 
 
 def _get_ignore_wildcards(directory, cache):
-  """Get wildcards listed in a directory's _IGNORE_FILE.
+  """Get wildcards listed in a directory's on-disk _IGNORE_FILE.
 
   Args:
     directory: A string containing a directory path.
@@ -280,49 +943,141 @@ def _get_ignore_wildcards(directory, cache):
     wildcards = []
     dotfile_path = os.path.join(directory, _IGNORE_FILE)
     if os.path.exists(dotfile_path):
-      # TODO(derat): Consider using _get_file_content() to get the file as of
-      # this commit instead of the on-disk version. This may have a noticeable
-      # performance impact, as each call to _get_file_content() runs git.
-      with open(dotfile_path, 'r') as dotfile:
-        for line in dotfile.readlines():
-          line = line.strip()
-          if line.startswith('#'):
-            continue
-          if line.endswith('/'):
-            line += '*'
-          wildcards.append(line)
+      wildcards = _parse_ignore_file(osutils.ReadFile(dotfile_path))
     cache[directory] = wildcards
 
   return cache[directory]
 
 
-def _path_is_ignored(path, cache):
-  """Check whether a path is ignored by _IGNORE_FILE.
+# Wildcards parsed from _IGNORE_FILE blobs, keyed by blob SHA.  Ignore files
+# rarely change, so a series of commits usually shares the same few blobs.
+_IGNORE_BLOB_WILDCARDS = {}
+
+
+def _get_commit_ignore_wildcards(commit, directory):
+  """Get wildcards listed in a directory's _IGNORE_FILE as of |commit|.
 
   Args:
-    path: A string containing a path.
-    cache: A dictionary (opaque to caller) caching previously-read wildcards.
+    commit: A CommitContext whose objects reader is used to read the file.
+    directory: A directory path relative to the project root ('' for the root
+        itself).
+
+  Returns:
+    A list of wildcards from _IGNORE_FILE or an empty list if _IGNORE_FILE
+    wasn't present in |commit|.
+  """
+  path = os.path.join(directory, _IGNORE_FILE)
+  info = commit.objects.info('%s:%s' % (commit, path))
+  if info is None or info[1] != 'blob':
+    return []
+  sha = info[0]
+  wildcards = _IGNORE_BLOB_WILDCARDS.get(sha)
+  if wildcards is None:
+    _obj_type, content = commit.objects.read(sha)
+    wildcards = _IGNORE_BLOB_WILDCARDS[sha] = _parse_ignore_file(content)
+  return wildcards
+
+
+def _compile_wildcards(wildcards):
+  """Compile fnmatch-style wildcards into a single regex.
+
+  Args:
+    wildcards: A list of wildcards as accepted by fnmatch.fnmatch().
 
   Returns:
-    True if a file named _IGNORE_FILE in one of the passed-in path's parent
-    directories contains a wildcard matching the path.
+    A compiled regex matching the same strings as any of the wildcards, or
+    None if |wildcards| is empty.
+  """
+  if not wildcards:
+    return None
+  exprs = []
+  for wildcard in wildcards:
+    # Python 2 appends global flags to the translation; they can't be used
+    # inside an alternation, so apply them when compiling instead.
+    expr = fnmatch.translate(wildcard)
+    if expr.endswith('(?ms)'):
+      expr = expr[:-len('(?ms)')]
+    exprs.append('(?:%s)' % expr)
+  return re.compile('|'.join(exprs), re.M | re.S)
+
+
+class IgnoreIndex(object):
+  """Answers whether paths are ignored by _IGNORE_FILE files.
+
+  The index is a trie of directories, each node holding the compiled
+  wildcards of that directory's _IGNORE_FILE.  Nodes are filled in as paths
+  are looked up, so every _IGNORE_FILE is read and compiled at most once.
   """
-  # Skip ignore files.
-  if os.path.basename(path) == _IGNORE_FILE:
-    return True
 
-  path = os.path.abspath(path)
-  base = os.getcwd()
+  def __init__(self, root, loader=None):
+    """Initialize.
+
+    Args:
+      root: The top directory of the project.
+      loader: A function taking a directory path relative to |root| ('' for
+          |root| itself) and returning the wildcards in its _IGNORE_FILE.
+          Defaults to reading the files from disk.
+    """
+    if loader is None:
+      base = os.path.normpath(root)
+      cache = {}
+      loader = lambda d: _get_ignore_wildcards(os.path.join(base, d), cache)
+    self._loader = loader
+    self._root = self._make_node('')
+
+  def _make_node(self, directory):
+    """Returns a new trie node for |directory|: [regex, children]."""
+    return [_compile_wildcards(self._loader(directory)), {}]
+
+  def is_ignored(self, path):
+    """Check whether a path is ignored.
+
+    Args:
+      path: A string containing a path relative to the project root.
+
+    Returns:
+      True if a file named _IGNORE_FILE in one of the path's parent
+      directories contains a wildcard matching the path (relative to that
+      directory), or if the path is itself an _IGNORE_FILE.
+    """
+    parts = os.path.normpath(path).split('/')
+    # Skip ignore files.
+    if parts[-1] == _IGNORE_FILE:
+      return True
 
-  prefix = os.path.dirname(path)
-  while prefix.startswith(base):
-    rel_path = path[len(prefix) + 1:]
-    for wildcard in _get_ignore_wildcards(prefix, cache):
-      if fnmatch.fnmatch(rel_path, wildcard):
+    node = self._root
+    for i in xrange(len(parts)):
+      regex, children = node
+      if regex is not None and regex.match('/'.join(parts[i:])):
         return True
-    prefix = os.path.dirname(prefix)
+      if i == len(parts) - 1:
+        break
+      child = children.get(parts[i])
+      if child is None:
+        child = children[parts[i]] = self._make_node('/'.join(parts[:i + 1]))
+      node = child
+    return False
 
-  return False
+  def filter(self, paths):
+    """Returns the members of |paths| which are not ignored."""
+    return [x for x in paths if not self.is_ignored(x)]
+
+
+def _get_ignore_index(commit):
+  """Returns the IgnoreIndex for |commit|.
+
+  The _IGNORE_FILE files are read from the commit itself when we have a git
+  objects reader for it.  Otherwise (plain string commits, or PRE_SUBMIT),
+  the files in the working tree are used.
+  """
+  def _make_index():
+    loader = None
+    if (commit != PRE_SUBMIT and
+        getattr(commit, 'objects', None) is not None):
+      loader = functools.partial(_get_commit_ignore_wildcards, commit)
+    return IgnoreIndex(_get_project_root(commit), loader=loader)
+
+  return _cached(commit, ('ignore_index',), _make_index)
 
 
 def _get_affected_files(commit, include_deletes=False, relative=False,
@@ -345,12 +1100,31 @@ def _get_affected_files(commit, include_deletes=False, relative=False,
   if not relative and full_details:
     raise ValueError('full_details only supports relative paths currently')
 
+  key = ('affected_files', include_deletes, relative, include_symlinks,
+         include_adds, full_details, use_ignore_files)
+  return list(_cached(commit, key, lambda: _list_affected_files(
+      commit, include_deletes=include_deletes, relative=relative,
+      include_symlinks=include_symlinks, include_adds=include_adds,
+      full_details=full_details, use_ignore_files=use_ignore_files)))
+
+
+def _get_raw_diff(commit):
+  """Returns the git.RawDiff entries for the files |commit| touched."""
+  return _cached(commit, ('raw_diff',),
+                 lambda: git.RawDiff(_get_project_root(commit),
+                                     '%s^!' % commit))
+
+
+def _list_affected_files(commit, include_deletes, relative, include_symlinks,
+                         include_adds, full_details, use_ignore_files):
+  """Computes the result of _get_affected_files() without any caching."""
+  path = _get_project_root(commit)
   if commit == PRE_SUBMIT:
-    return _run_command(['git', 'diff-index', '--cached',
-                         '--name-only', 'HEAD']).split()
+    return _cached(commit, ('diff_index',), lambda: _run_command(
+        ['git', 'diff-index', '--cached', '--name-only', 'HEAD'],
+        cwd=path).split())
 
-  path = os.getcwd()
-  files = git.RawDiff(path, '%s^!' % commit)
+  files = _get_raw_diff(commit)
 
   # Filter out symlinks.
   if not include_symlinks:
@@ -363,9 +1137,9 @@ def _get_affected_files(commit, include_deletes=False, relative=False,
     files = [x for x in files if x.status != 'A']
 
   if use_ignore_files:
-    cache = {}
-    is_ignored = lambda x: _path_is_ignored(x.dst_file or x.src_file, cache)
-    files = [x for x in files if not is_ignored(x)]
+    index = _get_ignore_index(commit)
+    files = [x for x in files
+             if not index.is_ignored(x.dst_file or x.src_file)]
 
   if full_details:
     # Caller wants the raw objects to parse status/etc... themselves.
@@ -379,108 +1153,566 @@ def _get_affected_files(commit, include_deletes=False, relative=False,
       return [os.path.join(path, x) for x in files]
 
 
-def _get_commits():
-  """Returns a list of commits for this review."""
-  cmd = ['git', 'log', '%s..' % _get_upstream_branch(), '--format=%H']
-  return _run_command(cmd).split()
+def _get_commit_infos(args, root):
+  """Returns the metadata of all the commits `git log |args|` lists.
+
+  Everything is fetched with a single git call, so the hooks don't have to
+  run git again for each commit to get at it.
+
+  Args:
+    args: A list of arguments to pass to `git log` to select the commits.
+    root: The top directory of the project.
+
+  Returns:
+    A collections.OrderedDict mapping the SHA of each commit (in the order git
+    listed them) to its CommitInfo.
+  """
+  fields = ['%H', '%P', '%an <%ae>', '%s%n%n%b']
+  cmd = ['git', 'log', '-z', '--format=' + '%x00'.join(fields)] + args
+  # Both the fields and the commits are NUL terminated.
+  output = _run_command(cmd, cwd=root).split('\0')[:-1]
+
+  infos = collections.OrderedDict()
+  for i in range(0, len(output) - len(fields) + 1, len(fields)):
+    sha, parents, author, desc = output[i:i + len(fields)]
+    # `git log` would have terminated the description with a newline.
+    infos[sha] = CommitInfo(sha=sha, parents=parents.split(), author=author,
+                            desc=desc + '\n')
+  return infos
+
+
+def _get_commits(root):
+  """Returns the CommitInfo table (see _get_commit_infos) for this review.
+
+  Args:
+    root: The top directory of the project.
+  """
+  return _get_commit_infos(['%s..' % _get_upstream_branch(root)], root)
 
 
 def _get_commit_desc(commit):
   """Returns the full commit message of a commit."""
   if commit == PRE_SUBMIT:
     return ''
-  return _run_command(['git', 'log', '--format=%s%n%n%b', commit + '^!'])
+  info = getattr(commit, 'info', None)
+  if info is not None:
+    return info.desc
+  return _cached(commit, ('commit_desc',), lambda: _run_command(
+      ['git', 'log', '--format=%s%n%n%b', commit + '^!'],
+      cwd=_get_project_root(commit)))
+
+
+# Matches the name of a field line in a commit message, with its separator:
+# e.g. 'BUG=' or 'Signed-off-by:'.
+_DESC_FIELD_RE = re.compile(r'[A-Za-z][A-Za-z0-9_-]*[=:]')
+
+
+class CommitDescription(object):
+  """A commit message, split up once for all the hooks checking it.
+
+  The message is split into lines on LF only, and a field is any line after
+  the first one starting with a name and a separator (e.g. 'BUG=chromium:1',
+  'Signed-off-by: Me').  So looking up a field gives the same answer as
+  searching the whole message for '\\nNAME=...' would.
+
+  Attributes:
+    text: The full commit message.
+    lines: The lines of the message.
+    subject: The first line of the message.
+    paragraphs: The paragraphs after the subject, each a list of lines.
+    fields: A dictionary mapping the name of each field, including its
+        separator (e.g. 'BUG=', 'Change-Id:'), to a list of (line index, value)
+        tuples, the value being what follows the separator.
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.lines = text.split('\n')
+    self.subject = self.lines[0]
+    self.paragraphs = []
+    self.fields = {}
+    paragraph = None
+    for i, line in enumerate(self.lines[1:], 1):
+      if not line.strip():
+        paragraph = None
+        continue
+      if paragraph is None:
+        paragraph = []
+        self.paragraphs.append(paragraph)
+      paragraph.append(line)
+      m = _DESC_FIELD_RE.match(line)
+      if m:
+        self.fields.setdefault(m.group(), []).append((i, line[m.end():]))
+
+  def get(self, name, pattern=None):
+    """Returns the first value of a field, or None if there is none.
+
+    Args:
+      name: The name of the field, including its separator (e.g. 'TEST=').
+      pattern: If given, only values starting with a match of this regex are
+          considered.
+    """
+    for _i, value in self.fields.get(name, ()):
+      if pattern is None or re.match(pattern, value):
+        return value
+    return None
 
 
-# Common Hooks
+def _get_commit_description(commit):
+  """Returns the CommitDescription of a commit."""
+  return _cached(commit, ('commit_description',),
+                 lambda: CommitDescription(_get_commit_desc(commit)))
 
 
-def _check_no_long_lines(_project, commit):
-  """Checks there are no lines longer than MAX_LEN in any of the text files."""
+# Line Rules
 
-  MAX_LEN = 80
-  SKIP_REGEXP = re.compile('|'.join([
-      r'https?://',
-      r'^#\s*(define|include|import|pragma|if|endif)\b']))
 
-  errors = []
+class LineRule(object):
+  """A check applied to each line a commit adds to a file.
+
+  A list of rules is evaluated by _evaluate_line_rules() in a single pass over
+  the added lines, and each line hook then reports the errors of its own rule.
+  """
+
+  def __init__(self, name, check, error, excluded_paths=(), max_errors=None,
+               stop_after_file=False, pattern=None, files=None, message=None):
+    """Initialize.
+
+    Args:
+      name: A unique name for the rule.
+      check: A function taking a line and returning a true value (e.g. the
+          problems found) if it breaks the rule.
+      error: A function taking (path, line_num, line, found), found being what
+          |check| returned, and returning the error message for a line breaking
+          the rule.
+      excluded_paths: Regexes of paths the rule doesn't apply to, on top of
+          COMMON_EXCLUDED_PATHS.
+      max_errors: If set, stop looking for errors once this many were found.
+      stop_after_file: If True, stop looking for errors after the first file
+          with errors.
+      pattern: If set, a regex that every line breaking the rule matches.  The
+          patterns of all the rules are combined, so that lines matching none
+          of them are only checked against the rules without a pattern.
+      files: If set, a compiled regex that paths relative to the project root
+          must match for the rule to apply.
+      message: The message of the HookFailure reporting the rule's errors.
+    """
+    self.name = name
+    self.check = check
+    self.error = error
+    self.excluded_paths = tuple(excluded_paths)
+    self.max_errors = max_errors
+    self.stop_after_file = stop_after_file
+    self.pattern = pattern
+    self.files = files
+    self.message = message
+
+  def __repr__(self):
+    return 'LineRule(%r, pattern=%r)' % (self.name, self.pattern)
+
+  def applies_to(self, path, rel_path):
+    """Returns True if the rule should be checked against a file.
+
+    Args:
+      path: The full path to the file.
+      rel_path: The path to the file relative to the project root.
+    """
+    if self.files is not None and not self.files.match(rel_path):
+      return False
+    return (not self.excluded_paths or
+            not _get_path_matcher(self.excluded_paths).match(path))
+
+
+def _get_required_literal(pattern):
+  """Returns a string that every match of a regex must contain.
+
+  Args:
+    pattern: A regular expression.
+
+  Returns:
+    The longest run of literal ASCII characters at the top level of |pattern|,
+    or None if there is no such run (or the regex ignores case).
+  """
+  parsed = sre_parse.parse(pattern)
+  if parsed.pattern.flags & re.IGNORECASE:
+    return None
+  best = run = ''
+  for op, av in parsed:
+    if op == sre_constants.LITERAL and av < 128:
+      run += chr(av)
+      best = max(best, run, key=len)
+    else:
+      run = ''
+  return best or None
+
+
+def _compile_literal_trie(literals):
+  """Compiles a regex searching for any of |literals|.
+
+  The literals are arranged in a trie, so that the regex engine can rule out
+  most positions after a single character instead of trying every literal.
+  """
+  trie = {}
+  for literal in literals:
+    node = trie
+    for c in literal:
+      if None in node:
+        # A prefix of this literal is already enough for a match.
+        break
+      node = node.setdefault(c, {})
+    else:
+      node.clear()
+      node[None] = True
+
+  def _to_regex(node):
+    if None in node:
+      return ''
+    alternatives = [re.escape(c) + _to_regex(child)
+                    for c, child in sorted(node.iteritems())]
+    if len(alternatives) == 1:
+      return alternatives[0]
+    return '(?:%s)' % '|'.join(alternatives)
+
+  return re.compile(_to_regex(trie))
+
+
+class LinePrefilter(object):
+  """Quickly tells whether a line might match any of a list of regexes.
+
+  Most regexes have a literal part every match must contain; those parts are
+  searched for with a single trie-shaped regex.  The other regexes are
+  searched for as a RegexList.  A line the prefilter rejects matches none of
+  the regexes, while a line it accepts may still match none of them.
+  """
+
+  def __init__(self, patterns):
+    """Compiles the prefilter.
+
+    Args:
+      patterns: A list of regular expressions.
+    """
+    literals = []
+    others = []
+    for pattern in patterns:
+      literal = _get_required_literal(pattern)
+      if literal is None:
+        others.append(pattern)
+      else:
+        literals.append(literal)
+    self._literals = _compile_literal_trie(literals) if literals else None
+    self._others = RegexList(others) if others else None
+
+  def search(self, line):
+    """Returns whether |line| might match any of the regexes."""
+    return bool((self._literals is not None and self._literals.search(line)) or
+                (self._others is not None and self._others.search(line)))
+
+
+MAX_LINE_LEN = 80
+
+# Lines matching this are allowed to exceed MAX_LINE_LEN.
+SKIP_REGEXP = re.compile('|'.join([
+    r'https?://',
+    r'^#\s*(define|include|import|pragma|if|endif)\b']))
+
+# Paths where tabs are fine.
+TAB_OK_PATHS = [
+    r"/src/third_party/u-boot/",
+    r".*\.ebuild$",
+    r".*\.eclass$",
+    r".*/[M|m]akefile$",
+    r".*\.mk$"
+]
+
+_LINE_RULES = [
+    LineRule('long_line',
+             lambda line: (len(line) > MAX_LINE_LEN and
+                           not SKIP_REGEXP.search(line)),
+             lambda path, line_num, line, _found: '%s, line %s, %s chars' % (
+                 path, line_num, len(line)),
+             max_errors=5),
+    LineRule('stray_whitespace',
+             lambda line: line.rstrip() != line,
+             lambda path, line_num, _line, _found: '%s, line %s' % (
+                 path, line_num),
+             stop_after_file=True),
+    LineRule('tab',
+             lambda line: '\t' in line,
+             lambda path, line_num, _line, _found: '%s, line %s' % (
+                 path, line_num),
+             excluded_paths=TAB_OK_PATHS),
+    LineRule('spelling',
+             lambda line: _get_spelling_list().find(line),
+             lambda path, line_num, _line, typos: _format_misspellings(
+                 '%s, line %s' % (path, line_num), typos)),
+]
+
+
+def _scan_added_lines(commit, name):
+  """Returns the errors of a rule of _LINE_RULES on the lines |commit| added.
+
+  The rules of all the line hooks run on the commit (commit.line_rules, see
+  CommitContext) are checked together in a single pass, the first time one of
+  those hooks asks.  Other rules are checked on their own.
+
+  Args:
+    commit: The commit to check.
+    name: The name of the rule to return the errors of.
+  """
+  rules = getattr(commit, 'line_rules', None) or ()
+  if not any(rule.name == name for rule in rules):
+    return _evaluate_line_rules(
+        [rule for rule in _LINE_RULES if rule.name == name], commit)[name]
+  return _cached(commit, ('line_rules',),
+                 lambda: _evaluate_line_rules(rules, commit))[name]
+
+
+def _evaluate_line_rules(rules, commit):
+  """Checks every line |commit| added against |rules|, without any caching.
+
+  Returns:
+    A dictionary mapping each rule name to the list of its errors.
+  """
+  errors = dict((rule.name, []) for rule in rules)
+  done = set()
+  prefilters = {}
+  root = _get_project_root(commit)
   files = _filter_files(_get_affected_files(commit),
                         COMMON_INCLUDED_PATHS,
                         COMMON_EXCLUDED_PATHS)
 
   for afile in files:
+    rel_path = afile
+    if afile.startswith(root + '/'):
+      rel_path = afile[len(root) + 1:]
+    active = [rule for rule in rules
+              if rule.name not in done and rule.applies_to(afile, rel_path)]
+    if not active:
+      continue
+
+    # Rules with a pattern only need checking on lines matching any pattern.
+    unfiltered = [rule for rule in active if rule.pattern is None]
+    filtered = tuple(rule for rule in active if rule.pattern is not None)
+    prefilter = None
+    if filtered:
+      prefilter = prefilters.get(filtered)
+      if prefilter is None:
+        prefilter = prefilters[filtered] = LinePrefilter(
+            [rule.pattern for rule in filtered])
+
     for line_num, line in _get_file_diff(afile, commit):
-      # Allow certain lines to exceed the maxlen rule.
-      if len(line) <= MAX_LEN or SKIP_REGEXP.search(line):
+      candidates = unfiltered
+      if prefilter is not None and prefilter.search(line):
+        candidates = active
+      for rule in candidates:
+        if rule.name in done:
+          continue
+        found = rule.check(line)
+        if not found:
+          continue
+        rule_errors = errors[rule.name]
+        rule_errors.append(rule.error(afile, line_num, line, found))
+        if len(rule_errors) == rule.max_errors:
+          done.add(rule.name)
+      if len(done) == len(rules):
+        break
+
+    for rule in active:
+      if rule.stop_after_file and errors[rule.name]:
+        done.add(rule.name)
+    if len(done) == len(rules):
+      break
+
+  return errors
+
+
+class SpellingList(object):
+  """Finds the common misspellings listed in spelling.txt in text.
+
+  Like checkpatch.pl, a misspelling is only reported where it isn't part of a
+  longer word, i.e. where it isn't next to a letter or an '@'.  Each
+  misspelling is indexed by its first word, so a line is searched for all of
+  them at once by looking up each of its words, in time linear in its length.
+  """
+
+  _WORD_RE = re.compile(r'[a-z@]+')
+
+  def __init__(self, content):
+    """Parses a list of misspellings.
+
+    Args:
+      content: Lines of "mistake||correction" pairs, as in spelling.txt.
+    """
+    self.fixes = {}
+    self._index = {}
+    for line in content.splitlines():
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      mistake, fix = line.split('||', 1)
+      mistake = mistake.lower()
+      m = self._WORD_RE.match(mistake)
+      if m is None:
         continue
+      self.fixes[mistake] = fix
+      self._index.setdefault(m.group(), []).append(mistake)
+    # Prefer the longest of the misspellings starting with the same word.
+    for mistakes in self._index.itervalues():
+      mistakes.sort(key=len, reverse=True)
+
+  def find(self, text):
+    """Returns a list of (misspelling, correction) tuples found in |text|.
+
+    The corrections follow the case of the misspellings.
+    """
+    lower = text.lower()
+    found = []
+    for m in self._WORD_RE.finditer(lower):
+      start = m.start()
+      for mistake in self._index.get(m.group(), ()):
+        end = start + len(mistake)
+        if (lower.startswith(mistake, start) and
+            not self._WORD_RE.match(lower, end)):
+          typo = text[start:end]
+          fix = self.fixes[mistake]
+          if typo.isupper():
+            fix = fix.upper()
+          elif typo[0].isupper():
+            fix = fix[0].upper() + fix[1:]
+          found.append((typo, fix))
+          break
+    return found
+
+
+# The SpellingList of each file, as a (mtime, SpellingList) tuple, so that we
+# only parse a file again if it changed.  The default list is under None.
+_SPELLING_LISTS = {}
 
-      errors.append('%s, line %s, %s chars' % (afile, line_num, len(line)))
-      if len(errors) == 5:  # Just show the first 5 errors.
-        break
 
+def _get_spelling_list(path=None):
+  """Returns the SpellingList for |path| (spelling.txt by default).
+
+  The default list is looked up on every line checked, so it is only read
+  once.  Others are read again whenever they change.
+  """
+  if path is None:
+    cached = _SPELLING_LISTS.get(None)
+    if cached is None:
+      cached = _SPELLING_LISTS[None] = (None, _get_spelling_list(
+          os.path.join(_get_hooks_dir(), 'spelling.txt')))
+    return cached[1]
+  mtime = os.stat(path).st_mtime
+  cached = _SPELLING_LISTS.get(path)
+  if cached is None or cached[0] != mtime:
+    cached = _SPELLING_LISTS[path] = (mtime,
+                                      SpellingList(osutils.ReadFile(path)))
+  return cached[1]
+
+
+def _format_misspellings(where, typos):
+  """Returns an error message listing the misspellings found somewhere."""
+  return '%s: %s' % (where, ', '.join("'%s' -> '%s'" % x for x in typos))
+
+
+# Common Hooks
+
+
+def _check_no_long_lines(_project, commit):
+  """Checks there are no lines longer than MAX_LINE_LEN in any text files."""
+  errors = _scan_added_lines(commit, 'long_line')
   if errors:
-    msg = 'Found lines longer than %s characters (first 5 shown):' % MAX_LEN
+    msg = ('Found lines longer than %s characters (first 5 shown):' %
+           MAX_LINE_LEN)
     return HookFailure(msg, errors)
 
 
 def _check_no_stray_whitespace(_project, commit):
   """Checks that there is no stray whitespace at source lines end."""
-  errors = []
-  files = _filter_files(_get_affected_files(commit),
-                        COMMON_INCLUDED_PATHS,
-                        COMMON_EXCLUDED_PATHS)
-  for afile in files:
-    for line_num, line in _get_file_diff(afile, commit):
-      if line.rstrip() != line:
-        errors.append('%s, line %s' % (afile, line_num))
-    if errors:
-      return HookFailure('Found line ending with white space in:', errors)
+  errors = _scan_added_lines(commit, 'stray_whitespace')
+  if errors:
+    return HookFailure('Found line ending with white space in:', errors)
 
 
 def _check_no_tabs(_project, commit):
   """Checks there are no unexpanded tabs."""
-  TAB_OK_PATHS = [
-      r"/src/third_party/u-boot/",
-      r".*\.ebuild$",
-      r".*\.eclass$",
-      r".*/[M|m]akefile$",
-      r".*\.mk$"
-  ]
+  errors = _scan_added_lines(commit, 'tab')
+  if errors:
+    return HookFailure('Found a tab character in:', errors)
+
 
+def _check_spelling(_project, commit):
+  """Checks the commit message and added lines for common misspellings."""
+  spelling = _get_spelling_list()
   errors = []
-  files = _filter_files(_get_affected_files(commit),
-                        COMMON_INCLUDED_PATHS,
-                        COMMON_EXCLUDED_PATHS + TAB_OK_PATHS)
+  for line_num, line in enumerate(_get_commit_desc(commit).splitlines(), 1):
+    typos = spelling.find(line)
+    if typos:
+      errors.append(_format_misspellings(
+          'commit message, line %s' % line_num, typos))
 
-  for afile in files:
-    for line_num, line in _get_file_diff(afile, commit):
-      if '\t' in line:
-        errors.append('%s, line %s' % (afile, line_num))
+  errors += _scan_added_lines(commit, 'spelling')
   if errors:
-    return HookFailure('Found a tab character in:', errors)
+    return HookFailure('Found possible misspellings:', errors)
+
+
+def _chunk_args(args, max_len=_MAX_ARGS_LEN):
+  """Splits |args| into lists that can each be passed to one command.
+
+  Args:
+    args: A list of command line arguments.
+    max_len: The most bytes of arguments to put in one list.
+
+  Yields:
+    Consecutive sublists of |args|.
+  """
+  chunk = []
+  size = 0
+  for arg in args:
+    if chunk and size + len(arg) + 1 > max_len:
+      yield chunk
+      chunk = []
+      size = 0
+    chunk.append(arg)
+    size += len(arg) + 1
+  if chunk:
+    yield chunk
 
 
 def _check_gofmt(_project, commit):
   """Checks that Go files are formatted with gofmt."""
-  errors = []
   files = _filter_files(_get_affected_files(commit, relative=True),
                         [r'\.go$'])
+  if not files:
+    return None
 
-  for gofile in files:
-    contents = _get_file_content(gofile, commit)
-    output = _run_command(cmd=['gofmt', '-l'], input=contents,
-                          combine_stdout_stderr=True)
-    if output:
-      errors.append(gofile)
+  # Write out the files as of |commit| and check them all with one gofmt (or
+  # a few, if there are too many to list on one command line).
+  bad_files = set()
+  with osutils.TempDir(prefix='gofmt') as tempdir:
+    for gofile in files:
+      osutils.WriteFile(os.path.join(tempdir, gofile),
+                        _get_file_content(gofile, commit), makedirs=True)
+
+    for chunk in _chunk_args(files):
+      output = _run_command(cmd=['gofmt', '-l', '--'] + chunk, cwd=tempdir,
+                            combine_stdout_stderr=True)
+      # gofmt lists badly formatted files alone on a line, and prefixes its
+      # errors (e.g. for files that don't parse) with "<file>:".
+      names = set(chunk)
+      for line in output.splitlines():
+        if line in names:
+          bad_files.add(line)
+        elif line.split(':', 1)[0] in names:
+          bad_files.add(line.split(':', 1)[0])
+
+  errors = [x for x in files if x in bad_files]
   if errors:
     return HookFailure('Files not formatted with gofmt:', errors)
 
 
 def _check_change_has_test_field(_project, commit):
   """Check for a non-empty 'TEST=' field in the commit message."""
-  TEST_RE = r'\nTEST=\S+'
-
-  if not re.search(TEST_RE, _get_commit_desc(commit)):
+  if _get_commit_description(commit).get('TEST=', r'\S') is None:
     msg = 'Changelist description needs TEST field (after first line)'
     return HookFailure(msg)
 
@@ -490,15 +1722,15 @@ def _check_change_has_valid_cq_depend(_project, commit):
   msg = 'Changelist has invalid CQ-DEPEND target.'
   example = 'Example: CQ-DEPEND=CL:1234, CL:2345'
   try:
-    patch.GetPaladinDeps(_get_commit_desc(commit))
+    patch.GetPaladinDeps(_get_commit_description(commit).text)
   except ValueError as ex:
     return HookFailure(msg, [example, str(ex)])
 
 
 def _check_change_has_bug_field(project, commit):
   """Check for a correctly formatted 'BUG=' field in the commit message."""
-  OLD_BUG_RE = r'\nBUG=.*chromium-os'
-  if re.search(OLD_BUG_RE, _get_commit_desc(commit)):
+  desc = _get_commit_description(commit)
+  if desc.get('BUG=', r'.*chromium-os') is not None:
     msg = ('The chromium-os bug tracker is now deprecated. Please use\n'
            'the chromium tracker in your BUG= line now.')
     return HookFailure(msg)
@@ -510,15 +1742,14 @@ def _check_change_has_bug_field(project, commit):
       'goog',
   )
   if project.remote in BUG_COLON_REMOTES:
-    BUG_RE = r'\nBug: ?([Nn]one|\d+)'
-    if not re.search(BUG_RE, _get_commit_desc(commit)):
+    if desc.get('Bug:', r' ?([Nn]one|\d)') is None:
       msg = ('Changelist description needs BUG field (after first line):\n'
              'Bug: 9999 (for buganizer)\n'
              'BUG=None')
       return HookFailure(msg)
   else:
-    BUG_RE = r'\nBUG=([Nn]one|(chrome-os-partner|chromium|brillo|b):\d+)'
-    if not re.search(BUG_RE, _get_commit_desc(commit)):
+    BUG_RE = r'([Nn]one|(chrome-os-partner|chromium|brillo|b):\d)'
+    if desc.get('BUG=', BUG_RE) is None:
       msg = ('Changelist description needs BUG field (after first line):\n'
              'BUG=brillo:9999 (for Brillo tracker)\n'
              'BUG=chromium:9999 (for public tracker)\n'
@@ -553,7 +1784,8 @@ def _check_for_uprev(project, commit, project_top=None):
   Args:
     project: The Project to look at
     commit: The commit to look at
-    project_top: Top dir to process commits in
+    project_top: Top dir to process commits in.  Defaults to the dir of
+        |project|.
 
   Returns:
     A HookFailure or None.
@@ -602,29 +1834,23 @@ def _check_for_uprev(project, commit, project_top=None):
   if not affected_path_objs:
     return
 
-  # We want to examine the current contents of all directories that are parents
-  # of files that were touched (up to the top of the project).
-  #
-  # ...note: we use the current directory contents even though it may have
-  # changed since the commit we're looking at.  This is just a heuristic after
-  # all.  Worst case we don't flag a missing revbump.
+  # We want to examine all directories that are parents of files that were
+  # touched (up to the top of the project), as they are in the commit.
   if project_top is None:
-    project_top = os.getcwd()
-  dirs_to_check = set([project_top])
+    project_top = project.dir
+  ebuild_dirs = _get_ebuild_dirs(commit)
+  dirs_to_check = set([''])
   for obj in affected_path_objs:
-    path = os.path.join(project_top, os.path.dirname(FinalName(obj)))
-    while os.path.exists(path) and not os.path.samefile(path, project_top):
+    path = os.path.dirname(FinalName(obj))
+    while path:
       dirs_to_check.add(path)
       path = os.path.dirname(path)
 
-  # Look through each directory.  If it's got an ebuild in it then we'll
-  # consider this as a case when we need a revbump.
-  affected_paths = set(os.path.join(project_top, FinalName(x))
-                       for x in affected_path_objs)
-  for dir_path in dirs_to_check:
-    contents = os.listdir(dir_path)
-    ebuilds = [os.path.join(dir_path, path)
-               for path in contents if path.endswith('.ebuild')]
+  # Look through each directory, nearest ones first.  If it's got an ebuild in
+  # it then we'll consider this as a case when we need a revbump.
+  affected_paths = set(FinalName(x) for x in affected_path_objs)
+  for dir_path in sorted(dirs_to_check, reverse=True):
+    ebuilds = [os.path.join(dir_path, x) for x in ebuild_dirs.get(dir_path, ())]
     ebuilds_9999 = [path for path in ebuilds if path.endswith('-9999.ebuild')]
 
     # If the -9999.ebuild file was touched the bot will uprev for us.
@@ -635,7 +1861,8 @@ def _check_for_uprev(project, commit, project_top=None):
     if ebuilds:
       return HookFailure('Changelist probably needs a revbump of an ebuild, '
                          'or a -r1.ebuild symlink if this is a new ebuild:\n'
-                         '%s' % dir_path)
+                         '%s' % os.path.normpath(
+                             os.path.join(project_top, dir_path)))
 
   return None
 
@@ -664,34 +1891,8 @@ def _check_ebuild_eapi(project, commit):
 
   BAD_EAPIS = ('0', '1', '2', '3')
 
-  get_eapi = re.compile(r'^\s*EAPI=[\'"]?([^\'"]+)')
-
-  ebuilds_re = [r'\.ebuild$']
-  ebuilds = _filter_files(_get_affected_files(commit, relative=True),
-                          ebuilds_re)
-  bad_ebuilds = []
-
-  for ebuild in ebuilds:
-    # If the ebuild does not specify an EAPI, it defaults to 0.
-    eapi = '0'
-
-    lines = _get_file_content(ebuild, commit).splitlines()
-    if len(lines) == 1:
-      # This is most likely a symlink, so skip it entirely.
-      continue
-
-    for line in lines:
-      m = get_eapi.match(line)
-      if m:
-        # Once we hit the first EAPI line in this ebuild, stop processing.
-        # The spec requires that there only be one and it be first, so
-        # checking all possible values is pointless.  We also assume that
-        # it's "the" EAPI line and not something in the middle of a heredoc.
-        eapi = m.group(1)
-        break
-
-    if eapi in BAD_EAPIS:
-      bad_ebuilds.append((ebuild, eapi))
+  bad_ebuilds = [(ebuild.path, ebuild.eapi) for ebuild in _get_ebuilds(commit)
+                 if ebuild.eapi in BAD_EAPIS]
 
   if bad_ebuilds:
     # pylint: disable=C0301
@@ -724,25 +1925,12 @@ def _check_ebuild_keywords(_project, commit):
   """
   WHITELIST = set(('*', '-*', '~*'))
 
-  get_keywords = re.compile(r'^\s*KEYWORDS="(.*)"')
-
-  ebuilds_re = [r'\.ebuild$']
-  ebuilds = _filter_files(_get_affected_files(commit, relative=True),
-                          ebuilds_re)
-
   bad_ebuilds = []
-  for ebuild in ebuilds:
-    # We get the full content rather than a diff as the latter does not work
-    # on new files (like when adding new ebuilds).
-    lines = _get_file_content(ebuild, commit).splitlines()
-    for line in lines:
-      m = get_keywords.match(line)
-      if m:
-        keywords = set(m.group(1).split())
-        if not keywords or WHITELIST - keywords != WHITELIST:
-          continue
-
-        bad_ebuilds.append(ebuild)
+  for ebuild in _get_ebuilds(commit):
+    # We look at the full content rather than a diff as the latter does not
+    # work on new files (like when adding new ebuilds).
+    bad_ebuilds += [ebuild.path for keywords in ebuild.keywords
+                    if keywords and not WHITELIST & set(keywords)]
 
   if bad_ebuilds:
     return HookFailure(
@@ -758,31 +1946,126 @@ def _check_ebuild_keywords(_project, commit):
         '  KEYWORDS="-* arm ..."\n' % '\n* '.join(bad_ebuilds))
 
 
+def _get_license_dirs():
+  """Returns the (stock, custom) license directories licenses_lib searches."""
+  return (list(getattr(licenses_lib, 'STOCK_LICENSE_DIRS', [])),
+          list(getattr(licenses_lib, 'CUSTOM_LICENSE_DIRS', [])))
+
+
+def _get_dir_mtime(path):
+  """Returns the mtime of directory |path|, or None if it doesn't exist."""
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+class LicenseIndex(object):
+  """Finds license types like licenses_lib.Licensing.FindLicenseType does.
+
+  FindLicenseType looks for the license in each license directory on every
+  call.  Instead, the directories are listed once (or the listing is reused
+  from the hook cache, as long as their mtimes didn't change), so that known
+  licenses are found in memory.  Other names are passed on to FindLicenseType,
+  which knows the special cases and how to report unknown licenses, and its
+  answer (or error) is remembered.
+  """
+
+  STOCK = 'Gentoo Package Stock'
+  CUSTOM = 'Custom'
+
+  def __init__(self, stock_dirs, custom_dirs, hook_cache=None):
+    """Lists the license directories.
+
+    Args:
+      stock_dirs: The directories with the stock Gentoo licenses.
+      custom_dirs: The directories with our own licenses.
+      hook_cache: If non-None, a HookResultCache to keep the listing in.
+    """
+    dirs = stock_dirs + custom_dirs
+    key = None
+    listing = None
+    if hook_cache is not None:
+      key = hook_cache.verdict_key('license_dirs', None, [
+          [x, _get_dir_mtime(x)] for x in dirs])
+      _found, listing = hook_cache.get_verdict(key)
+    if listing is None:
+      listing = []
+      for directory in dirs:
+        try:
+          listing.append(os.listdir(directory))
+        except OSError:
+          listing.append([])
+      if key is not None:
+        hook_cache.put_verdict(key, listing)
+
+    self._types = {}
+    # The first directory a license is in decides its type.
+    for names, kind in reversed(zip(
+        listing, [self.STOCK] * len(stock_dirs) +
+        [self.CUSTOM] * len(custom_dirs))):
+      self._types.update((x, kind) for x in names)
+    self._misses = {}
+
+  def find(self, license_name):
+    """Returns the type of |license_name|.
+
+    Raises:
+      AssertionError: The license is unknown.
+    """
+    kind = self._types.get(license_name)
+    if kind is not None:
+      return kind
+
+    if license_name not in self._misses:
+      try:
+        self._misses[license_name] = licenses_lib.Licensing.FindLicenseType(
+            license_name)
+      except AssertionError as e:
+        self._misses[license_name] = e
+    result = self._misses[license_name]
+    if isinstance(result, AssertionError):
+      raise result
+    return result
+
+
+# The LicenseIndex of this run, once made.
+_LICENSE_INDEX = []
+
+
+def _get_license_index(commit):
+  """Returns the LicenseIndex of this run, making it on first use."""
+  if not _LICENSE_INDEX:
+    stock_dirs, custom_dirs = _get_license_dirs()
+    _LICENSE_INDEX.append(LicenseIndex(
+        stock_dirs, custom_dirs, getattr(commit, 'verdicts', None)))
+  return _LICENSE_INDEX[0]
+
+
 def _check_ebuild_licenses(_project, commit):
   """Check if the LICENSE field in the ebuild is correct."""
-  affected_paths = _get_affected_files(commit)
-  touched_ebuilds = [x for x in affected_paths if x.endswith('.ebuild')]
-
   # A list of licenses to ignore for now.
   LICENSES_IGNORE = ['||', '(', ')']
 
-  for ebuild in touched_ebuilds:
+  index = _get_license_index(commit)
+  for ebuild in _get_ebuilds(commit):
     # Skip virutal packages.
-    if ebuild.split('/')[-3] == 'virtual':
+    if ebuild.category == 'virtual':
       continue
 
+    path = os.path.join(_get_project_root(commit), ebuild.path)
     try:
-      license_types = licenses_lib.GetLicenseTypesFromEbuild(ebuild)
+      license_types = ebuild.get_license_types()
     except ValueError as e:
-      return HookFailure(e.message, [ebuild])
+      return HookFailure(e.message, [path])
 
     # Also ignore licenses ending with '?'
     for license_type in [x for x in license_types
                          if x not in LICENSES_IGNORE and not x.endswith('?')]:
       try:
-        licenses_lib.Licensing.FindLicenseType(license_type)
+        index.find(license_type)
       except AssertionError as e:
-        return HookFailure(e.message, [ebuild])
+        return HookFailure(e.message, [path])
 
 
 def _check_ebuild_virtual_pv(project, commit):
@@ -803,21 +2086,15 @@ def _check_ebuild_virtual_pv(project, commit):
   is_board = lambda x: x.startswith('overlay-')
   is_private = lambda x: x.endswith('-private')
 
-  get_pv = re.compile(r'(.*?)virtual/([^/]+)/\2-([^/]*)\.ebuild$')
-
-  ebuilds_re = [r'\.ebuild$']
-  ebuilds = _filter_files(_get_affected_files(commit, relative=True),
-                          ebuilds_re)
   bad_ebuilds = []
 
-  for ebuild in ebuilds:
-    m = get_pv.match(ebuild)
-    if m:
-      overlay = m.group(1)
+  for ebuild in _get_ebuilds(commit):
+    if ebuild.category == 'virtual' and ebuild.version is not None:
+      overlay = ebuild.overlay
       if not overlay or not is_board(overlay):
         overlay = project_base
 
-      pv = m.group(3).split('-', 1)[0]
+      pv = ebuild.version.split('-', 1)[0]
 
       if is_private(overlay):
         want_pv = '3.5' if is_variant(overlay) else '3'
@@ -827,7 +2104,7 @@ def _check_ebuild_virtual_pv(project, commit):
         want_pv = '1'
 
       if pv != want_pv:
-        bad_ebuilds.append((ebuild, pv, want_pv))
+        bad_ebuilds.append((ebuild.path, pv, want_pv))
 
   if bad_ebuilds:
     # pylint: disable=C0301
@@ -885,14 +2162,17 @@ def _check_portage_make_use_var(_project, commit):
 
 def _check_change_has_proper_changeid(_project, commit):
   """Verify that Change-ID is present in last paragraph of commit message."""
-  CHANGE_ID_RE = r'\nChange-Id: I[a-f0-9]+\n'
-  desc = _get_commit_desc(commit)
-  m = re.search(CHANGE_ID_RE, desc)
-  if not m:
+  desc = _get_commit_description(commit)
+  # The first well-formed Change-Id which isn't on the very last line (i.e.
+  # without a newline after it).
+  last = len(desc.lines) - 1
+  index = next((i for i, value in desc.fields.get('Change-Id:', ())
+                if i < last and re.match(r' I[a-f0-9]+\Z', value)), None)
+  if index is None:
     return HookFailure('Change-Id must be in last paragraph of description.')
 
   # Allow s-o-b tags to follow it, but only those.
-  end = desc[m.end():].strip().splitlines()
+  end = '\n'.join(desc.lines[index + 1:]).strip().splitlines()
   if [x for x in end if not x.startswith('Signed-off-by: ')]:
     return HookFailure('Only "Signed-off-by:" tags may follow the Change-Id.')
 
@@ -903,10 +2183,11 @@ def _check_commit_message_style(_project, commit):
   We do not check for BUG=/TEST=/etc... lines here as that is handled by other
   commit hooks.
   """
-  desc = _get_commit_desc(commit)
+  desc = _get_commit_description(commit)
 
-  # The first line should be by itself.
-  lines = desc.splitlines()
+  # The first line should be by itself.  Only the first two lines matter here,
+  # split the way str.splitlines() does (i.e. on CRs too).
+  lines = '\n'.join(desc.lines[:2]).splitlines()
   if len(lines) > 1 and lines[1]:
     return HookFailure('The second line of the commit message must be blank.')
 
@@ -958,15 +2239,24 @@ def _check_cros_license(_project, commit, options=()):
                         included + COMMON_INCLUDED_PATHS,
                         excluded + COMMON_EXCLUDED_PATHS)
 
-  for f in files:
-    contents = _get_file_content(f, commit)
+  def _get_license_verdict(contents):
+    """Returns 'license' or 'copyright' for a bad header, else None."""
     if not contents:
       # Ignore empty files.
-      continue
+      return None
 
     if not license_re.search(contents):
-      bad_files.append(f)
+      return 'license'
     elif copyright_re.search(contents):
+      return 'copyright'
+    return None
+
+  for f in files:
+    verdict = _get_blob_verdict(commit, 'cros_license', f,
+                                _get_license_verdict)
+    if verdict == 'license':
+      bad_files.append(f)
+    elif verdict == 'copyright':
       bad_copyright_files.append(f)
 
   if bad_files:
@@ -1011,15 +2301,10 @@ def _check_aosp_license(_project, commit):
                         COMMON_INCLUDED_PATHS,
                         COMMON_EXCLUDED_PATHS)
 
-  bad_files = []
-  for f in files:
-    contents = _get_file_content(f, commit)
-    if not contents:
-      # Ignore empty files.
-      continue
-
-    if not license_re.search(contents):
-      bad_files.append(f)
+  # Empty files are ignored.
+  is_bad = lambda contents: bool(contents) and not license_re.search(contents)
+  bad_files = [f for f in files
+               if _get_blob_verdict(commit, 'aosp_license', f, is_bad)]
 
   if bad_files:
     msg = ('License must match:\n%s\nFound a bad header in these files:' %
@@ -1049,36 +2334,8 @@ def _check_layout_conf(_project, commit):
   # Gather all the errors in one pass so we show one full message.
   all_errors = {}
   for layout_path in layout_paths:
-    all_errors[layout_path] = errors = []
-
-    # Make sure the config file is sorted.
-    data = [x for x in _get_file_content(layout_path, commit).splitlines()
-            if x and x[0] != '#']
-    if sorted(data) != data:
-      errors += ['keep lines sorted']
-
-    # Require people to set specific values all the time.
-    settings = (
-        # TODO: Enable this for everyone.  http://crbug.com/408038
-        #('fast caching', 'cache-format = md5-dict'),
-        ('fast manifests', 'thin-manifests = true'),
-        ('extra features', 'profile-formats = portage-2 profile-default-eapi'),
-        ('newer eapi', 'profile_eapi_when_unspecified = 5-progress'),
-    )
-    for reason, line in settings:
-      if line not in data:
-        errors += ['enable %s with: %s' % (reason, line)]
-
-    # Require one of these settings.
-    if 'use-manifests = strict' not in data:
-      errors += ['enable file checking with: use-manifests = strict']
-
-    # Require repo-name to be set.
-    for line in data:
-      if line.startswith('repo-name = '):
-        break
-    else:
-      errors += ['set the board name with: repo-name = $BOARD']
+    all_errors[layout_path] = _get_blob_verdict(
+        commit, 'layout_conf', layout_path, _get_layout_conf_errors)
 
   # Summarize all the errors we saw (if any).
   lines = ''
@@ -1090,13 +2347,262 @@ def _check_layout_conf(_project, commit):
     return HookFailure(lines)
 
 
+def _get_layout_conf_errors(contents):
+  """Returns the list of problems with the content of a layout.conf file."""
+  errors = []
+
+  # Make sure the config file is sorted.
+  data = [x for x in contents.splitlines() if x and x[0] != '#']
+  if sorted(data) != data:
+    errors += ['keep lines sorted']
+
+  # Require people to set specific values all the time.
+  settings = (
+      # TODO: Enable this for everyone.  http://crbug.com/408038
+      #('fast caching', 'cache-format = md5-dict'),
+      ('fast manifests', 'thin-manifests = true'),
+      ('extra features', 'profile-formats = portage-2 profile-default-eapi'),
+      ('newer eapi', 'profile_eapi_when_unspecified = 5-progress'),
+  )
+  for reason, line in settings:
+    if line not in data:
+      errors += ['enable %s with: %s' % (reason, line)]
+
+  # Require one of these settings.
+  if 'use-manifests = strict' not in data:
+    errors += ['enable file checking with: use-manifests = strict']
+
+  # Require repo-name to be set.
+  for line in data:
+    if line.startswith('repo-name = '):
+      break
+  else:
+    errors += ['set the board name with: repo-name = $BOARD']
+
+  return errors
+
+
 # Project-specific hooks
 
 
-def _run_checkpatch(_project, commit, options=()):
-  """Runs checkpatch.pl on the given project"""
+def _split_patch(patch):
+  """Splits a patch into one patch fragment per file.
+
+  Args:
+    patch: A patch, as made by `git format-patch` or `git diff`.
+
+  Returns:
+    A list of patch fragments, in file order.  The first fragment keeps the
+    commit header (message, diffstat) in front of the first file's diff.
+  """
+  starts = [m.start() for m in re.finditer(r'(?m)^diff --git ', patch)]
+  if len(starts) < 2:
+    return [patch]
+  starts[0] = 0
+  return [patch[start:end] for start, end in zip(starts, starts[1:] + [None])]
+
+
+_CHECKPATCH_TOTAL_RE = re.compile(
+    r'^total: (\d+) errors, (\d+) warnings, (?:(\d+) checks, )?'
+    r'(\d+) lines checked\n', re.M)
+
+# The "#N:" references checkpatch.pl makes to line N of the patch.
+_CHECKPATCH_LINE_RE = re.compile(r'^#(\d+):', re.M)
+
+
+def _merge_checkpatch_outputs(results):
+  """Merges the outputs of checkpatch.pl on the fragments of a patch.
+
+  The reports of the failed fragments come first, in order, with the "#N:"
+  line numbers they refer to made relative to the whole patch.  Then comes
+  one summary adding up the totals of all the fragments, and the notes of the
+  failed fragments, so the output reads as if the whole patch was checked at
+  once.
+
+  Args:
+    results: A list of (first line, CommandResult) tuples, one for each
+        fragment, where the first line is how many lines of the patch come
+        before the fragment.
+
+  Returns:
+    The merged output.
+  """
+  reports = []
+  totals = None
+  notes = []
+  for first_line, result in results:
+    output = result.output
+    m = _CHECKPATCH_TOTAL_RE.search(output)
+    if m is not None:
+      counts = [int(x or 0) for x in m.groups()]
+      totals = counts if totals is None else [
+          x + y for x, y in zip(totals, counts)]
+    if not result.returncode:
+      continue
+    if m is None:
+      # Not something we know how to merge (maybe checkpatch.pl died), so
+      # keep all of it.
+      reports.append(output)
+      continue
+
+    reports.append(_CHECKPATCH_LINE_RE.sub(
+        lambda x, first_line=first_line: '#%d:' % (
+            int(x.group(1)) + first_line),
+        output[:m.start()]))
+    for note in output[m.end():].split('\n\n'):
+      note = note.strip('\n')
+      if note and note not in notes:
+        notes.append(note)
+
+  merged = ''.join(reports)
+  if totals is not None:
+    checks = ''
+    if totals[2]:
+      checks = '%d checks, ' % totals[2]
+    merged += 'total: %d errors, %d warnings, %s%d lines checked\n\n' % (
+        totals[0], totals[1], checks, totals[3])
+    if notes:
+      merged += '\n\n'.join(notes) + '\n'
+  return merged
+
+
+class CheckpatchServer(object):
+  """A checkpatch.pl process checking patches as they are sent to it.
+
+  Starting checkpatch.pl (perl compiling it, loading its spelling list, ...)
+  often takes longer than checking a patch.  In --server mode, checkpatch.pl
+  instead reads patches from its stdin, each sent as its length in bytes on a
+  line of its own followed by the patch, and answers each with a
+  "<exit code> <length>" line followed by the report it would have printed.
+  """
+
+  def __init__(self, cmd, cwd):
+    """Starts checkpatch.pl.
+
+    Args:
+      cmd: The checkpatch.pl command line, without any file to check.
+      cwd: The directory to run checkpatch.pl in.
+    """
+    self._proc = subprocess.Popen(cmd + ['--server'], cwd=cwd,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+
+  def check(self, patch):
+    """Checks |patch|.
+
+    Returns:
+      A (returncode, output) tuple, as a regular checkpatch.pl run would give.
+
+    Raises:
+      IOError: checkpatch.pl exited, or didn't follow the protocol.
+    """
+    self._proc.stdin.write('%d\n%s' % (len(patch), patch))
+    self._proc.stdin.flush()
+    header = self._proc.stdout.readline().split()
+    if len(header) != 2 or not all(x.isdigit() for x in header):
+      raise IOError('checkpatch.pl server exited (code %s)' %
+                    self._proc.poll())
+    returncode, size = int(header[0]), int(header[1])
+    output = self._proc.stdout.read(size)
+    if len(output) != size:
+      raise IOError('checkpatch.pl server sent a truncated report')
+    return returncode, output
+
+  def close(self):
+    """Stops checkpatch.pl."""
+    try:
+      self._proc.stdin.close()
+    except IOError:
+      pass
+    self._proc.wait()
+
+
+# The idle CheckpatchServers, keyed by (command line, directory) tuples.  The
+# key maps to None instead if starting servers that way failed.
+_CHECKPATCH_SERVERS = {}
+_CHECKPATCH_SERVERS_LOCK = threading.Lock()
+
+
+def _run_checkpatch_server(cmd, cwd, patch):
+  """Checks |patch| with an idle checkpatch.pl server, starting one if needed.
+
+  Args:
+    cmd: The checkpatch.pl command line, without any file to check.
+    cwd: The directory to run checkpatch.pl in.
+    patch: The patch to check.
+
+  Returns:
+    A CommandResult, or None if no server could check |patch| (the caller
+    should then run checkpatch.pl the usual way, to get a proper error).
+  """
+  key = (tuple(cmd), cwd)
+  with _CHECKPATCH_SERVERS_LOCK:
+    idle = _CHECKPATCH_SERVERS.setdefault(key, [])
+    if idle is None:
+      return None
+    server = idle.pop() if idle else None
+
+  try:
+    if server is None:
+      server = CheckpatchServer(cmd, cwd)
+    returncode, output = server.check(patch)
+  except (IOError, OSError) as e:
+    print('Not using checkpatch.pl --server: %s' % e, file=sys.stderr)
+    if server is not None:
+      server.close()
+    with _CHECKPATCH_SERVERS_LOCK:
+      _CHECKPATCH_SERVERS[key] = None
+    return None
+
+  with _CHECKPATCH_SERVERS_LOCK:
+    if _CHECKPATCH_SERVERS.get(key) is not None:
+      _CHECKPATCH_SERVERS[key].append(server)
+      server = None
+  if server is not None:
+    server.close()
+  return cros_build_lib.CommandResult(output=output, returncode=returncode)
+
+
+def _close_checkpatch_servers():
+  """Stops all the checkpatch.pl servers."""
+  with _CHECKPATCH_SERVERS_LOCK:
+    servers = [x for idle in _CHECKPATCH_SERVERS.values() if idle
+               for x in idle]
+    _CHECKPATCH_SERVERS.clear()
+  for server in servers:
+    server.close()
+
+
+def _run_checkpatch(project, commit, options=()):
+  """Runs checkpatch.pl on the given project
+
+  The --parallel-jobs=N option (which isn't passed to checkpatch.pl) checks
+  the files of the patch separately, with up to N checkpatch.pl processes at
+  a time.
+
+  The --server option keeps the checkpatch.pl processes running (see
+  CheckpatchServer) and reuses them for the later commits of the run.
+
+  Without either option, checkpatch.pl reads the patch straight from git, so
+  big patches never go through our memory.
+  """
   hooks_dir = _get_hooks_dir()
+  jobs = 1
+  server = False
   options = list(options)
+  for option in options[:]:
+    if option.startswith('--parallel-jobs='):
+      try:
+        jobs = int(option.split('=', 1)[1])
+      except ValueError:
+        jobs = 0
+      if jobs < 1:
+        return HookFailure('Invalid checkpatch option %s: the number of jobs '
+                           'must be a positive integer' % option)
+      options.remove(option)
+    elif option == '--server':
+      server = True
+      options.remove(option)
   if commit == PRE_SUBMIT:
     # The --ignore option must be present and include 'MISSING_SIGN_OFF' in
     # this case.
@@ -1110,14 +2616,60 @@ def _run_checkpatch(_project, commit, options=()):
   # we always do, so disable the check globally.
   options.append('--ignore=GERRIT_CHANGE_ID')
   cmd = ['%s/checkpatch.pl' % hooks_dir] + options + ['-']
-  cmd_result = cros_build_lib.RunCommand(cmd=cmd,
-                                         print_cmd=False,
-                                         input=_get_patch(commit),
-                                         stdout_to_pipe=True,
-                                         combine_stdout_stderr=True,
-                                         error_code_ok=True)
-  if cmd_result.returncode:
-    return HookFailure('checkpatch.pl errors/warnings\n\n' + cmd_result.output)
+
+  def _checkpatch(args):
+    index, patch = args
+    fragment_cmd = cmd
+    if index:
+      # Only the first fragment has the commit message.
+      fragment_cmd = cmd[:-1] + ['--ignore=MISSING_SIGN_OFF', '-']
+    if server:
+      result = _run_checkpatch_server(fragment_cmd[:-1], project.dir, patch)
+      if result is not None:
+        return result
+    return cros_build_lib.RunCommand(cmd=fragment_cmd,
+                                     cwd=project.dir,
+                                     print_cmd=False,
+                                     input=patch,
+                                     stdout_to_pipe=True,
+                                     combine_stdout_stderr=True,
+                                     error_code_ok=True)
+
+  # How many lines of the patch come before each of the fragments checked.
+  first_lines = [0]
+  if jobs <= 1 and not server:
+    # Hand the patch straight from git over to checkpatch.pl, so that it never
+    # needs to fit in our memory.
+    git_proc = _open_patch(commit)
+    try:
+      results = [_checkpatch((0, git_proc.stdout))]
+    finally:
+      git_proc.stdout.close()
+      # checkpatch.pl may have quit before reading all of the patch.
+      if git_proc.poll() is None:
+        git_proc.kill()
+      git_proc.wait()
+  else:
+    patch = _get_patch(commit)
+    fragments = _split_patch(patch) if jobs > 1 else [patch]
+    for fragment in fragments[:-1]:
+      first_lines.append(first_lines[-1] + fragment.count('\n'))
+    if len(fragments) == 1:
+      results = [_checkpatch((0, patch))]
+    else:
+      pool = ThreadPool(min(jobs, len(fragments)))
+      try:
+        results = pool.map(_checkpatch, enumerate(fragments), chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+
+  failed = [x for x in results if x.returncode]
+  if len(results) == 1 and failed:
+    return HookFailure('checkpatch.pl errors/warnings\n\n' + failed[0].output)
+  if failed:
+    return HookFailure('checkpatch.pl errors/warnings\n\n' +
+                       _merge_checkpatch_outputs(zip(first_lines, results)))
 
 
 def _kernel_configcheck(_project, commit):
@@ -1131,8 +2683,11 @@ def _kernel_configcheck(_project, commit):
 def _run_json_check(_project, commit):
   """Checks that all JSON files are syntactically valid."""
   for f in _filter_files(_get_affected_files(commit), [r'.*\.json']):
+    content = _get_tree_file(f, commit)
+    if content is None:
+      continue
     try:
-      json.load(open(f))
+      json.loads(content)
     except Exception, e:
       return HookFailure('Invalid JSON in %s: %s' % (f, e))
 
@@ -1144,14 +2699,14 @@ def _check_manifests(_project, commit):
   for path in _get_affected_files(commit):
     if os.path.basename(path) != 'Manifest':
       continue
-    if not os.path.exists(path):
+    content = _get_tree_file(path, commit)
+    if content is None:
       continue
 
-    with open(path, 'r') as f:
-      for line in f.readlines():
-        if not line.startswith('DIST '):
-          paths.append(path)
-          break
+    for line in content.splitlines():
+      if not line.startswith('DIST '):
+        paths.append(path)
+        break
 
   if paths:
     return HookFailure('Please remove lines that do not start with DIST:\n%s' %
@@ -1162,9 +2717,7 @@ def _check_change_has_branch_field(_project, commit):
   """Check for a non-empty 'BRANCH=' field in the commit message."""
   if commit == PRE_SUBMIT:
     return
-  BRANCH_RE = r'\nBRANCH=\S+'
-
-  if not re.search(BRANCH_RE, _get_commit_desc(commit)):
+  if _get_commit_description(commit).get('BRANCH=', r'\S') is None:
     msg = ('Changelist description needs BRANCH field (after first line)\n'
            'E.g. BRANCH=none or BRANCH=link,snow')
     return HookFailure(msg)
@@ -1174,9 +2727,7 @@ def _check_change_has_signoff_field(_project, commit):
   """Check for a non-empty 'Signed-off-by:' field in the commit message."""
   if commit == PRE_SUBMIT:
     return
-  SIGNOFF_RE = r'\nSigned-off-by: \S+'
-
-  if not re.search(SIGNOFF_RE, _get_commit_desc(commit)):
+  if _get_commit_description(commit).get('Signed-off-by:', r' \S') is None:
     msg = ('Changelist description needs Signed-off-by: field\n'
            'E.g. Signed-off-by: My Name <me@chromium.org>')
     return HookFailure(msg)
@@ -1202,6 +2753,7 @@ def _run_project_hook_script(script, project, commit):
   env['PRESUBMIT_FILES'] = '\n'.join(files)
 
   cmd_result = cros_build_lib.RunCommand(cmd=script,
+                                         cwd=project.dir,
                                          env=env,
                                          shell=True,
                                          print_cmd=False,
@@ -1218,6 +2770,22 @@ def _run_project_hook_script(script, project, commit):
                         ':\n' + stdout if stdout else ''))
 
 
+def _run_project_hook_rule(rules, rule, _project, commit):
+  """Reports the lines |commit| added that break one of a project's rules.
+
+  All of the project's |rules| are checked together the first time one of
+  their hooks runs on a commit.
+
+  Args:
+    rules: A tuple of all the project's LineRules.
+    rule: The LineRule from |rules| to report errors for.
+  """
+  errors = _cached(commit, ('line_rules', rules),
+                   lambda: _evaluate_line_rules(rules, commit))[rule.name]
+  if errors:
+    return HookFailure(rule.message, errors)
+
+
 def _check_project_prefix(_project, commit):
   """Require the commit message have a project specific prefix as needed."""
 
@@ -1236,11 +2804,11 @@ def _check_project_prefix(_project, commit):
   # _get_affected_files() should return relative paths, but check against '/' to
   # ensure that this loop terminates even if it receives an absolute path.
   while prefix and prefix != '/':
-    alias_file = os.path.join(prefix, '.project_alias')
+    alias = _get_tree_file(os.path.join(prefix, '.project_alias'), commit)
 
     # If an alias exists, use it.
-    if os.path.isfile(alias_file):
-      project_name = osutils.ReadFile(alias_file).strip()
+    if alias is not None:
+      project_name = alias.strip()
 
     prefix = os.path.dirname(prefix)
 
@@ -1304,14 +2872,36 @@ _HOOK_FLAGS = {
     'bug_field_check': _check_change_has_bug_field,
     'test_field_check': _check_change_has_test_field,
     'manifest_check': _check_manifests,
+    'spelling_check': _check_spelling,
+}
+
+
+# Hooks whose result depends on more than the commit and the config (e.g. on
+# the licenses installed, or on whatever a hook script does), so it can't be
+# cached.
+_UNCACHEABLE_HOOKS = frozenset([
+    _check_ebuild_licenses,
+    _run_project_hook_script,
+])
+
+# The hooks reporting the errors of each of _LINE_RULES.
+_LINE_RULE_HOOKS = {
+    'long_line': _check_no_long_lines,
+    'spelling': _check_spelling,
+    'stray_whitespace': _check_no_stray_whitespace,
+    'tab': _check_no_tabs,
 }
 
 
+def _get_line_rules(hooks):
+  """Returns the _LINE_RULES whose hooks are among |hooks|."""
+  hooks = set(getattr(hook, 'func', hook) for hook in hooks)
+  return [rule for rule in _LINE_RULES if _LINE_RULE_HOOKS[rule.name] in hooks]
+
+
 def _get_override_hooks(config):
   """Returns a set of hooks controlled by the current project's config file.
 
-  Expects to be called within the project root.
-
   Args:
     config: A ConfigParser for the project's config file.
   """
@@ -1353,6 +2943,63 @@ def _get_override_hooks(config):
   return enabled_hooks, disabled_hooks
 
 
+def _get_project_hook_rules(config):
+  """Returns a list of project-specific line rules.
+
+  Each rule bans lines matching a regex from being added, for example:
+    [Hook Rules]
+    no_printf = \\bprintf\\(
+    no_printf.files = *.c *.h
+    no_printf.message = Use LOG() rather than printf().
+
+  The .files (space-separated wildcards matched against paths relative to the
+  project root) and .message settings are optional.
+
+  Args:
+    config: A ConfigParser for the project's config file.
+  """
+  SECTION = 'Hook Rules'
+  if not config.has_section(SECTION):
+    return []
+
+  patterns = {}
+  settings = {'files': {}, 'message': {}}
+  for key, value in config.items(SECTION):
+    name, _, setting = key.partition('.')
+    if not setting:
+      patterns[name] = value
+    elif setting in settings:
+      settings[setting][name] = value
+    else:
+      raise ValueError('Error: unknown key "%s" in hook rules section of "%s"' %
+                       (key, _CONFIG_FILE))
+
+  rules = []
+  for name in sorted(patterns):
+    pattern = patterns[name]
+    try:
+      regex = re.compile(pattern)
+    except re.error as e:
+      raise ValueError('Error: invalid regex for "%s" in "%s": %s' %
+                       (name, _CONFIG_FILE, e))
+    files = settings['files'].get(name)
+    rules.append(LineRule(
+        name, regex.search,
+        lambda path, line_num, _line, _found: '%s, line %s' % (path, line_num),
+        pattern=pattern,
+        files=_compile_wildcards(files.split()) if files else None,
+        message=settings['message'].get(
+            name, 'Found lines matching "%s" in:' % pattern)))
+
+  for setting in settings.itervalues():
+    for name in setting:
+      if name not in patterns:
+        raise ValueError('Error: no regex for rule "%s" in "%s"' %
+                         (name, _CONFIG_FILE))
+
+  return rules
+
+
 def _get_project_hook_scripts(config):
   """Returns a list of project-specific hook scripts.
 
@@ -1368,18 +3015,45 @@ def _get_project_hook_scripts(config):
   return [x[1] for x in hook_names_values]
 
 
-def _get_project_hooks(project, presubmit):
-  """Returns a list of hooks that need to be run for a project.
+def _is_bare_repo(proj_dir):
+  """Returns whether |proj_dir| is a bare git repository (no working tree)."""
+  return _run_command(['git', 'rev-parse', '--is-bare-repository'],
+                      cwd=proj_dir, redirect_stderr=True).strip() == 'true'
+
+
+def _read_project_config(proj_dir):
+  """Returns the content of a project's _CONFIG_FILE.
+
+  The file is read from the working tree.  A bare repository has none, so the
+  file committed in HEAD is used instead.
+
+  Args:
+    proj_dir: The directory the project is in.
+
+  Returns:
+    The content of the file, or None if there is none.
+  """
+  path = os.path.join(proj_dir, _CONFIG_FILE)
+  if os.path.isfile(path):
+    return osutils.ReadFile(path)
+  if _is_bare_repo(proj_dir):
+    return _get_tree_file(_CONFIG_FILE, CommitContext('HEAD', proj_dir))
+  return None
 
-  Expects to be called from within the project root.
+
+def _get_project_hooks(project, presubmit, proj_dir):
+  """Returns a list of hooks that need to be run for a project.
 
   Args:
     project: A string, name of the project.
     presubmit: A Boolean, True if the check is run as a git pre-submit script.
+    proj_dir: The directory the project is in.
   """
   config = ConfigParser.RawConfigParser()
   try:
-    config.read(_CONFIG_FILE)
+    content = _read_project_config(proj_dir)
+    if content is not None:
+      config.readfp(StringIO.StringIO(content), _CONFIG_FILE)
   except ConfigParser.Error:
     # Just use an empty config file
     config = ConfigParser.RawConfigParser()
@@ -1405,14 +3079,236 @@ def _get_project_hooks(project, presubmit):
     hooks.extend(hook for hook in _PROJECT_SPECIFIC_HOOKS[project]
                  if hook not in disabled_hooks)
 
+  rules = tuple(_get_project_hook_rules(config))
+  for rule in rules:
+    hooks.append(functools.partial(_run_project_hook_rule, rules, rule))
+
   for script in _get_project_hook_scripts(config):
     hooks.append(functools.partial(_run_project_hook_script, script))
 
   return hooks
 
 
+def _get_file_hash(path):
+  """Returns the SHA-1 of the content of |path|, or None if it can't be read."""
+  try:
+    return hashlib.sha1(osutils.ReadFile(path)).hexdigest()
+  except (IOError, OSError):
+    return None
+
+
+_REPOHOOKS_VERSION = []
+
+
+def _get_repohooks_version():
+  """Returns a hash identifying the version of the hooks being run."""
+  if not _REPOHOOKS_VERSION:
+    base = os.path.dirname(os.path.realpath(__file__))
+    _REPOHOOKS_VERSION.append(hashlib.sha1(''.join(
+        str(_get_file_hash(os.path.join(base, x)))
+        for x in ('pre-upload.py', 'errors.py', 'checkpatch.pl',
+                  'spelling.txt'))).hexdigest())
+  return _REPOHOOKS_VERSION[0]
+
+
+def _get_hook_id(hook):
+  """Returns a string identifying |hook|, including any bound options."""
+  if isinstance(hook, functools.partial):
+    return '%s%r%r' % (hook.func.__name__, hook.args,
+                       sorted((hook.keywords or {}).items()))
+  return hook.__name__
+
+
+def _encode_cached_value(value):
+  """Returns |value| with its strings made safe to store as JSON.
+
+  JSON can only hold text, while hooks deal in byte strings which may not be
+  valid UTF-8.  Byte strings are mapped to text one character per byte (see
+  _decode_cached_value); unicode strings are stored as their UTF-8 bytes.
+  """
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  if isinstance(value, str):
+    return value.decode('latin-1')
+  if isinstance(value, (list, tuple)):
+    return [_encode_cached_value(x) for x in value]
+  if isinstance(value, dict):
+    return dict((_encode_cached_value(k), _encode_cached_value(v))
+                for k, v in value.iteritems())
+  return value
+
+
+def _decode_cached_value(value):
+  """Turns a value stored by _encode_cached_value back into byte strings."""
+  if isinstance(value, unicode):
+    return value.encode('latin-1')
+  if isinstance(value, list):
+    return [_decode_cached_value(x) for x in value]
+  if isinstance(value, dict):
+    return dict((_decode_cached_value(k), _decode_cached_value(v))
+                for k, v in value.iteritems())
+  return value
+
+
+class HookResultCache(object):
+  """Remembers the results of hooks on commits across runs.
+
+  Results are keyed by the commit SHA, the hook (and its options), the project
+  (and where it is checked out, as failures name files by their full paths),
+  the version of the hooks and the content of the project's _CONFIG_FILE, so
+  a result is only reused when running the hook again would give the same
+  result.  Hooks in _UNCACHEABLE_HOOKS are never cached.
+
+  It also keeps the verdicts of checks on file contents, keyed by blob SHA (see
+  _get_blob_verdict).  Everything is stored in a cache.Cache, which is shared
+  with other projects and runs.
+  """
+
+  # Stands in for missing entries, as None is a valid result.
+  _MISSING = object()
+
+  def __init__(self, store, config_hash):
+    """Initialize.
+
+    Args:
+      store: The cache.Cache to keep results in.
+      config_hash: The hash of the project's _CONFIG_FILE (None if missing).
+    """
+    self.store = store
+    self._config_hash = config_hash
+
+  def key(self, hook, project, commit):
+    """Returns the key to cache |hook|'s result on |commit| under.
+
+    Returns:
+      The key, or None if the result can't be cached.
+    """
+    if (getattr(hook, 'func', hook) in _UNCACHEABLE_HOOKS or
+        getattr(commit, 'info', None) is None):
+      return None
+    return 'hook:' + hashlib.sha1(json.dumps([
+        _get_repohooks_version(), self._config_hash, project.name,
+        project.dir, project.remote, commit.info.sha,
+        _get_hook_id(hook)])).hexdigest()
+
+  def verdict_key(self, check, sha, options=()):
+    """Returns the key to cache the verdict of |check| on blob |sha| under."""
+    return 'verdict:' + hashlib.sha1(json.dumps([
+        _get_repohooks_version(), check, sha, options])).hexdigest()
+
+  def get_many(self, keys):
+    """Looks up the results of several hooks at once.
+
+    Returns:
+      A dictionary mapping the keys that were found to their HookFailure (or
+      None) results.
+    """
+    results = self.store.GetMany(keys)
+    for key, result in results.iteritems():
+      if result is not None:
+        results[key] = HookFailure(*_decode_cached_value(result))
+    return results
+
+  def get(self, key):
+    """Returns a (found, result) tuple for the result cached under |key|."""
+    results = self.get_many([key])
+    return key in results, results.get(key)
+
+  def put(self, key, result):
+    """Caches the |result| (a HookFailure or None) of a hook under |key|."""
+    if result is not None:
+      result = _encode_cached_value([result.msg, result.items])
+    self.store.Put(key, result)
+
+  def get_verdict(self, key):
+    """Returns a (found, verdict) tuple for the verdict cached under |key|."""
+    verdict = self.store.Get(key, self._MISSING)
+    if verdict is self._MISSING:
+      return False, None
+    return True, _decode_cached_value(verdict)
+
+  def put_verdict(self, key, verdict):
+    """Caches a |verdict| of a check under |key|."""
+    self.store.Put(key, _encode_cached_value(verdict))
+
+
+def _open_hook_cache(proj_dir):
+  """Returns a HookResultCache for a project, or None if it can't be opened."""
+  try:
+    store = cache.Cache(cache.GetDefaultPath())
+  except (sqlite3.Error, OSError) as e:
+    print('Not caching hook results: %s' % e, file=sys.stderr)
+    return None
+  config = _read_project_config(proj_dir)
+  return HookResultCache(
+      store, hashlib.sha1(config).hexdigest() if config is not None else None)
+
+
+def _close_hook_cache(hook_cache):
+  """Saves what |hook_cache| learned and releases it."""
+  try:
+    hook_cache.store.Close()
+  except (sqlite3.Error, ValueError) as e:
+    print('Failed to save hook results: %s' % e, file=sys.stderr)
+
+
+def _run_hooks(hooks, project, commit, pool):
+  """Runs all the |hooks| on |commit|.
+
+  Args:
+    hooks: A list of hooks to run.
+    project: The Project the hooks are run for.
+    commit: The commit to run the hooks on.
+    pool: If non-None, a ThreadPool to run the hooks in parallel in.
+
+  Returns:
+    A list with the result of each hook, in the same order as |hooks|.
+  """
+  run_hook = lambda hook: hook(project, commit)
+  if pool is None:
+    return [run_hook(hook) for hook in hooks]
+  return pool.map(run_hook, hooks, chunksize=1)
+
+
+def _run_hooks_cached(hooks, project, commit, pool, hook_cache):
+  """Runs all the |hooks| on |commit|, reusing the results in |hook_cache|.
+
+  Args:
+    hooks: A list of hooks to run.
+    project: The Project the hooks are run for.
+    commit: The commit to run the hooks on.
+    pool: If non-None, a ThreadPool to run the hooks in parallel in.
+    hook_cache: If non-None, the HookResultCache to reuse results from (and to
+        store new results in).
+
+  Returns:
+    A list with the result of each hook, in the same order as |hooks|.
+  """
+  if hook_cache is None:
+    return _run_hooks(hooks, project, commit, pool)
+
+  results = [None] * len(hooks)
+  keys = [hook_cache.key(hook, project, commit) for hook in hooks]
+  cached = hook_cache.get_many(x for x in keys if x)
+  pending = []
+  for i, key in enumerate(keys):
+    if key in cached:
+      results[i] = cached[key]
+    else:
+      pending.append(i)
+
+  pending_results = _run_hooks([hooks[i] for i in pending], project, commit,
+                               pool)
+  for i, result in zip(pending, pending_results):
+    results[i] = result
+    if keys[i]:
+      hook_cache.put(keys[i], result)
+  return results
+
+
 def _run_project_hooks(project_name, proj_dir=None,
-                       commit_list=None, presubmit=False):
+                       commit_list=None, presubmit=False, jobs=None,
+                       use_cache=True):
   """For each project run its project specific hook from the hooks dictionary.
 
   Args:
@@ -1422,6 +3318,10 @@ def _run_project_hooks(project_name, proj_dir=None,
     commit_list: A list of commits to run hooks against.  If None or empty list
         then we'll automatically get the list of commits that would be uploaded.
     presubmit: A Boolean, True if the check is run as a git pre-submit script.
+    jobs: The maximum number of hooks to run in parallel on a commit.  If None,
+        use the number of CPUs.
+    use_cache: Whether to reuse the results of hooks from earlier runs.  This
+        is turned off by setting NO_CACHE_ENV in the environment too.
 
   Returns:
     Boolean value of whether any errors were ecountered while running the hooks.
@@ -1440,12 +3340,13 @@ def _run_project_hooks(project_name, proj_dir=None,
       return True
     proj_dir = proj_dirs[0]
 
-  pwd = os.getcwd()
-  # hooks assume they are run from the root of the project
-  os.chdir(proj_dir)
+  # Nothing below depends on the current directory (everything is given the
+  # project dir explicitly), so several projects can be checked at once.
+  proj_dir = os.path.abspath(proj_dir)
 
   remote_branch = _run_command(['git', 'rev-parse', '--abbrev-ref',
-                                '--symbolic-full-name', '@{u}']).strip()
+                                '--symbolic-full-name', '@{u}'],
+                               cwd=proj_dir, redirect_stderr=True).strip()
   if not remote_branch:
     print('Your project %s doesn\'t track any remote repo.' % project_name,
           file=sys.stderr)
@@ -1457,29 +3358,150 @@ def _run_project_hooks(project_name, proj_dir=None,
 
   if not commit_list:
     try:
-      commit_list = _get_commits()
+      commit_infos = _get_commits(proj_dir)
     except VerifyException as e:
       PrintErrorForProject(project.name, HookFailure(str(e)))
-      os.chdir(pwd)
       return True
-
-  hooks = _get_project_hooks(project.name, presubmit)
+    commit_list = list(commit_infos)
+  else:
+    # Commits that weren't given as full SHAs (or are PRE_SUBMIT) won't be
+    # found in this table; their metadata will be looked up on demand.
+    commits = [x for x in commit_list if x != PRE_SUBMIT]
+    commit_infos = {}
+    if commits:
+      commit_infos = _get_commit_infos(['--no-walk=unsorted'] + commits,
+                                       proj_dir)
+
+  hooks = _get_project_hooks(project.name, presubmit, proj_dir)
+  if os.environ.get(NO_CACHE_ENV):
+    use_cache = False
+  hook_cache = _open_hook_cache(proj_dir) if use_cache else None
   error_found = False
-  for commit in commit_list:
-    error_list = []
-    for hook in hooks:
-      hook_error = hook(project, commit)
-      if hook_error:
-        error_list.append(hook_error)
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  # Most hooks spend their time waiting on git or other tools, so threads are
+  # enough to run them in parallel.
+  pool = ThreadPool(min(jobs, len(hooks))) if jobs > 1 and hooks else None
+  line_rules = _get_line_rules(hooks)
+  objects = GitObjectReader(proj_dir)
+  try:
+    for commit in commit_list:
+      # Share the git queries of this commit among all the hooks.
+      commit = CommitContext(commit, proj_dir, objects=objects,
+                             info=commit_infos.get(commit),
+                             verdicts=hook_cache, line_rules=line_rules)
+      error_list = [x for x in _run_hooks_cached(hooks, project, commit, pool,
+                                                  hook_cache) if x]
+      if error_list:
         error_found = True
-    if error_list:
-      PrintErrorsForCommit(project.name, commit, _get_commit_desc(commit),
-                           error_list)
+        PrintErrorsForCommit(project.name, commit, _get_commit_desc(commit),
+                             error_list)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    objects.close()
+    _close_checkpatch_servers()
+    if hook_cache is not None:
+      _close_hook_cache(hook_cache)
 
-  os.chdir(pwd)
   return error_found
 
 
+def _run_project_hooks_buffered(project_name, proj_dir, jobs=None):
+  """Runs _run_project_hooks, capturing everything written to stderr.
+
+  This is meant to be run in a worker process of its own (see _run_projects),
+  as it redirects the stderr of the whole process (and of the tools the hooks
+  run) while it runs.
+
+  Args:
+    project_name: The name of project to run hooks for.
+    proj_dir: The directory the project is in, or None to ask repo.
+    jobs: The maximum number of hooks to run in parallel on a commit.
+
+  Returns:
+    A (found_error, report) tuple, where found_error is the return value of
+    _run_project_hooks and report is everything written to stderr meanwhile.
+  """
+  orig_stderr = sys.stderr
+  saved_fd = os.dup(2)
+  with tempfile.TemporaryFile() as output:
+    # Both file objects share the offset, and ours is unbuffered, so what the
+    # hooks print and what the tools they run print stay in order.
+    os.dup2(output.fileno(), 2)
+    sys.stderr = os.fdopen(os.dup(2), 'w', 0)
+    try:
+      found_error = _run_project_hooks(project_name, proj_dir=proj_dir,
+                                       jobs=jobs)
+    except Exception:  # pylint: disable=broad-except
+      traceback.print_exc()
+      found_error = True
+    finally:
+      sys.stderr.close()
+      sys.stderr = orig_stderr
+      os.dup2(saved_fd, 2)
+      os.close(saved_fd)
+    output.seek(0)
+    return found_error, output.read()
+
+
+def _run_projects(project_list, worktree_list, jobs):
+  """Runs the hooks of several projects at once, in worker processes.
+
+  Each project is checked in a process of its own, with at most |jobs| of them
+  running at a time.  Those processes share the |jobs| CPUs: each one runs as
+  many hooks at once as its share of them, so the tools the hooks start don't
+  overload the machine.
+
+  Args:
+    project_list: List of projects to run on.
+    worktree_list: The directory of each project in project_list, or None to
+        ask repo.
+    jobs: The maximum number of projects to check at once.
+
+  Yields:
+    A (found_error, report) tuple (see _run_project_hooks_buffered) for each
+    project, in the order of |project_list|.  Each one is yielded as soon as
+    it, and all the ones before it, are done.
+  """
+  results = multiprocessing.Queue()
+  hook_jobs = max(1, jobs // max(1, min(jobs, len(project_list))))
+
+  def _Worker(index, project, worktree):
+    results.put((index, _run_project_hooks_buffered(project, worktree,
+                                                    jobs=hook_jobs)))
+
+  tasks = list(enumerate(zip(project_list, worktree_list)))
+  tasks.reverse()
+  running = {}
+  done = {}
+  next_index = 0
+  while next_index < len(project_list):
+    while tasks and len(running) < jobs:
+      index, (project, worktree) = tasks.pop()
+      proc = multiprocessing.Process(target=_Worker,
+                                     args=(index, project, worktree))
+      proc.start()
+      running[index] = (project, proc)
+
+    try:
+      index, result = results.get(timeout=1)
+      done[index] = result
+      running.pop(index)[1].join()
+    except Queue.Empty:
+      # Make sure we don't wait forever on a worker that died on us.
+      for index, (project, proc) in running.items():
+        if proc.exitcode:
+          del running[index]
+          done[index] = (True, 'Checking %s exited unexpectedly (code %s)\n' %
+                         (project, proc.exitcode))
+
+    while next_index in done:
+      yield done.pop(next_index)
+      next_index += 1
+
+
 # Main
 
 
@@ -1500,15 +3522,26 @@ def main(project_list, worktree_list=None, **_kwargs):
   found_error = False
   if not worktree_list:
     worktree_list = [None] * len(project_list)
-  for project, worktree in zip(project_list, worktree_list):
-    if _run_project_hooks(project, proj_dir=worktree):
+
+  if len(project_list) > 1:
+    results = _run_projects(project_list, worktree_list,
+                            multiprocessing.cpu_count())
+  else:
+    results = ((_run_project_hooks(project, proj_dir=worktree), '')
+               for project, worktree in zip(project_list, worktree_list))
+  for project_error, report in results:
+    sys.stderr.write(report)
+    if project_error:
       found_error = True
 
   if found_error:
     msg = ('Preupload failed due to errors in project(s). HINTS:\n'
            '- To disable some source style checks, and for other hints, see '
            '<checkout_dir>/src/repohooks/README\n'
-           '- To upload only current project, run \'repo upload .\'')
+           '- To run all the checks again rather than reuse earlier results, '
+           'set %s=1\n'
+           '- To upload only current project, run \'repo upload .\'' %
+           NO_CACHE_ENV)
     print(msg, file=sys.stderr)
     sys.exit(1)
 
@@ -1556,6 +3589,12 @@ def direct_main(argv):
                       'This option should be used at the \'git commit\' '
                       'phase as opposed to \'repo upload\'. This option '
                       'is mutually exclusive with --rerun-since.')
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='The number of hooks to run in parallel on each '
+                      'commit.  Defaults to the number of CPUs.')
+  parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                      help='Run every hook again instead of reusing results '
+                      'from earlier runs on the same commits.')
   parser.add_argument('commits', nargs='*',
                       help='Check specific commits')
   opts = parser.parse_args(argv)
@@ -1564,15 +3603,6 @@ def direct_main(argv):
     if opts.commits:
       raise BadInvocation('Can\'t pass commits and use rerun-since: %s' %
                           ' '.join(opts.commits))
-
-    cmd = ['git', 'log', '--since="%s"' % opts.rerun_since, '--pretty=%H']
-    all_commits = _run_command(cmd).splitlines()
-    bot_commits = _run_command(cmd + ['--author=chrome-bot']).splitlines()
-
-    # Eliminate chrome-bot commits but keep ordering the same...
-    bot_commits = set(bot_commits)
-    opts.commits = [c for c in all_commits if c not in bot_commits]
-
     if opts.pre_submit:
       raise BadInvocation('rerun-since and pre-submit can not be '
                           'used together')
@@ -1583,18 +3613,26 @@ def direct_main(argv):
     opts.commits = [PRE_SUBMIT,]
 
   # Check/normlaize git dir; if unspecified, we'll use the root of the git
-  # project from CWD
+  # project from CWD.  Bare repositories are fine too: the hooks read
+  # everything from the git objects of the commits.
   if opts.dir is None:
     git_dir = _run_command(['git', 'rev-parse', '--git-dir'],
                            redirect_stderr=True).strip()
     if not git_dir:
       raise BadInvocation('The current directory is not part of a git project.')
-    opts.dir = os.path.dirname(os.path.abspath(git_dir))
+    if _is_bare_repo(os.getcwd()):
+      opts.dir = os.path.abspath(git_dir)
+    else:
+      opts.dir = os.path.dirname(os.path.abspath(git_dir))
   elif not os.path.isdir(opts.dir):
     raise BadInvocation('Invalid dir: %s' % opts.dir)
-  elif not os.path.isdir(os.path.join(opts.dir, '.git')):
+  elif (not os.path.isdir(os.path.join(opts.dir, '.git')) and
+        not _is_bare_repo(opts.dir)):
     raise BadInvocation('Not a git directory: %s' % opts.dir)
 
+  if opts.pre_submit and _is_bare_repo(opts.dir):
+    raise BadInvocation('pre-submit needs a working tree: %s' % opts.dir)
+
   # Identify the project if it wasn't specified; this _requires_ the repo
   # tool to be installed and for the project to be part of a repo checkout.
   if not opts.project:
@@ -1602,9 +3640,19 @@ def direct_main(argv):
     if not opts.project:
       raise BadInvocation("Repo couldn't identify the project of %s" % opts.dir)
 
+  if opts.rerun_since:
+    commit_infos = _get_commit_infos(['--since="%s"' % opts.rerun_since],
+                                     opts.dir)
+
+    # Eliminate chrome-bot commits but keep ordering the same...
+    opts.commits = [x.sha for x in commit_infos.itervalues()
+                    if 'chrome-bot' not in x.author]
+
   found_error = _run_project_hooks(opts.project, proj_dir=opts.dir,
                                    commit_list=opts.commits,
-                                   presubmit=opts.pre_submit)
+                                   presubmit=opts.pre_submit,
+                                   jobs=opts.jobs,
+                                   use_cache=opts.use_cache)
   if found_error:
     return 1
   return 0
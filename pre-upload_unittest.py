@@ -8,9 +8,14 @@
 
 from __future__ import print_function
 
+import functools
+import multiprocessing
 import os
+import re
+import StringIO
 import sys
 
+import cache
 import errors
 
 # pylint: disable=W0212
@@ -21,9 +26,11 @@ sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 '..', '..'))
 
 from chromite.cbuildbot import constants
+from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import git
 from chromite.lib import osutils
+from chromite.licensing import licenses_lib
 
 # Needs to be after chromite imports so we use the bundled copy.
 import mock
@@ -50,6 +57,351 @@ class TryUTF8DecodeTest(cros_test_lib.TestCase):
     self.assertEquals('\x80', pre_upload._try_utf8_decode('\x80'))
 
 
+class FilterFilesTest(cros_test_lib.TestCase):
+  """Tests for _filter_files and PathMatcher."""
+
+  PATHS = ['a.c', 'dir/b.cc', 'dir/README', 'dir/Makefile', 'experimental/c.c',
+           'x.min.js', 'y.js', 'd.txt', 'noext', 'dir.d/noext']
+
+  def _AssertSame(self, include_list, exclude_list=()):
+    """Assert _filter_files agrees with _match_regex_list."""
+    expected = [x for x in self.PATHS
+                if (pre_upload._match_regex_list(x, include_list) and
+                    not pre_upload._match_regex_list(x, exclude_list))]
+    self.assertEqual(pre_upload._filter_files(self.PATHS, include_list,
+                                              exclude_list), expected)
+    return expected
+
+  def testCommonPaths(self):
+    """Verify the common lists behave as with plain regexes."""
+    self.assertEqual(
+        self._AssertSame(pre_upload.COMMON_INCLUDED_PATHS,
+                         pre_upload.COMMON_EXCLUDED_PATHS),
+        ['a.c', 'dir/b.cc', 'dir/Makefile', 'y.js', 'noext', 'dir.d/noext'])
+
+  def testSuffixes(self):
+    """Verify literal suffixes and other regexes can be mixed."""
+    self.assertEqual(self._AssertSame([r'\.c$', r'E$', r'^dir/M']),
+                     ['a.c', 'dir/README', 'dir/Makefile', 'experimental/c.c'])
+
+  def testBackReferences(self):
+    """Verify regexes that can't be combined still work."""
+    self.assertEqual(self._AssertSame([r'(\w)\1', r'^(x)']),
+                     ['dir/b.cc', 'x.min.js'])
+    self._AssertSame([r'(?i)readme', r'\.js$'])
+
+  def testNamedGroups(self):
+    """Verify regexes naming the same group can be used together."""
+    self.assertEqual(self._AssertSame([r'^(?P<x>dir)/R', r'(?P<x>min)\.']),
+                     ['dir/README', 'x.min.js'])
+    prefilter = pre_upload.LinePrefilter([r'(?P<x>a|b)', r'(?P<x>d|e)'])
+    self.assertTrue(prefilter.search('xb'))
+    self.assertTrue(prefilter.search('e'))
+    self.assertFalse(prefilter.search('cf'))
+
+  def testEmptyLists(self):
+    """Verify nothing passes an empty include list."""
+    self.assertEqual(self._AssertSame([]), [])
+
+  def testMatcherMemoized(self):
+    """Verify matchers are shared between users of the same lists."""
+    matcher = pre_upload._get_path_matcher([r'\.c$'], [r'^exp'])
+    self.assertTrue(matcher is pre_upload._get_path_matcher((r'\.c$',),
+                                                            [r'^exp']))
+    self.assertEqual(matcher.filter(self.PATHS), ['a.c'])
+
+
+class IgnoreIndexTest(cros_test_lib.TestCase):
+  """Tests for IgnoreIndex."""
+
+  def setUp(self):
+    self.loaded = []
+    self.files = {
+        '': ['*.o', 'build/*'],
+        'a': ['b/*.txt', '*/gen.c'],
+        'a/b': ['[xy].c'],
+    }
+
+  def _Loader(self, directory):
+    self.loaded.append(directory)
+    return self.files.get(directory, [])
+
+  def testIsIgnored(self):
+    """Verify wildcards apply relative to their own directory."""
+    index = pre_upload.IgnoreIndex('/root', loader=self._Loader)
+    self.assertTrue(index.is_ignored('foo.o'))
+    self.assertTrue(index.is_ignored('a/b/c/foo.o'))
+    self.assertTrue(index.is_ignored('build/x/y.c'))
+    self.assertFalse(index.is_ignored('a/build/y.c'))
+    self.assertTrue(index.is_ignored('a/b/c.txt'))
+    self.assertTrue(index.is_ignored('a/b/gen.c'))
+    self.assertTrue(index.is_ignored('a/b/x.c'))
+    self.assertFalse(index.is_ignored('a/b/z.c'))
+    self.assertFalse(index.is_ignored('a/x.c'))
+    self.assertTrue(index.is_ignored('a/b/.presubmitignore'))
+
+  def testFilter(self):
+    """Verify batches are filtered and each directory is loaded once."""
+    index = pre_upload.IgnoreIndex('/root', loader=self._Loader)
+    self.assertEqual(index.filter(['a/b/z.c', 'a/b/y.c', 'main.c', 'a/b/q.o',
+                                   'a/b/d/z.c']),
+                     ['a/b/z.c', 'main.c', 'a/b/d/z.c'])
+    index.filter(['a/b/z.c', 'a/b/d/z.c'])
+    self.assertEqual(sorted(self.loaded), ['', 'a', 'a/b', 'a/b/d'])
+
+
+class CheckGofmtTest(cros_test_lib.MockTestCase):
+  """Tests for _check_gofmt."""
+
+  def setUp(self):
+    self.PatchObject(pre_upload, '_get_affected_files',
+                     return_value=['a.go', 'x/b.go', 'x/c.go', 'README'])
+    self.PatchObject(pre_upload, '_get_file_content',
+                     side_effect=lambda path, _commit: 'content of ' + path)
+    self.cmd_mock = self.PatchObject(pre_upload, '_run_command')
+
+  def _Gofmt(self, output):
+    """Returns a fake _run_command checking the tree gofmt is run on."""
+    def _RunCommand(cmd, cwd, combine_stdout_stderr):
+      self.assertTrue(combine_stdout_stderr)
+      self.assertEqual(cmd, ['gofmt', '-l', '--', 'a.go', 'x/b.go', 'x/c.go'])
+      for path in cmd[3:]:
+        self.assertEqual(osutils.ReadFile(os.path.join(cwd, path)),
+                         'content of ' + path)
+      return output
+    return _RunCommand
+
+  def testFormatted(self):
+    """Verify well formatted files pass."""
+    self.cmd_mock.side_effect = self._Gofmt('')
+    self.assertEqual(pre_upload._check_gofmt(ProjectNamed('PROJECT'),
+                                             'COMMIT'), None)
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+  def testBadFiles(self):
+    """Verify both unformatted and unparsable files are reported."""
+    self.cmd_mock.side_effect = self._Gofmt(
+        'x/c.go\na.go:3:1: expected declaration, found foo\n')
+    failure = pre_upload._check_gofmt(ProjectNamed('PROJECT'), 'COMMIT')
+    self.assertEqual(failure.msg, 'Files not formatted with gofmt:')
+    self.assertEqual(failure.items, ['a.go', 'x/c.go'])
+
+  def testNoGoFiles(self):
+    """Verify gofmt isn't run without Go files."""
+    pre_upload._get_affected_files.return_value = ['README']
+    self.assertEqual(pre_upload._check_gofmt(ProjectNamed('PROJECT'),
+                                             'COMMIT'), None)
+    self.assertEqual(self.cmd_mock.call_count, 0)
+
+  def testChunkArgs(self):
+    """Verify long argument lists are split up."""
+    self.assertEqual(list(pre_upload._chunk_args(['aaa', 'bb', 'c', 'dddd'],
+                                                 max_len=7)),
+                     [['aaa', 'bb'], ['c', 'dddd']])
+    self.assertEqual(list(pre_upload._chunk_args(['aaaaaaaaa'], max_len=7)),
+                     [['aaaaaaaaa']])
+
+
+class RunCheckpatchTest(cros_test_lib.MockTestCase):
+  """Tests for _run_checkpatch."""
+
+  PATCH = ('From 1234\nSubject: [PATCH] x\n\n---\n a.c | 1 +\n'
+           'diff --git a/a.c b/a.c\n+a\n'
+           'diff --git a/b.c b/b.c\n+b\n'
+           'diff --git a/c.c b/c.c\n+c\n-- \n2.1.0\n')
+
+  def setUp(self):
+    self.PatchObject(pre_upload, '_get_hooks_dir', return_value='/hooks')
+    self.PatchObject(pre_upload, '_get_patch', return_value=self.PATCH)
+    self.git_proc = mock.Mock()
+    self.git_proc.stdout = StringIO.StringIO(self.PATCH)
+    self.git_proc.poll.return_value = 0
+    self.PatchObject(pre_upload, '_open_patch', return_value=self.git_proc)
+    self.cmd_mock = self.PatchObject(cros_build_lib, 'RunCommand')
+    self.cmd_mock.side_effect = self._Checkpatch
+
+  @staticmethod
+  def _Checkpatch(cmd, input, **_kwargs):
+    """Fakes a checkpatch.pl which complains about files b.c and c.c."""
+    # pylint: disable=redefined-builtin
+    if not isinstance(input, basestring):
+      input = input.read()
+    errors = [x for x in ('b.c', 'c.c') if 'b/%s' % x in input]
+    output = ''.join('ERROR: bad %s\n\n' % x for x in errors)
+    if errors:
+      output += ('total: %d errors, 1 warnings, 3 lines checked\n\n'
+                 'NOTE: %s\n\n' % (len(errors), ' '.join(cmd[1:-1])))
+    return cros_build_lib.CommandResult(output=output,
+                                        returncode=1 if errors else 0)
+
+  def testSplitPatch(self):
+    """Verify patches are split per file, keeping the header first."""
+    self.assertEqual(pre_upload._split_patch(self.PATCH), [
+        'From 1234\nSubject: [PATCH] x\n\n---\n a.c | 1 +\n'
+        'diff --git a/a.c b/a.c\n+a\n',
+        'diff --git a/b.c b/b.c\n+b\n',
+        'diff --git a/c.c b/c.c\n+c\n-- \n2.1.0\n'])
+    self.assertEqual(pre_upload._split_patch('diff --git a/a b/a\n+a\n'),
+                     ['diff --git a/a b/a\n+a\n'])
+
+  def testSerial(self):
+    """Verify the whole patch goes to one checkpatch.pl by default."""
+    failure = pre_upload._run_checkpatch(ProjectNamed('PROJECT'), 'COMMIT',
+                                         options=['--no-tree'])
+    self.assertEqual(self.cmd_mock.call_count, 1)
+    self.assertEqual(self.cmd_mock.call_args[1]['cmd'], [
+        '/hooks/checkpatch.pl', '--no-tree', '--ignore=FILE_PATH_CHANGES',
+        '--ignore=GERRIT_CHANGE_ID', '-'])
+    self.assertTrue('ERROR: bad b.c\n\nERROR: bad c.c\n' in failure.msg)
+
+  def testStreaming(self):
+    """Verify checkpatch.pl reads the patch straight from git by default."""
+    self.git_proc.poll.return_value = None
+    pre_upload._run_checkpatch(ProjectNamed('PROJECT'), 'COMMIT')
+    self.assertTrue(self.cmd_mock.call_args[1]['input'] is self.git_proc.stdout)
+    self.assertTrue(self.git_proc.stdout.closed)
+    # git is stopped if checkpatch.pl didn't read all of the patch.
+    self.git_proc.kill.assert_called_once_with()
+    self.git_proc.wait.assert_called_once_with()
+
+  def testParallel(self):
+    """Verify --parallel-jobs checks the files separately."""
+    failure = pre_upload._run_checkpatch(
+        ProjectNamed('PROJECT'), 'COMMIT',
+        options=['--parallel-jobs=2', '--no-tree'])
+    self.assertEqual(self.cmd_mock.call_count, 3)
+    for call in self.cmd_mock.call_args_list:
+      self.assertFalse('--parallel-jobs=2' in call[1]['cmd'])
+      self.assertEqual(
+          '--ignore=MISSING_SIGN_OFF' in call[1]['cmd'],
+          not call[1]['input'].startswith('From '))
+    self.assertEqual(failure.msg, (
+        'checkpatch.pl errors/warnings\n\n'
+        'ERROR: bad b.c\n\nERROR: bad c.c\n\n'
+        'total: 2 errors, 2 warnings, 6 lines checked\n\n'
+        'NOTE: --no-tree --ignore=FILE_PATH_CHANGES --ignore=GERRIT_CHANGE_ID '
+        '--ignore=MISSING_SIGN_OFF\n'))
+
+  def testParallelMatchesSerial(self):
+    """Verify merged parallel reports read like a report on the whole patch."""
+    def _Checkpatch(input, **_kwargs):
+      # pylint: disable=redefined-builtin
+      if not isinstance(input, basestring):
+        input = input.read()
+      lines = input.splitlines()
+      bad = [i + 1 for i, x in enumerate(lines) if x in ('+b', '+c')]
+      output = ''.join('ERROR: bad\n#%d: FILE: x\n\n' % x for x in bad)
+      output += 'total: %d errors, 0 warnings, %d lines checked\n\n' % (
+          len(bad), len([x for x in lines if x.startswith('+')]))
+      if bad:
+        output += 'NOTE: has style problems\n'
+      return cros_build_lib.CommandResult(output=output,
+                                          returncode=1 if bad else 0)
+    self.cmd_mock.side_effect = _Checkpatch
+
+    serial = pre_upload._run_checkpatch(ProjectNamed('PROJECT'), 'COMMIT')
+    parallel = pre_upload._run_checkpatch(ProjectNamed('PROJECT'), 'COMMIT',
+                                          options=['--parallel-jobs=3'])
+    self.assertEqual(parallel.msg, serial.msg)
+    self.assertIn('#11: FILE', parallel.msg)
+    self.assertIn('3 lines checked', parallel.msg)
+
+  def testParallelClean(self):
+    """Verify a clean patch passes when checked in parallel."""
+    self.cmd_mock.side_effect = lambda **_kwargs: (
+        cros_build_lib.CommandResult(output='', returncode=0))
+    self.assertEqual(pre_upload._run_checkpatch(
+        ProjectNamed('PROJECT'), 'COMMIT', options=['--parallel-jobs=4']),
+                     None)
+    self.assertEqual(self.cmd_mock.call_count, 3)
+
+  def testBadParallelJobs(self):
+    """Verify a malformed --parallel-jobs is reported."""
+    for option in ('--parallel-jobs=x', '--parallel-jobs=0',
+                   '--parallel-jobs='):
+      failure = pre_upload._run_checkpatch(ProjectNamed('PROJECT'), 'COMMIT',
+                                           options=[option])
+      self.assertTrue(isinstance(failure, errors.HookFailure))
+      self.assertIn(option, failure.msg)
+    self.assertEqual(self.cmd_mock.call_count, 0)
+
+  def testServer(self):
+    """Verify --server checks all the commits with one checkpatch.pl."""
+    server_mock = self.PatchObject(pre_upload, 'CheckpatchServer')
+    server_mock.return_value.check.return_value = (1, 'ERROR: bad\n')
+    try:
+      for _ in xrange(2):
+        failure = pre_upload._run_checkpatch(
+            ProjectNamed('PROJECT'), 'COMMIT', options=['--server'])
+        self.assertEqual(failure.msg,
+                         'checkpatch.pl errors/warnings\n\nERROR: bad\n')
+    finally:
+      pre_upload._close_checkpatch_servers()
+    server_mock.assert_called_once_with(
+        ['/hooks/checkpatch.pl', '--ignore=FILE_PATH_CHANGES',
+         '--ignore=GERRIT_CHANGE_ID'], None)
+    self.assertEqual(server_mock.return_value.check.call_count, 2)
+    server_mock.return_value.close.assert_called_once_with()
+    self.assertEqual(self.cmd_mock.call_count, 0)
+
+  def testServerFailure(self):
+    """Verify we run checkpatch.pl normally if the server fails."""
+    server_mock = self.PatchObject(pre_upload, 'CheckpatchServer')
+    server_mock.return_value.check.side_effect = IOError('exited')
+    stderr = self.PatchObject(sys, 'stderr', new=StringIO.StringIO())
+    try:
+      for _ in xrange(2):
+        failure = pre_upload._run_checkpatch(
+            ProjectNamed('PROJECT'), 'COMMIT', options=['--server'])
+        self.assertTrue('ERROR: bad b.c\n' in failure.msg)
+    finally:
+      pre_upload._close_checkpatch_servers()
+    # We don't keep trying to start servers once one failed.
+    self.assertEqual(server_mock.call_count, 1)
+    server_mock.return_value.close.assert_called_once_with()
+    self.assertEqual(self.cmd_mock.call_count, 2)
+    self.assertEqual(stderr.getvalue(),
+                     'Not using checkpatch.pl --server: exited\n')
+
+
+class CheckpatchServerTest(cros_test_lib.TestCase):
+  """Tests for CheckpatchServer."""
+
+  # Answers each patch with the patch in upper case, failing on empty ones.
+  FAKE_SERVER = (
+      'import sys\n'
+      'while True:\n'
+      '  size = sys.stdin.readline()\n'
+      '  if not size:\n'
+      '    break\n'
+      '  patch = sys.stdin.read(int(size))\n'
+      '  sys.stdout.write("%d %d\\n%s" % (not patch, len(patch), '
+      'patch.upper()))\n'
+      '  sys.stdout.flush()\n')
+
+  def testProtocol(self):
+    """Verify patches and reports are framed as checkpatch.pl expects."""
+    server = pre_upload.CheckpatchServer(
+        [sys.executable, '-c', self.FAKE_SERVER], None)
+    try:
+      self.assertEqual(server.check('a\n\nb\n'), (0, 'A\n\nB\n'))
+      self.assertEqual(server.check(''), (1, ''))
+      self.assertEqual(server.check('12\n'), (0, '12\n'))
+    finally:
+      server.close()
+
+  def testExited(self):
+    """Verify a server which exited is reported as such."""
+    server = pre_upload.CheckpatchServer(
+        [sys.executable, '-c', 'print("Must be run from a kernel tree")'],
+        None)
+    try:
+      with self.assertRaises(IOError):
+        server.check('a\n')
+    finally:
+      server.close()
+
+
 class CheckNoLongLinesTest(cros_test_lib.MockTestCase):
   """Tests for _check_no_long_lines."""
 
@@ -78,29 +430,269 @@ class CheckNoLongLinesTest(cros_test_lib.MockTestCase):
                       failure.items)
 
 
-class CheckProjectPrefix(cros_test_lib.MockTempDirTestCase):
+class LineRulesTest(cros_test_lib.MockTestCase):
+  """Tests for the line rules shared by the line hooks."""
+
+  def setUp(self):
+    self.PatchObject(pre_upload, '_get_affected_files',
+                     return_value=['a.c', 'dir/Makefile', 'b.c'])
+    self.diff_mock = self.PatchObject(pre_upload, '_get_file_diff')
+    self.diff_mock.side_effect = lambda path, _commit: {
+        'a.c': [(1, u'a\t'), (2, u'x' * 81)],
+        'dir/Makefile': [(3, u'\tb '), (4, u'x' * 90)],
+        'b.c': [(5, u'c '), (6, u'x' * 81 + '\t')],
+    }[path]
+
+  def _NewCommit(self, hooks):
+    """Returns a commit context on which |hooks| are run."""
+    return pre_upload.CommitContext(
+        'COMMIT', '/root', line_rules=pre_upload._get_line_rules(hooks))
+
+  def testOnePass(self):
+    """Verify all the rules are checked while reading each file once."""
+    commit = self._NewCommit([pre_upload._check_no_long_lines,
+                              pre_upload._check_no_stray_whitespace,
+                              pre_upload._check_no_tabs])
+    errors = dict((name, pre_upload._scan_added_lines(commit, name))
+                  for name in ('long_line', 'stray_whitespace', 'tab'))
+    self.assertEqual(errors, {
+        'long_line': ['a.c, line 2, 81 chars', 'dir/Makefile, line 4, 90 chars',
+                      'b.c, line 6, 82 chars'],
+        'stray_whitespace': ['a.c, line 1'],
+        'tab': ['a.c, line 1', 'b.c, line 6'],
+    })
+    self.assertEqual(self.diff_mock.call_count, 3)
+
+  def testEnabledRules(self):
+    """Verify only the rules of the hooks run are checked."""
+    self.assertEqual(
+        [rule.name for rule in pre_upload._get_line_rules(
+            [pre_upload._check_no_tabs, pre_upload._check_spelling,
+             pre_upload._check_gofmt])],
+        ['tab', 'spelling'])
+    commit = self._NewCommit([pre_upload._check_no_tabs])
+    self.assertEqual(pre_upload._scan_added_lines(commit, 'tab'),
+                     ['a.c, line 1', 'b.c, line 6'])
+    # Other rules are still checked when asked for, on their own.
+    self.assertEqual(pre_upload._scan_added_lines(commit, 'stray_whitespace'),
+                     ['a.c, line 1'])
+
+  def testHooks(self):
+    """Verify each hook reports the errors of its own rule."""
+    commit = self._NewCommit([pre_upload._check_no_tabs,
+                              pre_upload._check_no_stray_whitespace])
+    project = ProjectNamed('PROJECT')
+    failure = pre_upload._check_no_tabs(project, commit)
+    self.assertEqual(failure.msg, 'Found a tab character in:')
+    self.assertEqual(failure.items, ['a.c, line 1', 'b.c, line 6'])
+    failure = pre_upload._check_no_stray_whitespace(project, commit)
+    self.assertEqual(failure.items, ['a.c, line 1'])
+    # Neither rule applies to dir/Makefile, so it wasn't even read.
+    self.assertEqual(self.diff_mock.call_count, 2)
+
+  def testMaxErrors(self):
+    """Verify rules stop collecting errors at their limit."""
+    self.diff_mock.side_effect = lambda path, _commit: [
+        (i, u'x' * 81) for i in xrange(4)]
+    failure = pre_upload._check_no_long_lines(ProjectNamed('PROJECT'),
+                                              'COMMIT')
+    self.assertEqual(len(failure.items), 5)
+
+
+class SpellingTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for SpellingList and _check_spelling."""
+
+  SPELLING = ('# mistake||correction\n'
+              '\n'
+              'abov||above\n'
+              'arne\'t||aren\'t\n'
+              'teh||the\n'
+              'tehre||there\n')
+
+  def setUp(self):
+    self.spelling = pre_upload.SpellingList(self.SPELLING)
+
+  def testFind(self):
+    """Verify misspellings are found as whole words, in order."""
+    self.assertEqual(self.spelling.find('teh cat is abov tehre'),
+                     [('teh', 'the'), ('abov', 'above'), ('tehre', 'there')])
+    self.assertEqual(self.spelling.find('(abov), "teh"; arne\'t.'),
+                     [('abov', 'above'), ('teh', 'the'),
+                      ('arne\'t', 'aren\'t')])
+    self.assertEqual(self.spelling.find('tehm abovx arne\'tt x@teh tehr'), [])
+    self.assertEqual(self.spelling.find(u'teh_x 3abov'),
+                     [(u'teh', 'the'), (u'abov', 'above')])
+
+  def testCase(self):
+    """Verify corrections follow the case of the misspellings."""
+    self.assertEqual(self.spelling.find('Teh TEH tEh'),
+                     [('Teh', 'The'), ('TEH', 'THE'), ('tEh', 'the')])
+
+  def testFileCache(self):
+    """Verify spelling lists are only parsed again once changed."""
+    path = os.path.join(self.tempdir, 'spelling.txt')
+    osutils.WriteFile(path, self.SPELLING)
+    spelling = pre_upload._get_spelling_list(path)
+    self.assertTrue(pre_upload._get_spelling_list(path) is spelling)
+    osutils.WriteFile(path, 'wierd||weird\n')
+    os.utime(path, (0, 0))
+    spelling = pre_upload._get_spelling_list(path)
+    self.assertEqual(spelling.fixes, {'wierd': 'weird'})
+
+  def testRealList(self):
+    """Verify the spelling.txt we ship can be parsed."""
+    spelling = pre_upload._get_spelling_list(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'spelling.txt'))
+    self.assertTrue(len(spelling.fixes) > 1000)
+    self.assertEqual(spelling.find('an usefull change'),
+                     [('usefull', 'useful')])
+
+  def testHook(self):
+    """Verify the commit message and added lines are checked."""
+    self.PatchObject(pre_upload, '_get_spelling_list',
+                     return_value=self.spelling)
+    self.PatchObject(pre_upload, '_get_commit_desc',
+                     return_value='Fix teh bug\n\nIt is abov.\n')
+    self.PatchObject(pre_upload, '_get_affected_files',
+                     return_value=['a.c', 'b.c'])
+    self.PatchObject(pre_upload, '_get_file_diff',
+                     side_effect=lambda path, _commit: {
+                         'a.c': [(1, u'ok'), (2, u'// teh abov, teh')],
+                         'b.c': [(3, u'fine')],
+                     }[path])
+    failure = pre_upload._check_spelling(ProjectNamed('PROJECT'), 'COMMIT')
+    self.assertEqual(failure.msg, 'Found possible misspellings:')
+    self.assertEqual(failure.items, [
+        "commit message, line 1: 'teh' -> 'the'",
+        "commit message, line 3: 'abov' -> 'above'",
+        "a.c, line 2: 'teh' -> 'the', 'abov' -> 'above', 'teh' -> 'the'",
+    ])
+
+  def testSharedPass(self):
+    """Verify added lines are checked with the other line rules, once."""
+    self.PatchObject(pre_upload, '_get_spelling_list',
+                     return_value=self.spelling)
+    find_mock = self.PatchObject(self.spelling, 'find',
+                                 wraps=self.spelling.find)
+    self.PatchObject(pre_upload, '_get_commit_desc', return_value='Fix\n')
+    self.PatchObject(pre_upload, '_get_affected_files', return_value=['a.c'])
+    diff_mock = self.PatchObject(pre_upload, '_get_file_diff', return_value=[
+        (1, u'ok'), (2, u'\tteh')])
+    hooks = [pre_upload._check_no_tabs, pre_upload._check_spelling]
+    commit = pre_upload.CommitContext(
+        'COMMIT', '/root', line_rules=pre_upload._get_line_rules(hooks))
+    failures = [hook(ProjectNamed('PROJECT'), commit) for hook in hooks]
+    self.assertEqual(failures[0].items, ['a.c, line 2'])
+    self.assertEqual(failures[1].items, ["a.c, line 2: 'teh' -> 'the'"])
+    self.assertEqual(diff_mock.call_count, 1)
+    # The commit message line, then each added line.
+    self.assertEqual(find_mock.call_count, 3)
+
+
+class LinePrefilterTest(cros_test_lib.TestCase):
+  """Tests for LinePrefilter."""
+
+  def testRequiredLiteral(self):
+    """Verify the literal part every match contains is found."""
+    self.assertEqual(pre_upload._get_required_literal(r'\bprintf\('),
+                     'printf(')
+    self.assertEqual(pre_upload._get_required_literal(r'ab?cdef|x'), None)
+    self.assertEqual(pre_upload._get_required_literal(r'ab?cdef'), 'cdef')
+    self.assertEqual(pre_upload._get_required_literal(r'(?i)abc'), None)
+    self.assertEqual(pre_upload._get_required_literal(r'\w+'), None)
+
+  def testSearch(self):
+    """Verify lines matching any of the regexes are let through."""
+    patterns = [r'\bfoo\(', r'foobar', r'TODO(?!\()', r'\d{5}', r'fo\b']
+    prefilter = pre_upload.LinePrefilter(patterns)
+    for line in ('x = foo(1)', 'foobar', 'TODO: x', 'id 12345', 'fo',
+                 'nothing', 'fobar', u'caf\xe9 1234', 'TOD'):
+      if any(re.search(x, line) for x in patterns):
+        self.assertTrue(prefilter.search(line), line)
+    self.assertFalse(prefilter.search('nothing here'))
+    self.assertFalse(prefilter.search('12 f o o'))
+
+
+class ProjectHookRulesTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the [Hook Rules] section of PRESUBMIT.cfg."""
+
+  def setUp(self):
+    self.PatchObject(pre_upload, '_get_affected_files', return_value=[
+        os.path.join(self.tempdir, 'a.c'), os.path.join(self.tempdir, 'b.py')])
+    self.diff_mock = self.PatchObject(pre_upload, '_get_file_diff')
+    self.diff_mock.side_effect = lambda path, _commit: {
+        'a.c': [(1, u'printf("x");'), (2, u'// TODO: fix'), (3, u'ok')],
+        'b.py': [(4, u'print("x")  # TODO: fix')],
+    }[os.path.basename(path)]
+
+  def _GetRuleHooks(self, data):
+    """Writes a config file and returns the rule hooks it results in."""
+    osutils.WriteFile(os.path.join(self.tempdir, pre_upload._CONFIG_FILE),
+                      data)
+    hooks = pre_upload._get_project_hooks('PROJECT', True, self.tempdir)
+    return [hook for hook in hooks
+            if getattr(hook, 'func', None) == pre_upload._run_project_hook_rule]
+
+  def _RunHooks(self, hooks):
+    """Runs |hooks| on one commit and returns their results."""
+    commit = pre_upload.CommitContext('COMMIT', self.tempdir)
+    return [hook(ProjectNamed('PROJECT'), commit) for hook in hooks]
+
+  def testRules(self):
+    """Verify rules report matching lines in the files they apply to."""
+    hooks = self._GetRuleHooks(
+        '[Hook Rules]\n'
+        'printf = \\bprintf\\(\n'
+        'printf.files = *.c *.h\n'
+        'printf.message = Use LOG().\n'
+        'todo = TODO(?!\\()\n'
+        'unused = XXX\n')
+    printf, todo, unused = self._RunHooks(hooks)
+    self.assertEqual(printf.msg, 'Use LOG().')
+    self.assertEqual(printf.items,
+                     [os.path.join(self.tempdir, 'a.c') + ', line 1'])
+    self.assertEqual(todo.msg, 'Found lines matching "TODO(?!\\()" in:')
+    self.assertEqual(todo.items,
+                     [os.path.join(self.tempdir, 'a.c') + ', line 2',
+                      os.path.join(self.tempdir, 'b.py') + ', line 4'])
+    self.assertEqual(unused, None)
+    # All the rules were checked together.
+    self.assertEqual(self.diff_mock.call_count, 2)
+
+  def testNoRules(self):
+    """Verify there are no rule hooks without a [Hook Rules] section."""
+    self.assertEqual(self._GetRuleHooks('[Hook Scripts]\nfoo = true\n'), [])
+
+  def testBadConfig(self):
+    """Verify mistakes in the section are reported."""
+    self.assertRaises(ValueError, self._GetRuleHooks,
+                      '[Hook Rules]\nfoo = x\nfoo.bar = y\n')
+    self.assertRaises(ValueError, self._GetRuleHooks,
+                      '[Hook Rules]\nfoo = (\n')
+    self.assertRaises(ValueError, self._GetRuleHooks,
+                      '[Hook Rules]\nfoo.message = y\n')
+
+
+class CheckProjectPrefix(cros_test_lib.MockTestCase):
   """Tests for _check_project_prefix."""
 
   def setUp(self):
-    self.orig_cwd = os.getcwd()
-    os.chdir(self.tempdir)
+    self.project = pre_upload.Project('PROJECT', '/PROJECT', None)
     self.file_mock = self.PatchObject(pre_upload, '_get_affected_files')
     self.desc_mock = self.PatchObject(pre_upload, '_get_commit_desc')
-
-  def tearDown(self):
-    os.chdir(self.orig_cwd)
+    self.tree = {}
+    self.PatchObject(pre_upload, '_get_tree_file',
+                     side_effect=lambda path, _commit: self.tree.get(path))
 
   def _WriteAliasFile(self, filename, project):
-    """Writes a project name to a file, creating directories if needed."""
-    os.makedirs(os.path.dirname(filename))
-    osutils.WriteFile(filename, project)
+    """Adds a file with a project name to the tree of the commit."""
+    self.tree[filename] = project
 
   def testInvalidPrefix(self):
     """Report an error when the prefix doesn't match the base directory."""
     self.file_mock.return_value = ['foo/foo.cc', 'foo/subdir/baz.cc']
     self.desc_mock.return_value = 'bar: Some commit'
-    failure = pre_upload._check_project_prefix(ProjectNamed('PROJECT'),
-                                               'COMMIT')
+    failure = pre_upload._check_project_prefix(self.project, 'COMMIT')
     self.assertTrue(failure)
     self.assertEquals(('The commit title for changes affecting only foo' +
                        ' should start with "foo: "'), failure.msg)
@@ -110,7 +702,7 @@ class CheckProjectPrefix(cros_test_lib.MockTempDirTestCase):
     self.file_mock.return_value = ['foo/foo.cc', 'foo/subdir/baz.cc']
     self.desc_mock.return_value = 'foo: Change some files.'
     self.assertFalse(
-        pre_upload._check_project_prefix(ProjectNamed('PROJECT'), 'COMMIT'))
+        pre_upload._check_project_prefix(self.project, 'COMMIT'))
 
   def testAliasFile(self):
     """Use .project_alias to override the project name."""
@@ -118,7 +710,7 @@ class CheckProjectPrefix(cros_test_lib.MockTempDirTestCase):
     self.file_mock.return_value = ['foo/foo.cc', 'foo/subdir/bar.cc']
     self.desc_mock.return_value = 'project: Use an alias.'
     self.assertFalse(
-        pre_upload._check_project_prefix(ProjectNamed('PROJECT'), 'COMMIT'))
+        pre_upload._check_project_prefix(self.project, 'COMMIT'))
 
   def testAliasFileWithSubdirs(self):
     """Check that .project_alias is used when only modifying subdirectories."""
@@ -130,7 +722,7 @@ class CheckProjectPrefix(cros_test_lib.MockTempDirTestCase):
     ]
     self.desc_mock.return_value = 'project: Alias with subdirs.'
     self.assertFalse(
-        pre_upload._check_project_prefix(ProjectNamed('PROJECT'), 'COMMIT'))
+        pre_upload._check_project_prefix(self.project, 'COMMIT'))
 
 
 class CheckKernelConfig(cros_test_lib.MockTestCase):
@@ -314,6 +906,165 @@ src_compile() { }
     self.assertEqual(ret, None)
 
 
+class EbuildTest(cros_test_lib.MockTestCase):
+  """Tests for Ebuild."""
+
+  def setUp(self):
+    self.content_mock = self.PatchObject(pre_upload, '_get_file_content')
+    self.license_mock = self.PatchObject(licenses_lib,
+                                         'GetLicenseTypesFromEbuild',
+                                         return_value=['FROM-BASH'])
+    self.PatchObject(pre_upload, '_LICENSE_INDEX', [])
+
+  def testAtom(self):
+    """Verify the package atom is taken from the path."""
+    ebuild = pre_upload.Ebuild('overlay-x/dev-libs/foo/foo-1.2-r3.ebuild', 'H')
+    self.assertEqual((ebuild.overlay, ebuild.category, ebuild.package,
+                      ebuild.version, ebuild.atom),
+                     ('overlay-x', 'dev-libs', 'foo', '1.2-r3',
+                      'dev-libs/foo-1.2-r3'))
+    ebuild = pre_upload.Ebuild('dev-libs/foo/bar-1.ebuild', 'H')
+    self.assertEqual((ebuild.overlay, ebuild.version, ebuild.atom),
+                     ('', None, None))
+    ebuild = pre_upload.Ebuild('a.ebuild', 'H')
+    self.assertEqual((ebuild.category, ebuild.package), (None, None))
+    self.assertEqual(self.content_mock.call_count, 0)
+
+  def testVariables(self):
+    """Verify the variables are parsed once from the content."""
+    self.content_mock.return_value = ('EAPI="5"\nKEYWORDS="*"\n'
+                                      'KEYWORDS="~arm x86"\nEAPI=1\n')
+    ebuild = pre_upload.Ebuild('cat/foo/foo-1.ebuild', 'H')
+    self.assertEqual(ebuild.eapi, '5')
+    self.assertEqual(ebuild.keywords, [['*'], ['~arm', 'x86']])
+    self.assertFalse(ebuild.is_symlink)
+    self.assertEqual(self.content_mock.call_count, 1)
+
+    self.content_mock.return_value = 'foo-1.ebuild'
+    ebuild = pre_upload.Ebuild('cat/foo/foo-1-r1.ebuild', 'H')
+    self.assertTrue(ebuild.is_symlink)
+    self.assertEqual(ebuild.eapi, None)
+
+  def _GetLicenseTypes(self, content):
+    """Returns the license types of an ebuild with |content|."""
+    self.content_mock.return_value = content
+    ebuild = pre_upload.Ebuild('cat/foo/foo-1.ebuild',
+                               pre_upload.CommitContext('H', '/root'))
+    return ebuild.get_license_types()
+
+  def testLicense(self):
+    """Verify plain LICENSE assignments are read without bash."""
+    self.assertEqual(self._GetLicenseTypes(
+        'inherit foo\nLICENSE="BSD-Google || ( MIT GPL-2 )"\n'),
+                     ['BSD-Google', '||', '(', 'MIT', 'GPL-2', ')'])
+    self.assertEqual(self._GetLicenseTypes('LICENSE=BSD # ok\n\n'), ['BSD'])
+    self.assertEqual(self.license_mock.call_count, 0)
+    self.assertRaises(ValueError, self._GetLicenseTypes, 'LICENSE=""\n\n')
+    self.assertRaises(ValueError, self._GetLicenseTypes,
+                      'LICENSE="BSD, MIT"\n\n')
+
+  def testLicenseFromBash(self):
+    """Verify bash works out LICENSE when it could be anything else."""
+    sourced = []
+    def _GetLicenseTypesFromEbuild(path):
+      sourced.append((os.path.basename(path), osutils.ReadFile(path)))
+      return ['FROM-BASH']
+    self.license_mock.side_effect = _GetLicenseTypesFromEbuild
+
+    contents = ('EAPI=4\ninherit foo\n',
+                'LICENSE="BSD"\ninherit foo\n',
+                'LICENSE="${FOO}"\n\n',
+                'LICENSE="BSD"\nLICENSE+=" MIT"\n',
+                'if x; then\n  LICENSE="BSD"\nfi\n')
+    for content in contents:
+      self.assertEqual(self._GetLicenseTypes(content), ['FROM-BASH'])
+    # The ebuild as of the commit is sourced, not the one in the working tree.
+    self.assertEqual(sourced, [('foo-1.ebuild', x) for x in contents])
+
+  def testLicenseFromBashPreSubmit(self):
+    """Verify the working tree is sourced for pre-submit checks."""
+    self.content_mock.return_value = 'inherit foo\n'
+    ebuild = pre_upload.Ebuild(
+        'cat/foo/foo-1.ebuild',
+        pre_upload.CommitContext(pre_upload.PRE_SUBMIT, '/root'))
+    self.assertEqual(ebuild.get_license_types(), ['FROM-BASH'])
+    self.license_mock.assert_called_once_with('/root/cat/foo/foo-1.ebuild')
+
+  def testSharedByHooks(self):
+    """Verify all the ebuild hooks share one read of each ebuild."""
+    self.PatchObject(pre_upload, '_get_affected_files',
+                     return_value=['virtual/foo/foo-2.ebuild'])
+    self.content_mock.return_value = 'EAPI=2\nKEYWORDS="x86"\n'
+    commit = pre_upload.CommitContext('H', '/root')
+    project = ProjectNamed('PROJECT')
+    self.assertTrue(pre_upload._check_ebuild_eapi(project, commit))
+    self.assertTrue(pre_upload._check_ebuild_keywords(project, commit))
+    self.assertTrue(pre_upload._check_ebuild_virtual_pv(project, commit))
+    self.assertEqual(pre_upload._check_ebuild_licenses(project, commit), None)
+    self.assertEqual(self.content_mock.call_count, 1)
+
+
+class LicenseIndexTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for LicenseIndex."""
+
+  def setUp(self):
+    self.stock = os.path.join(self.tempdir, 'stock')
+    self.custom = os.path.join(self.tempdir, 'custom')
+    for path in ('stock/BSD', 'stock/GPL-2', 'custom/BSD', 'custom/Google'):
+      osutils.Touch(os.path.join(self.tempdir, path), makedirs=True)
+    self.find_mock = self.PatchObject(licenses_lib.Licensing,
+                                      'FindLicenseType')
+    self.find_mock.side_effect = self._FindLicenseType
+    self.listdir_mock = self.PatchObject(os, 'listdir',
+                                         side_effect=os.listdir)
+
+  @staticmethod
+  def _FindLicenseType(license_name):
+    """Fakes FindLicenseType, which knows of skipped licenses."""
+    if license_name == 'Skipped':
+      return 'Custom'
+    raise AssertionError('license %s could not be found' % license_name)
+
+  def _Index(self, hook_cache=None):
+    return pre_upload.LicenseIndex([self.stock],
+                                   [self.custom, '/does/not/exist'],
+                                   hook_cache)
+
+  def testFind(self):
+    """Verify licenses are found in memory, stock ones first."""
+    index = self._Index()
+    self.assertEqual(index.find('BSD'), 'Gentoo Package Stock')
+    self.assertEqual(index.find('GPL-2'), 'Gentoo Package Stock')
+    self.assertEqual(index.find('Google'), 'Custom')
+    self.assertEqual(self.find_mock.call_count, 0)
+    self.assertEqual(self.listdir_mock.call_count, 3)
+
+  def testMisses(self):
+    """Verify other names are looked up once with FindLicenseType."""
+    index = self._Index()
+    for _ in xrange(2):
+      self.assertEqual(index.find('Skipped'), 'Custom')
+      with self.assertRaises(AssertionError) as e:
+        index.find('Nope')
+      self.assertEqual(str(e.exception), 'license Nope could not be found')
+    self.assertEqual(self.find_mock.call_count, 2)
+
+  def testCachedListing(self):
+    """Verify the listing is reused until a directory changes."""
+    hook_cache = pre_upload.HookResultCache(
+        cache.Cache(os.path.join(self.tempdir, 'cache.sqlite')), 'cfg')
+    self._Index(hook_cache)
+    index = self._Index(hook_cache)
+    self.assertEqual(index.find('Google'), 'Custom')
+    self.assertEqual(self.listdir_mock.call_count, 3)
+
+    osutils.Touch(os.path.join(self.custom, 'New'))
+    os.utime(self.custom, (0, 0))
+    index = self._Index(hook_cache)
+    self.assertEqual(index.find('New'), 'Custom')
+    self.assertEqual(self.listdir_mock.call_count, 6)
+
+
 class CheckEbuildKeywords(cros_test_lib.MockTestCase):
   """Tests for _check_ebuild_keywords."""
 
@@ -660,6 +1411,42 @@ class CheckLayoutConfTestCase(cros_test_lib.MockTestCase):
     self.assertRejected(['metadata/layout.conf'])
 
 
+class CommitDescriptionTest(cros_test_lib.MockTestCase):
+  """Tests for CommitDescription."""
+
+  def testParse(self):
+    """Verify the parts of a message are split up."""
+    desc = pre_upload.CommitDescription(
+        'subject: BUG=1\n\nSome text.\nBUG=b:12\n  \n'
+        'TEST=none\nBUG= x\nSigned-off-by: Me\n')
+    self.assertEqual(desc.subject, 'subject: BUG=1')
+    self.assertEqual(desc.paragraphs,
+                     [['Some text.', 'BUG=b:12'],
+                      ['TEST=none', 'BUG= x', 'Signed-off-by: Me']])
+    self.assertEqual(desc.fields, {
+        'BUG=': [(3, 'b:12'), (6, ' x')], 'TEST=': [(5, 'none')],
+        'Signed-off-by:': [(7, ' Me')]})
+    self.assertEqual(desc.get('BUG='), 'b:12')
+    self.assertEqual(desc.get('BUG=', r'\s'), ' x')
+    self.assertEqual(desc.get('BUG=', r'chromium'), None)
+    self.assertEqual(desc.get('Signed-off-by:', r' \S'), ' Me')
+    self.assertEqual(desc.get('BRANCH='), None)
+
+  def testSharedByHooks(self):
+    """Verify the message is only read and parsed once for all the hooks."""
+    desc_mock = self.PatchObject(pre_upload, '_get_commit_desc',
+                                 return_value='subject\n\nBUG=None\nTEST=x\n')
+    commit = pre_upload.CommitContext('COMMIT', '/root')
+    project = ProjectNamed('PROJECT')
+    for hook in (pre_upload._check_change_has_bug_field,
+                 pre_upload._check_change_has_test_field,
+                 pre_upload._check_commit_message_style):
+      self.assertEqual(hook(project, commit), None)
+    self.assertTrue(pre_upload._check_change_has_proper_changeid(project,
+                                                                 commit))
+    self.assertEqual(desc_mock.call_count, 1)
+
+
 class CommitMessageTestCase(cros_test_lib.MockTestCase):
   """Test case for funcs that check commit messages."""
 
@@ -1003,14 +1790,482 @@ class HelpersTest(cros_test_lib.MockTempDirTestCase):
     ])
     self.assertEquals(pre_upload._get_affected_files('HEAD', relative=True), [])
 
+  def _CommitWithIgnoreFiles(self, sha, files):
+    """Returns a CommitContext whose tree holds the given ignore files.
+
+    Args:
+      sha: The name of the commit.
+      files: A dict mapping directories to (blob sha, content) tuples.
+    """
+    objects = self.PatchObject(pre_upload, 'GitObjectReader')
+    def _Info(obj):
+      directory = os.path.dirname(obj.split(':', 1)[1])
+      if directory not in files:
+        return None
+      blob, content = files[directory]
+      return blob, 'blob', len(content)
+    objects.info.side_effect = _Info
+    objects.read.side_effect = (
+        lambda blob: ('blob', dict(files.values())[blob]))
+    return pre_upload.CommitContext(sha, self.tempdir, objects=objects)
+
+  def testGetAffectedFilesPresubmitIgnoreFromCommit(self):
+    """Verify .presubmitignore files are read from the commit's tree."""
+    self._WritePresubmitIgnoreFile('buildbot', '*.txt')
+    commit = self._CommitWithIgnoreFiles('HEAD', {'buildbot': ('1', '*.py')})
+    self.assertEquals(pre_upload._get_affected_files(commit, relative=True),
+                      [])
+    commit = self._CommitWithIgnoreFiles('HEAD', {})
+    self.assertEquals(pre_upload._get_affected_files(commit, relative=True),
+                      ['buildbot/constants.py'])
+
+  def testGetAffectedFilesPresubmitIgnoreBlobCache(self):
+    """Verify an ignore file shared by several commits is read once."""
+    self.PatchObject(pre_upload, '_IGNORE_BLOB_WILDCARDS', {})
+    commit = self._CommitWithIgnoreFiles('sha1', {'': ('1', 'buildbot/\n')})
+    self.assertEquals(pre_upload._get_affected_files(commit), [])
+    commit = pre_upload.CommitContext('sha2', self.tempdir,
+                                      objects=commit.objects)
+    self.assertEquals(pre_upload._get_affected_files(commit), [])
+    self.assertEquals(commit.objects.read.call_count, 1)
+    self.assertEquals(commit.objects.info.call_count, 2)
+
+
+class CommitIgnoreFilesTest(cros_test_lib.TempDirTestCase):
+  """Tests for reading .presubmitignore files from a real commit."""
+
+  def setUp(self):
+    for cmd in (['git', 'init'],
+                ['git', 'config', 'user.email', 'nobody@chromium.org'],
+                ['git', 'config', 'user.name', 'Nobody']):
+      pre_upload._run_command(cmd, cwd=self.tempdir, redirect_stderr=True)
+    pre_upload._run_command(['git', 'commit', '--allow-empty', '-m', 'init'],
+                            cwd=self.tempdir)
+    for path, content in (('my dir/.presubmitignore', '*.txt\n'),
+                          ('my dir/a.txt', 'a\n'),
+                          ('my dir/b.py', 'b\n'),
+                          ('other dir/c.txt', 'c\n')):
+      osutils.WriteFile(os.path.join(self.tempdir, path), content,
+                        makedirs=True)
+    pre_upload._run_command(['git', 'add', '.'], cwd=self.tempdir)
+    pre_upload._run_command(['git', 'commit', '-m', 'msg'], cwd=self.tempdir)
+    self.reader = pre_upload.GitObjectReader(self.tempdir)
+
+  def tearDown(self):
+    self.reader.close()
+
+  def testDirectoryWithSpace(self):
+    """Verify ignore files are found in directories with spaces."""
+    commit = pre_upload.CommitContext('HEAD', self.tempdir,
+                                      objects=self.reader)
+    self.assertEquals(pre_upload._get_affected_files(commit, relative=True),
+                      ['my dir/b.py', 'other dir/c.txt'])
+
+
+class CommitContextTest(cros_test_lib.MockTestCase):
+  """Tests for CommitContext."""
+
+  def setUp(self):
+    self.cmd_mock = self.PatchObject(pre_upload, '_run_command',
+                                     return_value='desc\n')
+    self.diff_mock = self.PatchObject(git, 'RawDiff', return_value=[
+        DiffEntry(src_file='a.py', status='M'),
+        DiffEntry(src_file='b.py', status='D'),
+    ])
+
+  def testIsCommitId(self):
+    """Verify the context can be used as the commit id."""
+    commit = pre_upload.CommitContext('1234', '/root')
+    self.assertEqual(commit, '1234')
+    self.assertEqual('%s^!' % commit, '1234^!')
+
+  def testCommitDescCached(self):
+    """Verify the description is only fetched once."""
+    commit = pre_upload.CommitContext('1234', '/root')
+    self.assertEqual(pre_upload._get_commit_desc(commit), 'desc\n')
+    self.assertEqual(pre_upload._get_commit_desc(commit), 'desc\n')
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+  def testAffectedFilesCached(self):
+    """Verify all _get_affected_files() variants share one git diff."""
+    commit = pre_upload.CommitContext('1234', '/root')
+    files = pre_upload._get_affected_files(commit, relative=True)
+    self.assertEqual(files, ['a.py'])
+    # Callers mutating the result must not affect later callers.
+    files.append('c.py')
+    self.assertEqual(pre_upload._get_affected_files(commit, relative=True),
+                     ['a.py'])
+    self.assertEqual(pre_upload._get_affected_files(
+        commit, relative=True, include_deletes=True), ['a.py', 'b.py'])
+    self.assertEqual(self.diff_mock.call_count, 1)
+
+  def testPlainCommitNotCached(self):
+    """Verify plain commit ids still work, but aren't cached."""
+    pre_upload._get_commit_desc('1234')
+    pre_upload._get_commit_desc('1234')
+    self.assertEqual(self.cmd_mock.call_count, 2)
+
+
+class GetCommitInfosTest(cros_test_lib.MockTestCase):
+  """Tests for _get_commit_infos."""
+
+  def setUp(self):
+    self.cmd_mock = self.PatchObject(pre_upload, '_run_command', return_value=(
+        'sha2\0sha1\0Me <me@chromium.org>\0second\n\nBUG=none\n\0'
+        'sha1\0\0chrome-bot <chrome-bot@chromium.org>\0first\n\n\0'))
+
+  def testParse(self):
+    """Verify all the commits are parsed from one git call."""
+    infos = pre_upload._get_commit_infos(['HEAD~2..'], '/root')
+    self.assertEqual(list(infos), ['sha2', 'sha1'])
+    self.assertEqual(infos['sha2'].parents, ['sha1'])
+    self.assertEqual(infos['sha2'].author, 'Me <me@chromium.org>')
+    self.assertEqual(infos['sha2'].desc, 'second\n\nBUG=none\n\n')
+    self.assertEqual(infos['sha1'].parents, [])
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+  def testCommitDesc(self):
+    """Verify _get_commit_desc uses the fetched info."""
+    infos = pre_upload._get_commit_infos(['HEAD~2..'], '/root')
+    commit = pre_upload.CommitContext('sha2', '/root', info=infos['sha2'])
+    self.assertEqual(pre_upload._get_commit_desc(commit),
+                     'second\n\nBUG=none\n\n')
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+
+class GetFileDiffTest(cros_test_lib.MockTestCase):
+  """Tests for _get_file_diff."""
+
+  DIFF = '\n'.join([
+      'diff --git a/a.py b/a.py',
+      'index 1234..5678 100644',
+      '--- a/a.py',
+      '+++ b/a.py',
+      '@@ -3 +3 @@ def foo():',
+      '-  old',
+      '+  new',
+      '@@ -10,0 +11,3 @@',
+      '+first',
+      '++plus',
+      '+',
+      'diff --git a/gone.py b/gone.py',
+      'deleted file mode 100644',
+      '--- a/gone.py',
+      '+++ /dev/null',
+      '@@ -1 +0,0 @@',
+      '-bye',
+      'diff --git "a/sp\\tace.c" "b/sp\\tace.c"',
+      'new file mode 100644',
+      '--- /dev/null',
+      '+++ "b/sp\\tace.c"',
+      '@@ -0,0 +1 @@',
+      '+hi',
+      '\\ No newline at end of file',
+      'diff --git a/a b.c b/a b.c',
+      'new file mode 100644',
+      '--- /dev/null',
+      '+++ b/a b.c\t',
+      '@@ -0,0 +1 @@',
+      '+space',
+      'diff --git "a/sp\\tace c" "b/sp\\tace c"',
+      'new file mode 100644',
+      '--- /dev/null',
+      '+++ "b/sp\\tace c"\t',
+      '@@ -0,0 +1 @@',
+      '+both',
+  ]) + '\n'
+
+  def setUp(self):
+    self.cmd_mock = self.PatchObject(pre_upload, '_run_command',
+                                     return_value=self.DIFF)
+
+  def testAddedLines(self):
+    """Verify the added lines and their numbers are found."""
+    self.assertEqual(pre_upload._get_file_diff('a.py', 'COMMIT'),
+                     [(3, '  new'), (11, 'first'), (12, '+plus'), (13, '')])
+    self.assertEqual(pre_upload._get_file_diff('sp\tace.c', 'COMMIT'),
+                     [(1, 'hi')])
+    self.assertEqual(pre_upload._get_file_diff('a b.c', 'COMMIT'),
+                     [(1, 'space')])
+    self.assertEqual(pre_upload._get_file_diff('sp\tace c', 'COMMIT'),
+                     [(1, 'both')])
+    self.assertEqual(pre_upload._get_file_diff('gone.py', 'COMMIT'), [])
+
+  def testOneGitCallPerCommit(self):
+    """Verify the whole commit is diffed with a single git call."""
+    commit = pre_upload.CommitContext('COMMIT', '/root')
+    self.assertEqual(pre_upload._get_file_diff('/root/a.py', commit)[0],
+                     (3, '  new'))
+    self.assertEqual(pre_upload._get_file_diff('sp\tace.c', commit),
+                     [(1, 'hi')])
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+
+class HookResultCacheTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for HookResultCache."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'cache.sqlite')
+    self.project = ProjectNamed('PROJECT')
+    self.commit = pre_upload.CommitContext(
+        'sha1', self.tempdir,
+        info=pre_upload.CommitInfo('sha1', (), 'Nobody', 'desc\n'))
+
+  def _NewCache(self, config_hash='cfg'):
+    """Returns a HookResultCache for the test's cache file."""
+    return pre_upload.HookResultCache(cache.Cache(self.path), config_hash)
+
+  def testRoundTrip(self):
+    """Verify results are found again after being saved."""
+    results = self._NewCache()
+    ok_key = results.key(pre_upload._check_no_tabs, self.project, self.commit)
+    bad_key = results.key(pre_upload._check_gofmt, self.project, self.commit)
+    self.assertEqual(results.get(ok_key), (False, None))
+    results.put(ok_key, None)
+    results.put(bad_key, errors.HookFailure('bad', ['a', 'b']))
+    results.store.Close()
+
+    results = self._NewCache()
+    self.assertEqual(results.get(ok_key), (True, None))
+    found, result = results.get(bad_key)
+    self.assertTrue(found)
+    self.assertEqual((result.msg, result.items), ('bad', ['a', 'b']))
+
+  def testNonAscii(self):
+    """Verify results and verdicts with non-ASCII bytes come back intact."""
+    results = self._NewCache()
+    key = results.key(pre_upload._check_no_tabs, self.project, self.commit)
+    verdict_key = results.verdict_key('check', 'sha')
+    results.put(key, errors.HookFailure('caf\xc3\xa9', ['\xff\xfe', u'\xe9']))
+    results.put_verdict(verdict_key, {'\xff': ['\xc3\xa9']})
+    results.store.Close()
+
+    results = self._NewCache()
+    _found, result = results.get(key)
+    self.assertEqual((result.msg, result.items),
+                     ('caf\xc3\xa9', ['\xff\xfe', '\xc3\xa9']))
+    self.assertTrue(isinstance(result.msg, str))
+    self.assertEqual(results.get_verdict(verdict_key),
+                     (True, {'\xff': ['\xc3\xa9']}))
+
+  def testCloseFailure(self):
+    """Verify failing to save results is reported, not raised."""
+    results = self._NewCache()
+    self.PatchObject(results.store, 'Close', side_effect=ValueError('bad'))
+    stderr = self.PatchObject(sys, 'stderr', new=StringIO.StringIO())
+    pre_upload._close_hook_cache(results)
+    self.assertEqual(stderr.getvalue(), 'Failed to save hook results: bad\n')
+
+  def testKeys(self):
+    """Verify keys change with everything a result depends on."""
+    hook = pre_upload._check_cros_license
+    results = self._NewCache()
+    key = results.key(hook, self.project, self.commit)
+    other_keys = [
+        results.key(functools.partial(hook, options=['--x']), self.project,
+                    self.commit),
+        results.key(hook, ProjectNamed('OTHER'), self.commit),
+        results.key(hook, pre_upload.Project('PROJECT', '/other', None),
+                    self.commit),
+        self._NewCache('cfg2').key(hook, self.project, self.commit),
+    ]
+    self.assertEqual(len(set([key] + other_keys)), 5)
+    self.assertEqual(key, results.key(hook, self.project, self.commit))
+
+  def testUncacheable(self):
+    """Verify hooks and commits we can't cache get no key."""
+    results = self._NewCache()
+    self.assertEqual(results.key(pre_upload._check_ebuild_licenses,
+                                 self.project, self.commit), None)
+    script_hook = functools.partial(pre_upload._run_project_hook_script, 'x')
+    self.assertEqual(results.key(script_hook, self.project, self.commit), None)
+    self.assertEqual(results.key(pre_upload._check_no_tabs, self.project,
+                                 'HEAD'), None)
+
+  def testRunHooksCached(self):
+    """Verify only hooks without a cached result are run."""
+    results = self._NewCache()
+    calls = []
+    def _Hook(_project, _commit):
+      calls.append('hook')
+      return errors.HookFailure('hook failed')
+    def _Script(_project, _commit):
+      calls.append('script')
+    self.PatchObject(pre_upload, '_UNCACHEABLE_HOOKS', frozenset([_Script]))
+    for _ in range(2):
+      hook_results = pre_upload._run_hooks_cached(
+          [_Hook, _Script], self.project, self.commit, None, results)
+      self.assertEqual([x and x.msg for x in hook_results],
+                       ['hook failed', None])
+    self.assertEqual(calls, ['hook', 'script', 'script'])
+
+
+class RunProjectHooksCacheTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the result cache of _run_project_hooks."""
+
+  def setUp(self):
+    self.PatchObject(cache, 'GetDefaultPath',
+                     return_value=os.path.join(self.tempdir, 'cache.sqlite'))
+    self.PatchObject(pre_upload, '_get_project_hooks',
+                     return_value=[pre_upload._check_no_long_lines])
+    self.stderr = self.PatchObject(sys, 'stderr', new=StringIO.StringIO())
+    origin = os.path.join(self.tempdir, 'origin')
+    osutils.SafeMakedirs(origin)
+    for cmd in (['git', 'init'],
+                ['git', 'config', 'user.email', 'nobody@chromium.org'],
+                ['git', 'config', 'user.name', 'Nobody'],
+                ['git', 'commit', '--allow-empty', '-m', 'init']):
+      pre_upload._run_command(cmd, cwd=origin, redirect_stderr=True)
+    osutils.WriteFile(os.path.join(origin, 'a.py'), 'x' * 90 + '\n')
+    pre_upload._run_command(['git', 'add', 'a.py'], cwd=origin)
+    pre_upload._run_command(['git', 'commit', '-m', 'long'], cwd=origin)
+    self.sha = pre_upload._run_command(['git', 'rev-parse', 'HEAD'],
+                                       cwd=origin).strip()
+    self.checkouts = []
+    for name in ('one', 'two'):
+      checkout = os.path.join(self.tempdir, name)
+      pre_upload._run_command(['git', 'clone', '-q', origin, checkout],
+                              redirect_stderr=True)
+      self.checkouts.append(checkout)
+
+  def _Run(self, checkout):
+    """Checks the commit in |checkout| and returns what was printed."""
+    self.stderr.truncate(0)
+    self.assertTrue(pre_upload._run_project_hooks(
+        'PROJECT', proj_dir=checkout, commit_list=[self.sha], jobs=1))
+    return self.stderr.getvalue()
+
+  def testCheckouts(self):
+    """Verify failures name the files of the checkout being checked."""
+    calls = []
+    def _CheckNoLongLines(project, commit):
+      calls.append(project.dir)
+      return pre_upload._check_no_long_lines(project, commit)
+    self.PatchObject(pre_upload, '_get_project_hooks',
+                     return_value=[_CheckNoLongLines])
+    for checkout in self.checkouts + self.checkouts:
+      output = self._Run(checkout)
+      self.assertIn(os.path.join(checkout, 'a.py') + ', line 1, 90 chars',
+                    output)
+    # The second run in each checkout reused the first one's result.
+    self.assertEqual(calls, self.checkouts)
+
+  def testNoCacheEnv(self):
+    """Verify the cache can be turned off from the environment."""
+    open_mock = self.PatchObject(pre_upload, '_open_hook_cache')
+    self.PatchObject(os, 'environ',
+                     new=dict(os.environ, **{pre_upload.NO_CACHE_ENV: '1'}))
+    self._Run(self.checkouts[0])
+    self.assertEqual(open_mock.call_count, 0)
+
+
+class GetBlobVerdictTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for _get_blob_verdict."""
+
+  def setUp(self):
+    self.cache = pre_upload.HookResultCache(
+        cache.Cache(os.path.join(self.tempdir, 'cache.sqlite')), 'cfg')
+    self.objects = mock.Mock()
+    self.objects.info.side_effect = (
+        lambda obj: ('blob-' + obj.split(':')[1], 'blob', 1))
+    self.content_mock = self.PatchObject(pre_upload, '_get_file_content',
+                                         return_value='content')
+
+  def _Commit(self, sha):
+    return pre_upload.CommitContext(sha, self.tempdir, objects=self.objects,
+                                    verdicts=self.cache)
+
+  def testReusedAcrossCommits(self):
+    """Verify a blob is only checked once, whichever commit it is in."""
+    func = mock.Mock(return_value=['bad'])
+    for sha in ('sha1', 'sha2'):
+      self.assertEqual(pre_upload._get_blob_verdict(
+          self._Commit(sha), 'check', 'dir/a', func), ['bad'])
+    self.assertEqual(func.call_count, 1)
+    self.assertEqual(self.content_mock.call_count, 1)
+
+    # Other blobs, checks and options get their own verdicts.
+    pre_upload._get_blob_verdict(self._Commit('sha1'), 'check', 'dir/b', func)
+    pre_upload._get_blob_verdict(self._Commit('sha1'), 'other', 'dir/a', func)
+    pre_upload._get_blob_verdict(self._Commit('sha1'), 'check', 'dir/a', func,
+                                 options=['-x'])
+    self.assertEqual(func.call_count, 4)
+
+  def testNoCache(self):
+    """Verify plain commits are checked every time."""
+    func = mock.Mock(return_value=None)
+    for _ in range(2):
+      self.assertEqual(pre_upload._get_blob_verdict('HEAD', 'check', 'a',
+                                                    func), None)
+    self.assertEqual(func.call_count, 2)
+
+  def testHook(self):
+    """Verify hooks report the cached verdicts like fresh ones."""
+    self.PatchObject(pre_upload, '_get_affected_files',
+                     return_value=['a.ebuild', 'b.ebuild'])
+    self.content_mock.return_value = 'EAPI=2\nKEYWORDS="x86"\n'
+    for sha in ('sha1', 'sha2'):
+      failure = pre_upload._check_ebuild_eapi(ProjectNamed('PROJECT'),
+                                              self._Commit(sha))
+      self.assertTrue('a.ebuild: EAPI=2' in failure.msg)
+      failure = pre_upload._check_ebuild_keywords(ProjectNamed('PROJECT'),
+                                                  self._Commit(sha))
+      self.assertTrue(failure.msg.startswith('a.ebuild\n* b.ebuild\n'))
+    # Two files, read once for both checks and both commits.
+    self.assertEqual(self.content_mock.call_count, 2)
+
+
+class GitObjectReaderTest(cros_test_lib.TempDirTestCase):
+  """Tests for GitObjectReader."""
+
+  def setUp(self):
+    for cmd in (['git', 'init'],
+                ['git', 'config', 'user.email', 'nobody@chromium.org'],
+                ['git', 'config', 'user.name', 'Nobody']):
+      pre_upload._run_command(cmd, cwd=self.tempdir, redirect_stderr=True)
+    osutils.WriteFile(os.path.join(self.tempdir, 'a.txt'), 'a\n')
+    osutils.WriteFile(os.path.join(self.tempdir, 'empty'), '')
+    pre_upload._run_command(['git', 'add', '.'], cwd=self.tempdir)
+    pre_upload._run_command(['git', 'commit', '-m', 'msg'], cwd=self.tempdir)
+    self.reader = pre_upload.GitObjectReader(self.tempdir)
+
+  def tearDown(self):
+    self.reader.close()
+
+  def testRead(self):
+    """Verify we can read several objects through one process."""
+    self.assertEqual(self.reader.read('HEAD:a.txt'), ('blob', 'a\n'))
+    self.assertEqual(self.reader.read('HEAD:empty'), ('blob', ''))
+    self.assertEqual(self.reader.read('HEAD:a.txt'), ('blob', 'a\n'))
+
+  def testInfo(self):
+    """Verify we can look up object types and sizes."""
+    sha, obj_type, size = self.reader.info('HEAD:a.txt')
+    self.assertEqual((obj_type, size), ('blob', 2))
+    self.assertEqual(self.reader.read(sha), ('blob', 'a\n'))
+
+  def testMissing(self):
+    """Verify missing objects are reported as None."""
+    self.assertEqual(self.reader.read('HEAD:missing'), None)
+    self.assertEqual(self.reader.info('HEAD:missing'), None)
+    self.assertEqual(self.reader.read('HEAD:my dir/missing'), None)
+    self.assertEqual(self.reader.info('HEAD:my dir/missing'), None)
+    self.assertEqual(self.reader.info('HEAD:a b 1'), None)
+    # Make sure the process is still usable afterwards.
+    self.assertEqual(self.reader.read('HEAD:a.txt'), ('blob', 'a\n'))
+
+
 class CheckForUprev(cros_test_lib.MockTempDirTestCase):
   """Tests for _check_for_uprev."""
 
   def setUp(self):
     self.file_mock = self.PatchObject(git, 'RawDiff')
+    self.tree = []
+    self.tree_mock = self.PatchObject(pre_upload, '_list_tree_files',
+                                      side_effect=lambda _commit: self.tree)
 
   def _Files(self, files):
-    """Create |files| in the tempdir and return full paths to them."""
+    """Add |files| to the tree of the commit and return them."""
     for obj in files:
       if obj.status == 'D':
         continue
@@ -1018,7 +2273,7 @@ class CheckForUprev(cros_test_lib.MockTempDirTestCase):
         f = obj.src_file
       else:
         f = obj.dst_file
-      osutils.Touch(os.path.join(self.tempdir, f), makedirs=True)
+      self.tree.append(f)
     return files
 
   def assertAccepted(self, files, project='project', commit='fake sha1'):
@@ -1058,8 +2313,7 @@ class CheckForUprev(cros_test_lib.MockTempDirTestCase):
 
   def testModifiedFilesOnly(self):
     """Reject ebuilds w/out uprevs and changes in files/."""
-    osutils.Touch(os.path.join(self.tempdir, 'cat/pkg/pkg-0.ebuild'),
-                  makedirs=True)
+    self.tree.append('cat/pkg/pkg-0.ebuild')
     self.assertRejected([DiffEntry(src_file='cat/pkg/files/f', status='A')])
     self.assertRejected([DiffEntry(src_file='cat/pkg/files/g', status='M')])
 
@@ -1082,6 +2336,177 @@ class CheckForUprev(cros_test_lib.MockTempDirTestCase):
     self.assertAccepted([DiffEntry(src_file='c/p/files/f', status='M'),
                          DiffEntry(src_file='c/p/p-9999.ebuild', status='M')])
 
+  def testNearestEbuilds(self):
+    """Verify the nearest directory with ebuilds is reported."""
+    self.tree += ['top.ebuild', 'c/p/p-0.ebuild']
+    self.file_mock.return_value = [
+        DiffEntry(src_file='c/p/files/a/f', status='M')]
+    ret = pre_upload._check_for_uprev(ProjectNamed('project'), 'fake sha1',
+                                      project_top=self.tempdir)
+    self.assertTrue(ret.msg.endswith('\n%s/c/p' % self.tempdir))
+
+    self.tree[:] = ['top.ebuild']
+    ret = pre_upload._check_for_uprev(ProjectNamed('project'), 'fake sha1',
+                                      project_top=self.tempdir)
+    self.assertTrue(ret.msg.endswith('\n%s' % self.tempdir))
+
+  def testTreeOfCommit(self):
+    """Verify the tree of the commit is read, not the working tree."""
+    osutils.Touch(os.path.join(self.tempdir, 'c/p/p-0.ebuild'), makedirs=True)
+    self.assertAccepted([DiffEntry(src_file='c/p/files/f', status='M')])
+    self.tree_mock.assert_called_with('fake sha1')
+
+
+class ListTreeFilesTest(cros_test_lib.TempDirTestCase):
+  """Tests for _list_tree_files and _get_ebuild_dirs."""
+
+  def setUp(self):
+    for cmd in (['git', 'init'],
+                ['git', 'config', 'user.email', 'nobody@chromium.org'],
+                ['git', 'config', 'user.name', 'Nobody']):
+      pre_upload._run_command(cmd, cwd=self.tempdir, redirect_stderr=True)
+    for path in ('a.ebuild', 'c/p/p-1.ebuild', 'c/p/files/x y'):
+      osutils.WriteFile(os.path.join(self.tempdir, path), '', makedirs=True)
+    pre_upload._run_command(['git', 'add', '.'], cwd=self.tempdir)
+    pre_upload._run_command(['git', 'commit', '-m', 'msg'], cwd=self.tempdir)
+    # Later changes to the working tree don't matter.
+    osutils.WriteFile(os.path.join(self.tempdir, 'c/p/p-2.ebuild'), '')
+
+  def testCommit(self):
+    """Verify the tree of a commit is listed."""
+    commit = pre_upload.CommitContext('HEAD', self.tempdir)
+    self.assertEqual(sorted(pre_upload._list_tree_files(commit)),
+                     ['a.ebuild', 'c/p/files/x y', 'c/p/p-1.ebuild'])
+    self.assertEqual(pre_upload._get_ebuild_dirs(commit),
+                     {'': ['a.ebuild'], 'c/p': ['p-1.ebuild']})
+
+  def testPreSubmit(self):
+    """Verify the index is listed for pre-submit checks."""
+    pre_upload._run_command(['git', 'rm', '-q', 'a.ebuild'], cwd=self.tempdir)
+    commit = pre_upload.CommitContext(pre_upload.PRE_SUBMIT, self.tempdir)
+    self.assertEqual(pre_upload._get_ebuild_dirs(commit),
+                     {'c/p': ['p-1.ebuild']})
+
+
+class CheckoutFreeTest(cros_test_lib.TempDirTestCase):
+  """Tests for reading files from the commits rather than the working tree."""
+
+  def setUp(self):
+    self.worktree = os.path.join(self.tempdir, 'worktree')
+    self.bare = os.path.join(self.tempdir, 'bare.git')
+    osutils.SafeMakedirs(self.worktree)
+    for cmd in (['git', 'init'],
+                ['git', 'config', 'user.email', 'nobody@chromium.org'],
+                ['git', 'config', 'user.name', 'Nobody'],
+                ['git', 'commit', '--allow-empty', '-m', 'init']):
+      pre_upload._run_command(cmd, cwd=self.worktree, redirect_stderr=True)
+    for path, content in (('ok.json', '{}'), ('bad.json', '{'),
+                          ('c/p/Manifest', 'DIST a 1\nEBUILD b 2\n'),
+                          ('c/.project_alias', 'alias\n'),
+                          (pre_upload._CONFIG_FILE,
+                           '[Hook Overrides]\njson_check: true\n')):
+      osutils.WriteFile(os.path.join(self.worktree, path), content,
+                        makedirs=True)
+    pre_upload._run_command(['git', 'add', '.'], cwd=self.worktree)
+    pre_upload._run_command(['git', 'commit', '-m', 'msg'], cwd=self.worktree)
+    pre_upload._run_command(['git', 'clone', '-q', '--bare', self.worktree,
+                             self.bare], redirect_stderr=True)
+    # Later changes to the working tree don't matter.
+    osutils.WriteFile(os.path.join(self.worktree, 'bad.json'), '{}')
+    osutils.WriteFile(os.path.join(self.worktree, 'ok.json'), '{')
+
+  def _NewCommit(self, root):
+    """Returns a CommitContext for HEAD in |root|."""
+    commit = pre_upload.CommitContext(
+        'HEAD', root, objects=pre_upload.GitObjectReader(root))
+    self.addCleanup(commit.objects.close)
+    return commit
+
+  def testGetTreeFile(self):
+    """Verify files are read from the commit, and missing ones told apart."""
+    for root in (self.worktree, self.bare):
+      for commit in (self._NewCommit(root),
+                     pre_upload.CommitContext('HEAD', root)):
+        self.assertEqual(pre_upload._get_tree_file('bad.json', commit), '{')
+        self.assertEqual(pre_upload._get_tree_file(
+            os.path.join(root, 'c/.project_alias'), commit), 'alias\n')
+        self.assertEqual(pre_upload._get_tree_file('c/p', commit), None)
+        self.assertEqual(pre_upload._get_tree_file('missing', commit), None)
+
+  def testPreSubmit(self):
+    """Verify the working tree is read for pre-submit checks."""
+    commit = pre_upload.CommitContext(pre_upload.PRE_SUBMIT, self.worktree)
+    self.assertEqual(pre_upload._get_tree_file('bad.json', commit), '{}')
+    self.assertEqual(pre_upload._get_tree_file('c/p', commit), None)
+
+  def testHooks(self):
+    """Verify the hooks only need the git objects."""
+    commit = self._NewCommit(self.bare)
+    project = pre_upload.Project('PROJECT', self.bare, None)
+    failure = pre_upload._run_json_check(project, commit)
+    self.assertTrue(failure.msg.startswith(
+        'Invalid JSON in %s/bad.json' % self.bare))
+    failure = pre_upload._check_manifests(project, commit)
+    self.assertEqual(failure.msg, 'Please remove lines that do not start with '
+                     'DIST:\n%s/c/p/Manifest' % self.bare)
+
+  def testBareConfig(self):
+    """Verify a bare repository uses the config file committed in HEAD."""
+    self.assertTrue(pre_upload._is_bare_repo(self.bare))
+    self.assertFalse(pre_upload._is_bare_repo(self.worktree))
+    self.assertEqual(pre_upload._read_project_config(self.bare),
+                     '[Hook Overrides]\njson_check: true\n')
+    self.assertIn(pre_upload._run_json_check,
+                  pre_upload._get_project_hooks('PROJECT', False, self.bare))
+    os.unlink(os.path.join(self.worktree, pre_upload._CONFIG_FILE))
+    self.assertEqual(pre_upload._read_project_config(self.worktree), None)
+
+
+class MainTest(cros_test_lib.MockTestCase):
+  """Tests for main()"""
+
+  @staticmethod
+  def _RunProjectHooks(project, proj_dir=None, jobs=None):
+    """Fake _run_project_hooks that reports the project it was run on."""
+    print('checked %s in %s' % (project, proj_dir), file=sys.stderr)
+    if jobs is not None:
+      print('with %s jobs' % jobs, file=sys.stderr)
+    return project.startswith('bad')
+
+  def setUp(self):
+    self.hooks_mock = self.PatchObject(pre_upload, '_run_project_hooks',
+                                       side_effect=self._RunProjectHooks)
+    self.stderr = self.PatchObject(sys, 'stderr', new=StringIO.StringIO())
+
+  def testSingleProject(self):
+    """Verify a single project is checked directly."""
+    pre_upload.main(['good'], ['/good'])
+    self.hooks_mock.assert_called_once_with('good', proj_dir='/good')
+    self.assertEqual(self.stderr.getvalue(), 'checked good in /good\n')
+
+  def testProjectsInOrder(self):
+    """Verify the reports of several projects come out in order."""
+    self.PatchObject(multiprocessing, 'cpu_count', return_value=4)
+    projects = ['p%d' % x for x in range(10)]
+    pre_upload.main(projects)
+    self.assertEqual(self.stderr.getvalue(),
+                     ''.join('checked %s in None\nwith 1 jobs\n' % x
+                             for x in projects))
+
+  def testSharedJobs(self):
+    """Verify the projects checked at once share the CPUs."""
+    self.PatchObject(multiprocessing, 'cpu_count', return_value=8)
+    pre_upload.main(['p1', 'p2', 'p3'])
+    self.assertEqual(self.stderr.getvalue().count('with 2 jobs\n'), 3)
+
+  def testErrors(self):
+    """Verify errors in any project are reported."""
+    self.assertRaises(SystemExit, pre_upload.main,
+                      ['good', 'bad', 'good2'], ['/a', '/b', '/c'])
+    self.assertTrue(re.match(
+        'checked good in /a\n.*checked bad in /b\n.*checked good2 in /c\n',
+        self.stderr.getvalue(), re.S))
+
 
 class DirectMainTest(cros_test_lib.MockTempDirTestCase):
   """Tests for direct_main()"""
@@ -1095,7 +2520,8 @@ class DirectMainTest(cros_test_lib.MockTempDirTestCase):
     ret = pre_upload.direct_main([])
     self.assertEqual(ret, 0)
     self.hooks_mock.assert_called_once_with(
-        mock.ANY, proj_dir=os.getcwd(), commit_list=[], presubmit=mock.ANY)
+        mock.ANY, proj_dir=os.getcwd(), commit_list=[], presubmit=mock.ANY,
+        jobs=None, use_cache=True)
 
   def testExplicitDir(self):
     """Verify we can run on a diff dir."""
@@ -1104,7 +2530,7 @@ class DirectMainTest(cros_test_lib.MockTempDirTestCase):
     self.assertEqual(ret, 0)
     self.hooks_mock.assert_called_once_with(
         mock.ANY, proj_dir=constants.CHROMITE_DIR, commit_list=[],
-        presubmit=mock.ANY)
+        presubmit=mock.ANY, jobs=None, use_cache=True)
 
   def testBogusProject(self):
     """A bogus project name should be fine (use default settings)."""
@@ -1114,7 +2540,7 @@ class DirectMainTest(cros_test_lib.MockTempDirTestCase):
     self.assertEqual(ret, 0)
     self.hooks_mock.assert_called_once_with(
         'foooooooooo', proj_dir=constants.CHROMITE_DIR, commit_list=[],
-        presubmit=mock.ANY)
+        presubmit=mock.ANY, jobs=None, use_cache=True)
 
   def testBogustProjectNoDir(self):
     """Make sure --dir is detected even with --project."""
@@ -1122,25 +2548,55 @@ class DirectMainTest(cros_test_lib.MockTempDirTestCase):
     self.assertEqual(ret, 0)
     self.hooks_mock.assert_called_once_with(
         'foooooooooo', proj_dir=os.getcwd(), commit_list=[],
-        presubmit=mock.ANY)
+        presubmit=mock.ANY, jobs=None, use_cache=True)
 
   def testNoGitDir(self):
     """We should die when run on a non-git dir."""
     self.assertRaises(pre_upload.BadInvocation, pre_upload.direct_main,
                       ['--dir', self.tempdir])
 
+  def testBareDir(self):
+    """Verify bare repositories can be checked, but not pre-submit."""
+    pre_upload._run_command(['git', 'init', '-q', '--bare', self.tempdir])
+    ret = pre_upload.direct_main(['--dir', self.tempdir, '--project', 'foo',
+                                  'sha1'])
+    self.assertEqual(ret, 0)
+    self.hooks_mock.assert_called_once_with(
+        'foo', proj_dir=self.tempdir, commit_list=['sha1'], presubmit=False,
+        jobs=None, use_cache=True)
+    self.assertRaises(pre_upload.BadInvocation, pre_upload.direct_main,
+                      ['--dir', self.tempdir, '--project', 'foo',
+                       '--pre-submit'])
+
   def testNoDir(self):
     """We should die when run on a missing dir."""
     self.assertRaises(pre_upload.BadInvocation, pre_upload.direct_main,
                       ['--dir', os.path.join(self.tempdir, 'foooooooo')])
 
+  def testJobs(self):
+    """Verify --jobs is passed along."""
+    ret = pre_upload.direct_main(['--jobs', '4'])
+    self.assertEqual(ret, 0)
+    self.hooks_mock.assert_called_once_with(
+        mock.ANY, proj_dir=mock.ANY, commit_list=[], presubmit=mock.ANY,
+        jobs=4, use_cache=True)
+
+  def testNoCache(self):
+    """Verify --no-cache is passed along."""
+    ret = pre_upload.direct_main(['--no-cache'])
+    self.assertEqual(ret, 0)
+    self.hooks_mock.assert_called_once_with(
+        mock.ANY, proj_dir=mock.ANY, commit_list=[], presubmit=mock.ANY,
+        jobs=None, use_cache=False)
+
   def testCommitList(self):
     """Any args on the command line should be treated as commits."""
     commits = ['sha1', 'sha2', 'shaaaaaaaaaaaan']
     ret = pre_upload.direct_main(commits)
     self.assertEqual(ret, 0)
     self.hooks_mock.assert_called_once_with(
-        mock.ANY, proj_dir=mock.ANY, commit_list=commits, presubmit=mock.ANY)
+        mock.ANY, proj_dir=mock.ANY, commit_list=commits, presubmit=mock.ANY,
+        jobs=None, use_cache=True)
 
 
 if __name__ == '__main__':